@@ -0,0 +1,407 @@
+# build the tables listed in query/make-tables.sql
+# make-tables.sql runs each script in order with psql's \i command
+# here, the tables created and read by each script are used to find which scripts
+# depend on which, and scripts with no outstanding dependencies are run concurrently,
+# each on its own connection and in its own transaction
+#
+#   pool = db.ConnectionPool(dbname='mimic', user='postgres', maxconn=4)
+#   timings = build.run_build(pool, 'query/make-tables.sql', n_jobs=4)
+
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+
+from . import instrument
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def parse_make_tables(filename):
+    # return the scripts called by \i in a psql script, in order
+    # paths are relative to the folder of the psql script, as for psql
+    # commented lines, e.g. "-- \i tbls/sofa-si.sql", are skipped
+    path = os.path.dirname(filename)
+    scripts = list()
+    with open(filename, 'r') as fp:
+        for line in fp.readlines():
+            line = line.strip()
+            if line[0:2] != '\\i':
+                continue
+            scripts.append(os.path.normpath(os.path.join(path, line[2:].strip())))
+    return scripts
+
+def strip_sql_comments(sql):
+    sql = re.sub(r'/\*.*?\*/', ' ', sql, flags=re.DOTALL)
+    return re.sub(r'--[^\n]*', ' ', sql)
+
+def table_name(name):
+    # normalize an identifier, e.g. mimiciii."ICUSTAYS" -> icustays
+    return name.split('.')[-1].replace('"', '').lower()
+
+IDENT = r'((?:"?\w+"?\.)?"?\w+"?)'
+
+# words which can follow a table name, and so are not its alias
+SQL_KEYWORDS = set(['where', 'on', 'using', 'join', 'inner', 'left', 'right', 'full', 'cross',
+                    'natural', 'group', 'order', 'having', 'limit', 'offset', 'union',
+                    'intersect', 'except', 'window', 'for', 'lateral', 'tablesample'])
+
+def script_tables(sql):
+    # return the sets of tables created and read by a script
+    sql = strip_sql_comments(sql)
+    created = re.findall(r'\bcreate\s+(?:or\s+replace\s+)?(?:temp\s+|temporary\s+|unlogged\s+)?'
+                         r'(?:table|materialized\s+view|view)\s+(?:if\s+not\s+exists\s+)?'
+                         + IDENT, sql, flags=re.IGNORECASE)
+    created = set([table_name(t) for t in created])
+
+    # tables after from or join, including comma separated lists, e.g. "from a, b c"
+    read = set()
+    for m in re.finditer(r'\b(?:from|join)\s+', sql, flags=re.IGNORECASE):
+        pos = m.end()
+        while True:
+            t = re.match(IDENT + r'(?:\s+(?:as\s+)?(\w+))?', sql[pos:], flags=re.IGNORECASE)
+            if t is None:
+                break
+            read.add(table_name(t.group(1)))
+            if t.group(2) is not None and t.group(2).lower() in SQL_KEYWORDS:
+                pos += t.end(1)
+            else:
+                pos += t.end()
+            t = re.match(r'\s*,\s*', sql[pos:])
+            if t is None:
+                break
+            pos += t.end()
+
+    # common table expressions are not tables
+    ctes = re.findall(r'(?:\bwith|,)\s*(?:recursive\s+)?"?(\w+)"?\s+as\s*\(', sql, flags=re.IGNORECASE)
+    read = read - set([t.lower() for t in ctes]) - created
+    return created, read
+
+def build_dag(scripts, sql=None):
+    # return an OrderedDict mapping each script to the set of scripts it depends on
+    # a script depends on the scripts before it which:
+    #   create a table it reads
+    #   create, or read, a table it creates (so the result matches a serial build)
+    # sql - dictionary of the text of each script, by default the scripts are read
+    if sql is None:
+        sql = dict()
+        for s in scripts:
+            with open(s, 'r') as fp:
+                sql[s] = fp.read()
+
+    tables = dict([(s, script_tables(sql[s])) for s in scripts])
+
+    dag = OrderedDict()
+    for i, s in enumerate(scripts):
+        created, read = tables[s]
+        dag[s] = set()
+        for s_prev in scripts[:i]:
+            created_prev, read_prev = tables[s_prev]
+            if (read & created_prev) or (created & created_prev) or (created & read_prev):
+                dag[s].add(s_prev)
+    return dag
+
+def critical_path(dag, timings):
+    # return the longest chain of dependent scripts, and its total time
+    finish = dict()
+    prev = dict()
+    for s in dag:
+        prev[s] = max(dag[s], key=lambda d: finish[d]) if dag[s] else None
+        finish[s] = timings[s] + (finish[prev[s]] if prev[s] is not None else 0)
+
+    s = max(finish, key=lambda d: finish[d])
+    total = finish[s]
+    path = list()
+    while s is not None:
+        path.append(s)
+        s = prev[s]
+    return path[::-1], total
+
+def run_script(pool, sql, name='script', log=None):
+    # run a script in a single transaction, returning the wall time in seconds
+    # log - an instrument.QueryLog, if given the plan and time of each statement is logged
+    t0 = time.time()
+    with pool.session() as s, s.transaction() as con:
+        if log is not None:
+            instrument.run_script(con, sql, name=name, log=log)
+        else:
+            cur = con.cursor()
+            cur.execute(sql)
+            cur.close()
+    return time.time() - t0
+
+# === indexes and statistics === #
+# the derived tables are joined on the patient identifiers, and filtered on charttime
+# B-tree indexes are used for the identifiers, and BRIN indexes for charttime, as
+# events are mostly inserted in time order and a BRIN index is a fraction of the size
+INDEX_COLUMNS = OrderedDict([('subject_id', 'btree'), ('hadm_id', 'btree'),
+                             ('icustay_id', 'btree'), ('charttime', 'brin')])
+
+def provision_indexes(con, table, analyze=True):
+    # index the columns in INDEX_COLUMNS of a table, unless they already lead an index
+    # then run ANALYZE on the table if analyze is True, or if it was never analyzed
+    # returns a list of the indexes created
+    cur = con.cursor()
+    try:
+        cur.execute("""
+        select c.relkind, a.attname
+        , exists(select 1 from pg_index i where i.indrelid = c.oid and i.indkey[0] = a.attnum)
+        , coalesce(s.last_analyze, s.last_autoanalyze) is not null
+        from pg_class c
+        inner join pg_attribute a
+          on c.oid = a.attrelid and a.attnum > 0 and not a.attisdropped
+        left join pg_stat_user_tables s
+          on c.oid = s.relid
+        where c.oid = to_regclass(%s)
+        """, [table])
+        rows = cur.fetchall()
+        # views cannot be indexed
+        if len(rows) == 0 or rows[0][0] not in ('r', 'm', 'p'):
+            return list()
+
+        created = list()
+        for relkind, column, indexed, analyzed in rows:
+            if column in INDEX_COLUMNS and not indexed:
+                index_name = (table + '_' + column)[:59] + '_idx'
+                cur.execute('create index if not exists ' + index_name + ' on ' + table
+                            + ' using ' + INDEX_COLUMNS[column] + ' (' + column + ')')
+                created.append(index_name)
+
+        if analyze or len(created) > 0 or not rows[0][3]:
+            cur.execute('analyze ' + table)
+    finally:
+        cur.close()
+    return created
+
+def provision_tables(pool, tables, analyze=True, verbose=False):
+    # provision_indexes for each table, committing after each
+    for t in sorted(tables):
+        with pool.session() as s, s.transaction() as con:
+            created = provision_indexes(con, t, analyze=analyze)
+        if verbose and len(created) > 0:
+            print('  created {}'.format(', '.join(created)))
+
+def index_usage(con):
+    # return a dataframe with the number of scans of each index
+    return pd.read_sql_query("""
+    select schemaname, relname, indexrelname, idx_scan, idx_tup_read, idx_tup_fetch
+    from pg_stat_user_indexes
+    """, con)
+
+def index_usage_delta(before, after):
+    # return the indexes scanned between two index_usage dataframes, most used first
+    keys = ['schemaname', 'relname', 'indexrelname']
+    df = after.merge(before, on=keys, how='left', suffixes=('', '_before')).fillna(0)
+    for c in ['idx_scan', 'idx_tup_read', 'idx_tup_fetch']:
+        df[c] = df[c] - df[c + '_before']
+    df = df.loc[df['idx_scan'] > 0, keys + ['idx_scan', 'idx_tup_read', 'idx_tup_fetch']]
+    return df.sort_values('idx_scan', ascending=False).reset_index(drop=True)
+
+def load_build(filename):
+    # return the scripts in a psql script, a dictionary of their text, and their DAG
+    scripts = parse_make_tables(filename)
+    sql = dict()
+    for s in scripts:
+        with open(s, 'r') as fp:
+            sql[s] = fp.read()
+    return scripts, sql, build_dag(scripts, sql=sql)
+
+def run_build(pool, filename=os.path.join('query', 'make-tables.sql'), n_jobs=4,
+              verbose=True, only=None, callback=None, provision=True, log=None):
+    # run the scripts in a psql script (see parse_make_tables), as concurrently as
+    # their dependencies allow
+    # pool is a db.ConnectionPool with at least n_jobs connections
+    # only - run only these scripts, assuming the tables of the others are up to date
+    # callback - called as callback(script, seconds) once each script has committed
+    # provision - index and analyze the base tables before the build, and the tables
+    #   created by each script before any script which depends on it is started
+    #   the indexes which were used during the build are printed if verbose
+    # log - an instrument.QueryLog, to log the plan and time of each statement
+    # unlike make-tables.sql, each script is committed separately - if a script fails,
+    # no new scripts are started and the error is raised once running scripts finish
+    # returns an OrderedDict with the wall time (seconds) of each script that was run
+    scripts, sql, dag = load_build(filename)
+    if only is not None:
+        scripts = [s for s in scripts if s in only]
+        dag = OrderedDict([(s, dag[s] & set(scripts)) for s in scripts])
+
+    remaining = OrderedDict([(s, set(dag[s])) for s in scripts])
+    timings = dict()
+    done = queue.Queue()
+
+    def run(s):
+        try:
+            t = run_script(pool, sql[s], name=s, log=log)
+            if provision:
+                provision_tables(pool, script_tables(sql[s])[0])
+            done.put((s, t, None))
+        except Exception as e:
+            done.put((s, None, e))
+
+    t0 = time.time()
+    if provision:
+        with pool.session() as ses:
+            usage = index_usage(ses.con)
+        created, read = set(), set()
+        for s in scripts:
+            created_s, read_s = script_tables(sql[s])
+            created |= created_s
+            read |= read_s
+        provision_tables(pool, read - created, analyze=False, verbose=verbose)
+    workers = ThreadPool(n_jobs)
+    error = None
+    n_running = 0
+    try:
+        while len(remaining) > 0 or n_running > 0:
+            if error is None:
+                ready = [s for s in remaining if len(remaining[s]) == 0]
+                for s in ready:
+                    del remaining[s]
+                    workers.apply_async(run, (s,))
+                    n_running += 1
+            if n_running == 0:
+                break
+
+            s, t, e = done.get()
+            n_running -= 1
+            if e is not None:
+                if verbose:
+                    print('Running {} ... failed.'.format(s))
+                if error is None:
+                    error = e
+                continue
+
+            timings[s] = t
+            if verbose:
+                print('Running {} ... done ({:0.1f}s).'.format(s, t))
+            if callback is not None:
+                callback(s, t)
+            for s_next in remaining:
+                remaining[s_next].discard(s)
+    finally:
+        workers.close()
+        workers.join()
+
+    if error is not None:
+        raise error
+
+    timings = OrderedDict([(s, timings[s]) for s in scripts])
+    if verbose and len(timings) > 0:
+        path, total = critical_path(dag, timings)
+        print('Ran {} scripts in {:0.1f}s ({:0.1f}s run serially).'.format(
+            len(timings), time.time() - t0, sum(timings.values())))
+        print('Critical path ({:0.1f}s): {}'.format(total, ' -> '.join(
+            [os.path.basename(s) for s in path])))
+    if verbose and provision:
+        with pool.session() as ses:
+            usage = index_usage_delta(usage, index_usage(ses.con))
+        print('Indexes used during the build:')
+        print(usage.to_string(index=False))
+    return timings
+
+# === incremental builds === #
+# a manifest records, for each script which has been run, a hash of its text and a
+# fingerprint of each table it creates or reads, taken when it finished
+# a script is run again if its text, or the fingerprint of any of its tables, has
+# changed since - as are all scripts downstream of it
+
+def table_fingerprints(con, tables, derived=()):
+    # return a dictionary mapping each table visible on the search_path to a fingerprint
+    # the oid and relfilenode change when a table is recreated, rewritten, truncated or
+    # refreshed, and the tuple counts change when rows are inserted, updated or deleted
+    # tuple counts are reported asynchronously, so are not used for the derived tables,
+    # which are only ever recreated
+    # tables which do not exist are not in the dictionary
+    cur = con.cursor()
+    try:
+        cur.execute("""
+        select c.relname, c.oid, c.relfilenode
+        , pg_stat_get_tuples_inserted(c.oid) + pg_stat_get_tuples_updated(c.oid)
+          + pg_stat_get_tuples_deleted(c.oid) as n_tup_mod
+        from pg_class c
+        where c.relname = any(%s)
+        and c.relkind in ('r', 'm', 'v', 'p', 'f')
+        and pg_table_is_visible(c.oid)
+        """, [sorted(tables)])
+        return dict([(r[0], [int(x) for x in (r[1:3] if r[0] in derived else r[1:])])
+                     for r in cur.fetchall()])
+    finally:
+        cur.close()
+
+def sql_hash(sql):
+    return hashlib.sha256(sql.encode('utf-8')).hexdigest()
+
+def read_manifest(filename):
+    if not os.path.exists(filename):
+        return dict()
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+def write_manifest(manifest, filename):
+    path = os.path.dirname(filename)
+    if path != '' and not os.path.exists(path):
+        os.makedirs(path)
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+def stale_scripts(scripts, sql, dag, manifest, fingerprints):
+    # return the scripts which must be run: those which are new, whose text changed,
+    # or whose tables changed since they were run, and everything downstream of them
+    stale = list()
+    for s in scripts:
+        created, read = script_tables(sql[s])
+        entry = manifest.get(s)
+        if entry is None or entry['sql'] != sql_hash(sql[s]) \
+                or any([d in stale for d in dag[s]]):
+            stale.append(s)
+            continue
+
+        # created tables must exist, e.g. they are not dropped by an upstream cascade
+        tables = entry['tables']
+        if any([t not in fingerprints for t in created]) \
+                or any([fingerprints.get(t) != tables.get(t) for t in created | read]):
+            stale.append(s)
+    return stale
+
+def run_incremental_build(pool, filename=os.path.join('query', 'make-tables.sql'),
+                          manifest_file=os.path.join('data', 'make-tables-manifest.json'),
+                          n_jobs=4, verbose=True, force=False, provision=True, log=None):
+    # as run_build, but only run the scripts whose inputs have changed since the last
+    # build (see stale_scripts), recording the state of each script in manifest_file
+    # force - run every script, and rewrite the manifest
+    scripts, sql, dag = load_build(filename)
+    manifest = dict() if force else read_manifest(manifest_file)
+
+    tables = dict([(s, script_tables(sql[s])) for s in scripts])
+    all_tables = set()
+    derived = set()
+    for created, read in tables.values():
+        all_tables |= created | read
+        derived |= created
+
+    with pool.session() as ses:
+        fingerprints = table_fingerprints(ses.con, all_tables, derived)
+    stale = stale_scripts(scripts, sql, dag, manifest, fingerprints)
+
+    if verbose:
+        for s in scripts:
+            if s not in stale:
+                print('Skipping {} ... up to date.'.format(s))
+
+    def record(s, t):
+        created, read = tables[s]
+        with pool.session() as ses:
+            fp = table_fingerprints(ses.con, created | read, derived)
+        manifest[s] = {'sql': sql_hash(sql[s]), 'tables': fp, 'seconds': t}
+        write_manifest(manifest, manifest_file)
+
+    return run_build(pool, filename, n_jobs=n_jobs, verbose=verbose, only=set(stale),
+                     callback=record, provision=provision, log=log)
@@ -0,0 +1,166 @@
+# on-disk cache of query results
+# results are stored under data/cache, in files named by a hash of the query text
+# and parameters, followed by a hash of a fingerprint of the database:
+#   <sha256(query, params)>-<sha256(fingerprint)>.parquet
+# a change to the query, its parameters, or the data in the database gives a new file
+# the least recently used files are removed once the cache exceeds max_bytes
+#
+#   cache = QueryCache('data/cache')
+#   df = cache.read_sql(con, 'select * from sepsis3 where excluded = 0')
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from . import db
+from .duckdb_backend import DuckDBBackend
+
+# a cheap summary of the database contents: rows inserted, updated or deleted change
+# the total number of modified tuples, and tables which are recreated, rewritten,
+# truncated or refreshed change their oid and relfilenode (as build.table_fingerprints),
+# e.g. a derived table rebuilt with drop/create table as and the same number of rows
+FINGERPRINT_QUERY = """
+select current_database(), current_setting('server_version_num')
+, current_setting('search_path')
+, (select count(*) from pg_stat_user_tables where schemaname not like 'pg_temp%')
+, (select coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) from pg_stat_user_tables
+   where schemaname not like 'pg_temp%')
+, (select md5(coalesce(string_agg(c.oid || ':' || c.relfilenode, ',' order by c.oid), ''))
+   from pg_class c
+   inner join pg_namespace n on n.oid = c.relnamespace
+   where c.relkind in ('r', 'm', 'p')
+   and n.nspname not in ('pg_catalog', 'information_schema')
+   and n.nspname not like 'pg_temp%' and n.nspname not like 'pg_toast%')
+"""
+
+def sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def remove(fn):
+    # remove a file, unless another process has removed it first
+    try:
+        os.remove(fn)
+    except FileNotFoundError:
+        pass
+
+class QueryCache(object):
+    # fmt - 'parquet' or 'feather' (both are written with pyarrow)
+    # fingerprint - if given, this string is used in place of querying the database
+    #   for its fingerprint, so that cached results are read without a connection
+    def __init__(self, path=os.path.join('data', 'cache'), max_bytes=2*1024**3,
+                 fmt='parquet', fingerprint=None):
+        if fmt not in ('parquet', 'feather'):
+            raise ValueError('Unrecognized format {} - use parquet or feather'.format(fmt))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fmt = fmt
+        self.fingerprint = fingerprint
+
+    def query_key(self, query, params=None):
+        return sha256(json.dumps([query, params], sort_keys=True, default=str))
+
+    def db_fingerprint(self, con):
+        # con is a connection, a db.ConnectionPool or a DuckDBBackend
+        if self.fingerprint is not None:
+            return self.fingerprint
+        if isinstance(con, DuckDBBackend):
+            return con.fingerprint()
+        if isinstance(con, db.ConnectionPool):
+            with con.session() as s:
+                return self.db_fingerprint(s.con)
+        cur = con.cursor()
+        try:
+            cur.execute(FINGERPRINT_QUERY)
+            return json.dumps(cur.fetchone(), default=str)
+        finally:
+            cur.close()
+
+    def filename(self, con, query, params=None):
+        return os.path.join(self.path, self.query_key(query, params) + '-'
+                            + sha256(self.db_fingerprint(con)) + '.' + self.fmt)
+
+    def fetch(self, con, query, params=None, compute=None):
+        # return the cached result of a query, calling compute() to create it if needed
+        # by default compute runs the query on con - a different function can be given
+        # if the result is obtained another way, e.g. in parallel partitions
+        fn = self.filename(con, query, params)
+        try:
+            # update the modification time, which orders files for eviction
+            os.utime(fn, None)
+            if self.fmt == 'parquet':
+                return pd.read_parquet(fn)
+            return pd.read_feather(fn)
+        except FileNotFoundError:
+            # not cached, or removed by another process since
+            pass
+
+        if compute is None:
+            compute = lambda: read_sql(con, query, params)
+        df = compute()
+
+        os.makedirs(self.path, exist_ok=True)
+        # results for earlier versions of the database are no longer needed
+        self.invalidate(query, params)
+        # each writer has its own temporary file, which is renamed into place, so that
+        # processes caching the same result at once do not write to the same file
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        os.close(fd)
+        try:
+            if self.fmt == 'parquet':
+                df.to_parquet(tmp, index=False)
+            else:
+                df.reset_index(drop=True).to_feather(tmp)
+            os.replace(tmp, fn)
+        finally:
+            remove(tmp)
+
+        self.evict()
+        return df
+
+    def read_sql(self, con, query, params=None):
+        return self.fetch(con, query, params)
+
+    def files(self):
+        return glob.glob(os.path.join(self.path, '*.' + self.fmt))
+
+    def invalidate(self, query=None, params=None):
+        # remove the cached results of a query, or of every query if none is given
+        # returns the number of files removed
+        if query is None:
+            files = self.files()
+        else:
+            files = glob.glob(os.path.join(self.path, self.query_key(query, params)
+                                           + '-*.' + self.fmt))
+        for fn in files:
+            remove(fn)
+        return len(files)
+
+    def evict(self):
+        # remove the least recently used files until the cache is below max_bytes
+        # files removed by another process while this runs are skipped
+        files = list()
+        for fn in self.files():
+            try:
+                files.append((os.path.getmtime(fn), os.path.getsize(fn), fn))
+            except FileNotFoundError:
+                pass
+        files.sort()
+        total = sum([f[1] for f in files])
+        for mtime, size, fn in files:
+            if total <= self.max_bytes:
+                break
+            remove(fn)
+            total -= size
+
+def read_sql(con, query, params=None):
+    # run a query on a connection, a db.ConnectionPool or a DuckDBBackend
+    if isinstance(con, DuckDBBackend):
+        return con.read_sql(query, params)
+    if isinstance(con, db.ConnectionPool):
+        with con.session() as s:
+            return s.read_sql(query, params)
+    return pd.read_sql_query(query, con, params=params)
@@ -0,0 +1,171 @@
+# database sessions for extracting data from MIMIC
+# a ConnectionPool holds open connections with the search_path already set, so that
+# repeated or parallel queries do not pay for connecting and configuring a session
+#
+#   pool = ConnectionPool(dbname='mimic', user='postgres', maxconn=8)
+#   with pool.session() as s:
+#       df = s.read_sql('select * from sepsis3')
+#       df = s.read_prepared('select * from icustays where icustay_id = %(icustay_id)s',
+#                            {'icustay_id': 200001})
+#   with pool.session() as s, s.transaction() as con:
+#       cur = con.cursor()
+#       cur.execute('create table ...')
+
+import hashlib
+import re
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+class Session(object):
+    # a pooled connection, along with the statements which have been prepared on it
+    # connections are in autocommit mode, except within transaction()
+    def __init__(self, con):
+        self.con = con
+        self.prepared = dict()
+        self.pending = dict()
+
+    def cursor(self, *args, **kwargs):
+        return self.con.cursor(*args, **kwargs)
+
+    def read_sql(self, query, params=None):
+        # run a query and return the result as a dataframe
+        return pd.read_sql_query(query, self.con, params=params)
+
+    def prepare(self, query, name=None):
+        # prepare a query with psycopg2 style named parameters, e.g. %(icustay_id)s
+        # the statement is prepared once per connection, and is named by a hash of the
+        # query unless a name is given
+        # returns the name of the statement
+        if name is None:
+            name = 'stmt_' + hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+        if name in self.prepared or name in self.pending:
+            return name
+
+        # convert the named parameters to positional parameters ($1, $2, ...)
+        param_names = list()
+        def to_positional(m):
+            if m.group(0) == '%%':
+                return '%'
+            if m.group(1) not in param_names:
+                param_names.append(m.group(1))
+            return '$' + str(param_names.index(m.group(1)) + 1)
+        query_pg = re.sub(r'%%|%\((\w+)\)s', to_positional, query.strip().rstrip(';'))
+
+        cur = self.con.cursor()
+        try:
+            cur.execute('PREPARE ' + name + ' AS ' + query_pg)
+        finally:
+            cur.close()
+
+        # statements prepared within a transaction are lost if it is rolled back
+        if self.con.autocommit:
+            self.prepared[name] = param_names
+        else:
+            self.pending[name] = param_names
+        return name
+
+    def execute_prepared(self, query, params=None, name=None):
+        # execute a query as a prepared statement, preparing it on first use
+        # returns a cursor with the results
+        name = self.prepare(query, name=name)
+        param_names = self.prepared.get(name, self.pending.get(name))
+        if params is None:
+            params = dict()
+        cur = self.con.cursor()
+        if len(param_names) == 0:
+            cur.execute('EXECUTE ' + name)
+        else:
+            cur.execute('EXECUTE ' + name + ' (' + ', '.join(['%s']*len(param_names)) + ')',
+                        [params[p] for p in param_names])
+        return cur
+
+    def read_prepared(self, query, params=None, name=None):
+        # as read_sql, but execute the query as a prepared statement
+        cur = self.execute_prepared(query, params=params, name=name)
+        try:
+            columns = [c[0] for c in cur.description]
+            return pd.DataFrame.from_records(cur.fetchall(), columns=columns)
+        finally:
+            cur.close()
+
+    def table_exists(self, table_name):
+        # check if a table or view is visible on the search_path
+        cur = self.con.cursor()
+        try:
+            cur.execute('select to_regclass(%s) is not null', [table_name])
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    @contextmanager
+    def transaction(self):
+        # run statements in a single transaction, which is committed on success
+        # and rolled back if an exception is raised - yields the connection
+        # this is also needed for named (server-side) cursors, e.g. read_sql_chunks
+        self.con.autocommit = False
+        try:
+            yield self.con
+            self.con.commit()
+            self.prepared.update(self.pending)
+        except:
+            self.con.rollback()
+            raise
+        finally:
+            self.pending = dict()
+            self.con.autocommit = True
+
+class ConnectionPool(object):
+    # a thread-safe pool of connections with the search_path preset
+    # session() blocks until a connection is free, rather than failing when all
+    # maxconn connections are in use
+    def __init__(self, dbname='mimic', user='postgres', schema_name='mimiciii',
+                 minconn=1, maxconn=8, **kwargs):
+        # the derived tables are created on public, and read from schema_name
+        options = '-c search_path=public,' + schema_name
+        if 'options' in kwargs:
+            options = kwargs.pop('options') + ' ' + options
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dbname=dbname,
+                                                         user=user, options=options, **kwargs)
+        self.available = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.sessions = dict()
+
+    @contextmanager
+    def session(self):
+        # borrow a connection from the pool - yields a Session
+        self.available.acquire()
+        try:
+            con = self.pool.getconn()
+            with self.lock:
+                if id(con) not in self.sessions:
+                    con.autocommit = True
+                    self.sessions[id(con)] = Session(con)
+                s = self.sessions[id(con)]
+            try:
+                yield s
+            finally:
+                if con.closed:
+                    with self.lock:
+                        del self.sessions[id(con)]
+                elif con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    con.rollback()
+                    s.pending = dict()
+                self.pool.putconn(con, close=bool(con.closed))
+        finally:
+            self.available.release()
+
+    def closeall(self):
+        with self.lock:
+            self.sessions = dict()
+        self.pool.closeall()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closeall()
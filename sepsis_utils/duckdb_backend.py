@@ -0,0 +1,124 @@
+# run the extraction on DuckDB, reading local Parquet copies of the MIMIC-III tables
+# the parquet folder has one file (or folder of files) per table, named as the table,
+# e.g. icustays.parquet, chartevents/*.parquet - these are views on the mimiciii schema
+# and the derived tables are created on the main schema, as public is used in postgres
+#
+#   backend = DuckDBBackend('data/mimic-parquet')
+#   backend.run_build('query/make-tables.sql', only=['query/tbls/abx-poe-list.sql', ...])
+#   df = sepsis_extract_data.get_scores_at_time(backend, T=3)
+#
+# the postgres SQL is translated (see translate) rather than rewritten, so the same
+# scripts and queries are used for both databases
+
+import glob
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+from . import build
+from . import instrument
+
+def translate(sql):
+    # translate postgres SQL to DuckDB SQL
+    # interval '3' hour -> interval 3 hour (older versions of DuckDB need the number)
+    sql = re.sub(r"\binterval\s+'(\d+(?:\.\d+)?)'\s+(second|minute|hour|day|week|month|year)s?\b",
+                 r'interval \1 \2', sql, flags=re.IGNORECASE)
+    # there are no materialized views - tables are used instead
+    sql = re.sub(r'\bmaterialized\s+view\b', 'table', sql, flags=re.IGNORECASE)
+    # the search_path is set on the connection
+    sql = re.sub(r'\bset\s+search_path\s+to\s+[^;]*;', '', sql, flags=re.IGNORECASE)
+    # statements are committed as they run, so there is no transaction to commit
+    sql = re.sub(r'^\s*commit\s*;', '', sql, flags=re.IGNORECASE | re.MULTILINE)
+    return sql
+
+def translate_params(query, params=None):
+    # psycopg2 named parameters, %(name)s, are DuckDB named parameters, $name
+    if params is None:
+        return query, None
+    query = re.sub(r'%%|%\((\w+)\)s',
+                   lambda m: '%' if m.group(0) == '%%' else '$' + m.group(1), query)
+    return query, dict(params)
+
+class DuckDBBackend(object):
+    # parquet_path - folder with the MIMIC-III tables as parquet
+    # database - a DuckDB database file, or ':memory:'
+    def __init__(self, parquet_path, database=':memory:', schema_name='mimiciii', threads=None):
+        import duckdb
+
+        self.con = duckdb.connect(database)
+        self.schema_name = schema_name
+        if threads is not None:
+            self.con.execute('SET threads = ' + str(int(threads)))
+        # integer division truncates, and unquoted identifiers are lower case, as in postgres
+        self.con.execute('SET integer_division = true')
+        self.con.execute('SET preserve_identifier_case = false')
+        self.con.execute('create schema if not exists ' + schema_name)
+        self.tables = self.register_parquet(parquet_path)
+        self.con.execute("SET search_path = 'main," + schema_name + "'")
+
+    def register_parquet(self, parquet_path):
+        # create a view on the schema for each table in the parquet folder
+        # returns a dictionary mapping each table to its files
+        tables = OrderedDict()
+        for fn in sorted(os.listdir(parquet_path)):
+            full = os.path.join(parquet_path, fn)
+            if fn.endswith('.parquet') and os.path.isfile(full):
+                tables[fn[:-len('.parquet')].lower()] = [full]
+            elif os.path.isdir(full):
+                files = sorted(glob.glob(os.path.join(full, '*.parquet')))
+                if len(files) > 0:
+                    tables[fn.lower()] = files
+
+        for t, files in tables.items():
+            self.con.execute('create or replace view ' + self.schema_name + '.' + t
+                             + ' as select * from read_parquet(['
+                             + ', '.join(["'" + f.replace("'", "''") + "'" for f in files])
+                             + '])')
+        return tables
+
+    def fingerprint(self):
+        # a fingerprint of the parquet files and the derived tables, for cache.QueryCache
+        files = [(f, os.path.getsize(f), os.path.getmtime(f))
+                 for t in self.tables for f in self.tables[t]]
+        derived = self.con.execute("""
+        select table_name, estimated_size, column_count from duckdb_tables()
+        where schema_name = 'main' order by table_name
+        """).fetchall()
+        return json.dumps([files, derived], default=str)
+
+    def execute(self, sql):
+        # run each statement of a script
+        for statement in instrument.split_statements(translate(sql)):
+            self.con.execute(statement)
+
+    def read_sql(self, query, params=None):
+        # run a query and return the result as a dataframe
+        query, params = translate_params(query, params)
+        return self.con.execute(translate(query), params).df()
+
+    def run_build(self, filename=os.path.join('query', 'make-tables.sql'), only=None,
+                  verbose=True):
+        # run the scripts of a psql script in order, as build.run_build does for postgres
+        # DuckDB parallelizes each query, so the scripts are run one at a time
+        # only - run only these scripts, e.g. those whose source tables are available
+        # returns an OrderedDict with the wall time (seconds) of each script
+        scripts = build.parse_make_tables(filename)
+        if only is not None:
+            only = set([os.path.normpath(s) for s in only])
+            scripts = [s for s in scripts if s in only]
+
+        timings = OrderedDict()
+        for s in scripts:
+            with open(s, 'r') as fp:
+                sql = fp.read()
+            t0 = time.time()
+            self.execute(sql)
+            timings[s] = time.time() - t0
+            if verbose:
+                print('Running {} ... done ({:0.1f}s).'.format(s, timings[s]))
+        return timings
+
+    def close(self):
+        self.con.close()
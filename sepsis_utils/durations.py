@@ -0,0 +1,233 @@
+# durations of mechanical ventilation and vasopressor therapy, without window functions
+# ventilation_episodes follows the ventsettings, vd1, vd2 and vd CTEs formerly in
+# get_scores_at_time (the ventdurations table), and vasopressor_durations follows
+# query/tbls/vaso-dur.sql
+#
+#   vd = get_ventilation_durations(con)
+#   vasodur = get_vasopressor_durations(con)
+#
+# the SQL makes several passes of LAG and SUM over every charted row - here the rows are
+# sorted once by stay and time, and each window function is a comparison with the
+# previous row or a cumulative sum restarted at each partition
+
+import numpy as np
+import pandas as pd
+
+from . import sepsis_extract_data as se
+
+VENT_ITEMS = [
+    445, 448, 449, 450, 1340, 1486, 1600, 224687,  # minute volume
+    639, 654, 681, 682, 683, 684, 224685, 224684, 224686,  # tidal volume
+    218, 436, 535, 444, 459, 224697, 224695, 224696, 224746, 224747,  # RespPressure
+    221, 1, 1211, 1655, 2000, 226873, 224738, 224419, 224750, 227187,  # Insp pressure
+    543,  # PlateauPressure
+    5865, 5866, 224707, 224709, 224705, 224706,  # APRV pressure
+    60, 437, 505, 506, 686, 220339, 224700,  # PEEP
+    3459,  # high pressure relief
+    501, 502, 503, 224702,  # PCV
+    223, 667, 668, 669, 670, 671, 672,  # TCPCV
+    157, 158, 1852, 3398, 3399, 3400, 3401, 3402, 3403, 3404, 8382, 227809, 227810,  # ETT
+    224701,  # PSVlevel
+]
+VASO_CV_ITEMS = [30047, 30120, 30044, 30119, 30309, 30127, 30128, 30051, 30043, 30307, 30125]
+VASO_MV_ITEMS = [221906, 221289, 221749, 222315, 221662]
+
+def partition_starts(*keys):
+    # True for the first row of each partition, for arrays sorted by the keys
+    n = len(keys[0])
+    starts = np.ones(n, dtype=bool)
+    if n > 1:
+        changed = np.zeros(n - 1, dtype=bool)
+        for k in keys:
+            k = np.asarray(k)
+            changed |= k[1:] != k[:-1]
+        starts[1:] = changed
+    return starts
+
+def lag(values, starts, fill=np.nan):
+    # the value of the previous row in the partition, or fill for its first row
+    values = np.asarray(values)
+    out = np.empty_like(values, dtype=np.result_type(values, np.asarray(fill)))
+    out[1:] = values[:-1]
+    out[starts] = fill
+    return out
+
+def cumsum_by(values, starts):
+    # cumulative sum of values, restarted at the first row of each partition
+    total = np.cumsum(values)
+    offset = (total - values)[starts]
+    return total - np.repeat(offset, np.diff(np.append(np.flatnonzero(starts), len(values))))
+
+def first_by(values, starts):
+    # the value of the first row of the partition
+    first = np.maximum.accumulate(np.where(starts, np.arange(len(values)), 0))
+    return np.asarray(values)[first]
+
+def ventilation_episodes(icustay_id, charttime, mechvent, extubated, gap=8):
+    # number the ventilation episodes of each ICU stay, as the vd CTE
+    # the arrays must be sorted by icustay_id and charttime, with one row per charttime
+    # a MechVent row starts a new episode unless the previous MechVent row is within gap
+    # hours, and the row after an extubation always starts a new episode
+    # returns a dataframe with icustay_id, ventnum, starttime and endtime
+    icustay_id = np.asarray(icustay_id)
+    charttime = pd.to_datetime(pd.Series(charttime)).values
+    mechvent = np.asarray(mechvent) == 1
+    extubated = np.asarray(extubated) == 1
+
+    # vd2 only keeps rows with ventilator settings or extubation flags
+    keep = mechvent | extubated
+    icustay_id, charttime = icustay_id[keep], charttime[keep]
+    mechvent, extubated = mechvent[keep], extubated[keep]
+    starts = partition_starts(icustay_id)
+
+    # the previous charttime with MechVent = 1 (partition by icustay_id, MechVent)
+    mv = np.flatnonzero(mechvent)
+    close = np.zeros(len(charttime), dtype=bool)
+    prevtime = lag(charttime[mv], partition_starts(icustay_id[mv]), np.datetime64('NaT'))
+    close[mv] = charttime[mv] - prevtime <= np.timedelta64(gap, 'h')
+
+    prev_extubated = lag(extubated, starts, False)
+    newvent = np.where(extubated, 0, np.where(prev_extubated, 1, np.where(close, 0, 1)))
+    ventnum = cumsum_by(newvent, starts)
+
+    # ventnum never decreases within a stay, so each episode is a run of rows
+    first = np.flatnonzero(partition_starts(icustay_id, ventnum))
+    last = np.append(first[1:], len(ventnum)) - 1
+    return pd.DataFrame({'icustay_id': icustay_id[first], 'ventnum': ventnum[first],
+                         'starttime': charttime[first], 'endtime': charttime[last]})
+
+def get_ventilation_settings(con):
+    # one row per icustay_id and charttime with the MechVent and Extubated flags, as the
+    # ventsettings CTE - only the aggregation is done in the database
+    items = ', '.join([str(i) for i in VENT_ITEMS])
+    return se.read_sql(con, """
+    select
+      icustay_id, charttime
+      , max(
+        case
+          when itemid = 720 and value != 'Other/Remarks' then 1
+          when itemid = 467 and value = 'Ventilator' then 1
+          when itemid = 648 and value = 'Intubated/trach' then 1
+          when itemid in (""" + items + """) then 1
+          else 0
+        end
+        ) as mechvent
+      , max(
+        case
+          when itemid = 640 and value = 'Extubated' then 1
+          when itemid = 640 and value = 'Self Extubation' then 1
+          else 0
+        end
+        ) as extubated
+      , max(case when itemid = 640 and value = 'Self Extubation' then 1 else 0 end)
+        as selfextubated
+    from chartevents
+    where value is not null
+    and icustay_id is not null
+    and itemid in (640, 648, 720, 467, """ + items + """)
+    group by icustay_id, charttime
+    order by icustay_id, charttime
+    """, name='ventilation_settings')
+
+def get_ventilation_durations(con):
+    # the ventdurations table: icustay_id, ventnum, starttime, endtime
+    vs = get_ventilation_settings(con)
+    vs = vs.sort_values(['icustay_id', 'charttime'], kind='mergesort')
+    return ventilation_episodes(vs['icustay_id'].values, vs['charttime'].values,
+                                vs['mechvent'].values, vs['extubated'].values)
+
+def merge_intervals(icustay_id, starttime, endtime):
+    # the union of the intervals of each ICU stay, as the vasocv_grp and vasomv_grp CTEs,
+    # numbered in order of starttime - intervals which touch are merged
+    # returns a dataframe with icustay_id, vasonum, starttime and endtime
+    df = pd.DataFrame({'icustay_id': np.asarray(icustay_id),
+                       'starttime': pd.to_datetime(pd.Series(starttime)).values,
+                       'endtime': pd.to_datetime(pd.Series(endtime)).values})
+    df = df.sort_values(['icustay_id', 'starttime'], kind='mergesort').reset_index(drop=True)
+    starts = partition_starts(df['icustay_id'].values)
+
+    # an interval starts a new group if it begins after every earlier interval has ended
+    reach = df.groupby('icustay_id', sort=False)['endtime'].cummax().values
+    new = starts | (df['starttime'].values > lag(reach, starts, np.datetime64('NaT')))
+    group = np.cumsum(new)
+    res = df.groupby(group, sort=False).agg({'icustay_id': 'first', 'starttime': 'first',
+                                             'endtime': 'max'}).reset_index(drop=True)
+    res = res[['icustay_id', 'starttime', 'endtime']]
+    res.insert(1, 'vasonum', cumsum_by(np.ones(len(res), dtype=int),
+                                       partition_starts(res['icustay_id'].values)))
+    return res
+
+def vasopressor_intervals_cv(io_cv):
+    # the vasocv CTE: one row per continuous administration of a vasopressor, from
+    # inputevents_cv rows with icustay_id, charttime, itemid, stopped, rate and amount
+    io = io_cv.loc[io_cv['icustay_id'].notnull()]
+    io = io.assign(vaso_stopped=io['stopped'].isin(['Stopped', "D/C'd"]).astype(int),
+                   vaso_null=io['rate'].notnull().astype(int))
+    v = io.groupby(['icustay_id', 'itemid', 'charttime'], sort=True).agg(
+        {'vaso_stopped': 'max', 'vaso_null': 'max', 'rate': 'max'}).reset_index()
+    v = v.rename(columns={'rate': 'vaso_rate'})
+
+    t = v['charttime'].values
+    rate = v['vaso_rate'].values.astype(float)
+    stopped = v['vaso_stopped'].values
+    has_rate = v['vaso_null'].values == 1
+    starts = partition_starts(v['icustay_id'].values, v['itemid'].values)
+
+    # vasocv2 and vasocv3: a partition starts at each row with a rate, and the rate of a
+    # row without one is carried forward from it
+    prevrate = first_by(rate, starts | has_rate)
+    lag_prevrate = lag(prevrate, starts)
+
+    # vasocv4: flag the start of each administration (NaN is null)
+    first_rate = has_rate & (cumsum_by(has_rate.astype(int), starts) == 1)
+    vaso_start = np.select(
+        [(rate > 0) & first_rate, (rate == 0) & (lag_prevrate == 0),
+         (prevrate == 0) & (lag_prevrate == 0), lag_prevrate == 0,
+         lag(stopped, starts, 0) == 1],
+        [1, 0, 0, 1, 1], np.nan)
+
+    # vasocv5 and vasocv6: number the administrations, and flag the rows which end one
+    seen = cumsum_by((~np.isnan(vaso_start)).astype(int), starts) > 0
+    vaso_first = np.where(seen, cumsum_by(np.nan_to_num(vaso_start), starts), np.nan)
+    last = np.append(starts[1:], True)
+    is_stop = (stopped == 1) | (rate == 0) | last
+
+    v = v.assign(vaso_first=vaso_first,
+                 ratetime=np.where(has_rate, t, np.datetime64('NaT')),
+                 stoptime=np.where(is_stop & seen, t, np.datetime64('NaT')))
+    v = v.loc[v['vaso_first'].notnull() & (v['vaso_first'] != 0)]
+    g = v.groupby(['icustay_id', 'itemid', 'vaso_first'], sort=True).agg(
+        {'ratetime': 'min', 'stoptime': 'min', 'charttime': 'min', 'vaso_rate': 'max'})
+    g = g.reset_index().rename(columns={'ratetime': 'starttime', 'stoptime': 'endtime',
+                                        'charttime': 'firsttime', 'vaso_rate': 'maxrate'})
+    g = g.loc[g['endtime'].notnull() & (g['firsttime'] != g['endtime']) & (g['maxrate'] > 0)]
+    return g[['icustay_id', 'itemid', 'starttime', 'endtime']].reset_index(drop=True)
+
+def vasopressor_durations(io_cv, io_mv):
+    # the vasodur table: icustay_id, vasonum, starttime, endtime
+    # io_cv - inputevents_cv rows of the vasopressors (see vasopressor_intervals_cv)
+    # io_mv - inputevents_mv rows of the vasopressors, with icustay_id, linkorderid,
+    #         starttime and endtime, excluding rewritten orders
+    cv = vasopressor_intervals_cv(io_cv)
+    mv = io_mv.loc[io_mv['icustay_id'].notnull()]
+    mv = mv.groupby(['icustay_id', 'linkorderid']).agg({'starttime': 'min',
+                                                        'endtime': 'max'}).reset_index()
+    res = pd.concat([merge_intervals(cv['icustay_id'], cv['starttime'], cv['endtime']),
+                     merge_intervals(mv['icustay_id'], mv['starttime'], mv['endtime'])],
+                    ignore_index=True).drop_duplicates()
+    return res.sort_values(['icustay_id', 'vasonum'], kind='mergesort').reset_index(drop=True)
+
+def get_vasopressor_durations(con):
+    # the vasodur table, read from inputevents_cv and inputevents_mv
+    io_cv = se.read_sql(con, """
+    select icustay_id, charttime, itemid, stopped, rate, amount
+    from inputevents_cv
+    where itemid in (""" + ', '.join([str(i) for i in VASO_CV_ITEMS]) + """)
+    """, name='vasopressor_cv')
+    io_mv = se.read_sql(con, """
+    select icustay_id, linkorderid, starttime, endtime
+    from inputevents_mv
+    where itemid in (""" + ', '.join([str(i) for i in VASO_MV_ITEMS]) + """)
+    and statusdescription != 'Rewritten'
+    """, name='vasopressor_mv')
+    return vasopressor_durations(io_cv, io_mv)
@@ -0,0 +1,252 @@
+# instrumentation of queries and build scripts
+# each query is run with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON), and a record of its
+# plan, wall time, rows and bytes is appended to a JSON lines log
+# timing_report and cte_report summarize the log, comparing the latest run of each
+# query with the previous run, so that a slower definition is easy to spot
+#
+#   log = QueryLog('data/query-log.jsonl')
+#   df = get_scores_at_time(con, T=3, log=log)
+#   print(timing_report(log.read()))
+#   print(cte_report(log.read(), 'get_scores_at_time'))
+
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+class QueryLog(object):
+    # an append only log of query records, one JSON object per line
+    # writes are serialized, so the log can be shared by concurrent queries
+    def __init__(self, filename=os.path.join('data', 'query-log.jsonl')):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            path = os.path.dirname(self.filename)
+            if path != '' and not os.path.exists(path):
+                os.makedirs(path)
+            with open(self.filename, 'a') as fp:
+                fp.write(json.dumps(record, default=str) + '\n')
+
+    def read(self):
+        if not os.path.exists(self.filename):
+            return list()
+        with open(self.filename, 'r') as fp:
+            return [json.loads(line) for line in fp if line.strip() != '']
+
+def split_statements(sql):
+    # split a script on semicolons which are not in comments or quotes
+    statements = list()
+    tokens = re.finditer(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|;",
+                         sql, flags=re.DOTALL)
+    start = 0
+    for m in tokens:
+        if m.group(0) == ';':
+            statements.append(sql[start:m.start()])
+            start = m.end()
+    statements.append(sql[start:])
+    # drop statements which are only whitespace and comments
+    return [s.strip() for s in statements
+            if re.sub(r'--[^\n]*|/\*.*?\*/|\s', '', s, flags=re.DOTALL) != '']
+
+# statements which EXPLAIN ANALYZE can run, i.e. those which return or write rows
+EXPLAINABLE = re.compile(r'^\s*(select|with|values|insert|update|delete|'
+                         r'create\s+(unlogged\s+|temp\s+|temporary\s+)?table\s+\S+\s+as|'
+                         r'create\s+materialized\s+view\s+\S+\s+as)\b', flags=re.IGNORECASE)
+
+def strip_leading_comments(sql):
+    return re.sub(r'^(\s*(--[^\n]*|/\*.*?\*/))*\s*', '', sql, flags=re.DOTALL)
+
+def explain_analyze(cur, query, params=None):
+    # run a statement with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON), returning the plan
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    plan = cur.fetchone()[0]
+    if not isinstance(plan, (list, dict)):
+        plan = json.loads(plan)
+    if isinstance(plan, list):
+        plan = plan[0]
+    return plan
+
+def plan_nodes(node):
+    # iterate over the nodes of a plan, depth first
+    yield node
+    for child in node.get('Plans', list()):
+        for n in plan_nodes(child):
+            yield n
+
+# keywords which can follow a table reference in place of an alias
+NOT_ALIAS = frozenset(['on', 'using', 'where', 'group', 'order', 'left', 'right', 'inner',
+                       'outer', 'full', 'cross', 'join', 'natural', 'union', 'limit', 'having',
+                       'window', 'lateral', 'except', 'intersect'])
+
+def strip_comments(sql):
+    return re.sub(r'--[^\n]*|/\*.*?\*/', ' ', sql, flags=re.DOTALL)
+
+def cte_aliases(query):
+    # map each alias of a CTE reference in a query to the name of the CTE, e.g.
+    # "left join vitals v" maps v to vitals - an alias used for several CTEs maps to
+    # their names joined by |
+    sql = strip_comments(query)
+    names = set([m.lower() for m in re.findall(r'(?:\bwith|,)\s*(\w+)\s+as\s*\(', sql,
+                                                   flags=re.IGNORECASE)])
+    aliases = dict()
+    for m in re.finditer(r'\b(?:from|join)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?', sql,
+                         flags=re.IGNORECASE):
+        cte = m.group(1).lower()
+        if cte not in names:
+            continue
+        alias = m.group(2).lower() if m.group(2) is not None else None
+        if alias is None or alias in NOT_ALIAS:
+            alias = cte
+        aliases.setdefault(alias, set()).add(cte)
+    return dict([(a, '|'.join(sorted(c))) for a, c in aliases.items()])
+
+def cte_timings(plan, query=None):
+    # return the time (ms) of each common table expression in a plan
+    # materialized CTEs are an InitPlan named "CTE <name>", and CTEs which are inlined
+    # (postgres 12+) are a subquery scan labelled only with the alias of the reference,
+    # e.g. "v" for "left join vitals v" - the alias is mapped to the CTE name using the
+    # query text, and subquery scans which are not a CTE (e.g. a subquery in from) are
+    # not reported
+    # times are inclusive, i.e. a CTE which reads another CTE for the first time
+    # includes the time to evaluate it
+    aliases = cte_aliases(query) if query is not None else dict()
+    timings = OrderedDict()
+    for node in plan_nodes(plan['Plan']):
+        name = None
+        if node.get('Subplan Name', '').startswith('CTE '):
+            name = node['Subplan Name'][4:]
+        elif node.get('Node Type') == 'Subquery Scan' and 'Alias' in node:
+            # explain adds a suffix to aliases which are repeated, e.g. v_1
+            alias = node['Alias'].lower()
+            name = aliases.get(alias, aliases.get(re.sub(r'_\d+$', '', alias)))
+        if name is not None:
+            ms = node.get('Actual Total Time', 0) * node.get('Actual Loops', 1)
+            timings[name] = timings.get(name, 0) + ms
+    return timings
+
+def plan_record(plan, query=None):
+    # summarize a plan: the rows and bytes output, execution time and buffers read
+    # query - the text of the query, used to name the CTEs of the plan
+    top = plan['Plan']
+    rows = top.get('Actual Rows', 0) * top.get('Actual Loops', 1)
+    return OrderedDict([
+        ('rows', rows),
+        ('bytes', rows * top.get('Plan Width', 0)),
+        ('planning_ms', plan.get('Planning Time')),
+        ('execution_ms', plan.get('Execution Time')),
+        ('shared_hit_blocks', top.get('Shared Hit Blocks')),
+        ('shared_read_blocks', top.get('Shared Read Blocks')),
+        ('temp_written_blocks', top.get('Temp Written Blocks')),
+        ('ctes', cte_timings(plan, query)),
+    ])
+
+def new_record(name, query, kind):
+    return OrderedDict([
+        ('time', datetime.datetime.now().isoformat()),
+        ('name', name),
+        ('kind', kind),
+        ('query_hash', hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]),
+    ])
+
+def read_sql(con, query, params=None, name='query', log=None, explain=True):
+    # run a query and return the result as a dataframe, logging a record of the run
+    # if explain is True, the query is first run with EXPLAIN ANALYZE to capture its
+    # plan - this runs the query twice, and the timed run benefits from a warm cache
+    record = new_record(name, query, 'query')
+    cur = con.cursor()
+    try:
+        if explain:
+            plan = explain_analyze(cur, query, params)
+            record.update(plan_record(plan, query))
+            record['plan'] = plan
+
+        t0 = time.time()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        columns = [c[0] for c in cur.description]
+        record['seconds'] = time.time() - t0
+    finally:
+        cur.close()
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    record['rows'] = df.shape[0]
+    record['result_bytes'] = int(df.memory_usage(deep=True).sum())
+    if log is not None:
+        log.write(record)
+    return df
+
+def run_script(con, sql, name='script', log=None):
+    # run each statement of a script, using EXPLAIN ANALYZE where possible so that the
+    # plan of statements such as CREATE TABLE ... AS is captured
+    # a record is logged for each statement and for the script as a whole
+    # returns the wall time of the script in seconds
+    cur = con.cursor()
+    t_script = time.time()
+    try:
+        for i, statement in enumerate(split_statements(sql)):
+            record = new_record(name + ':' + str(i+1), statement, 'statement')
+            record['script'] = name
+            record['statement'] = strip_leading_comments(statement)[:80]
+            t0 = time.time()
+            if EXPLAINABLE.match(strip_leading_comments(statement)):
+                plan = explain_analyze(cur, statement)
+                record.update(plan_record(plan, statement))
+                record['plan'] = plan
+            else:
+                cur.execute(statement)
+            record['seconds'] = time.time() - t0
+            if log is not None:
+                log.write(record)
+    finally:
+        cur.close()
+
+    t = time.time() - t_script
+    if log is not None:
+        record = new_record(name, sql, 'script')
+        record['seconds'] = t
+        log.write(record)
+    return t
+
+def timing_report(records, kind=None):
+    # return a dataframe with the latest and previous wall time of each query/script
+    # changed is True if the text of the query changed between the two runs
+    if kind is not None:
+        records = [r for r in records if r['kind'] == kind]
+    latest, previous = OrderedDict(), dict()
+    for r in records:
+        if r['name'] in latest:
+            previous[r['name']] = latest[r['name']]
+        latest[r['name']] = r
+
+    report = list()
+    for name, r in latest.items():
+        p = previous.get(name, dict())
+        report.append(OrderedDict([
+            ('name', name), ('kind', r['kind']), ('seconds', r.get('seconds')),
+            ('previous_seconds', p.get('seconds')), ('rows', r.get('rows')),
+            ('bytes', r.get('bytes')),
+            ('changed', None if len(p) == 0 else p['query_hash'] != r['query_hash'])]))
+    df = pd.DataFrame(report, columns=['name', 'kind', 'seconds', 'previous_seconds',
+                                       'rows', 'bytes', 'changed'])
+    df['ratio'] = df['seconds'].astype(float) / df['previous_seconds'].astype(float)
+    return df
+
+def cte_report(records, name):
+    # return a dataframe with the latest and previous time (ms) of each CTE of a query
+    records = [r for r in records if r['name'] == name and 'ctes' in r]
+    if len(records) == 0:
+        return pd.DataFrame(columns=['cte', 'ms', 'previous_ms', 'ratio'])
+    latest = records[-1]['ctes']
+    previous = records[-2]['ctes'] if len(records) > 1 else dict()
+    df = pd.DataFrame([(c, latest[c], previous.get(c)) for c in latest],
+                      columns=['cte', 'ms', 'previous_ms'])
+    df['ratio'] = df['ms'].astype(float) / df['previous_ms'].astype(float)
+    return df.sort_values('ms', ascending=False).reset_index(drop=True)
@@ -0,0 +1,184 @@
+# multivariable fractional polynomial (MFP) logistic regression
+# this follows the closed test procedure of the R mfp package, which was previously
+# called through a subprocess (see appendix/r-make-sepsis3-models.R)
+#   P Royston and W Sauerbrei, "Multivariable Model-building", Wiley, 2008.
+
+import multiprocessing
+import re
+from collections import OrderedDict
+
+import numpy as np
+import scipy.stats
+import statsmodels.api as sm
+
+# the set of powers for fractional polynomials - a power of 0 is log(x)
+FP_POWERS = [-2, -1, -0.5, 0, 0.5, 1, 2, 3]
+
+def parse_formula(formula):
+    # split an R style formula into the target, the fp() covariates and the linear covariates
+    # e.g. "y ~ fp(age) + is_male" -> ('y', ['age'], ['is_male'])
+    target, covariates = formula.split('~')
+    fp_vars, lin_vars = list(), list()
+    for term in covariates.split('+'):
+        term = term.strip()
+        m = re.match(r'^fp\((.+)\)$', term)
+        if m is not None:
+            fp_vars.append(m.group(1).strip())
+        else:
+            lin_vars.append(term)
+    return target.strip(), fp_vars, lin_vars
+
+def fp_scale(x):
+    # shift and scale for a covariate, as in the R mfp package
+    # the shift makes all values positive, the scale is a power of 10 near the mean
+    shift = 0.0
+    if np.min(x) <= 0:
+        z = np.diff(np.sort(x))
+        shift = np.min(z[z > 0]) - np.min(x)
+        shift = np.ceil(shift*10)/10.0
+    x_range = np.mean(x + shift)
+    scale = 10.0**(np.sign(np.log10(x_range)) * np.round(np.abs(np.log10(x_range))))
+    return shift, scale
+
+def fp_transform(x, powers, shift=0.0, scale=1.0):
+    # return a matrix with one column per power of the fractional polynomial
+    # repeated powers are multiplied by log(x), e.g. (2, 2) is x^2, x^2*log(x)
+    x = (np.asarray(x, dtype=float) + shift) / scale
+    X = list()
+    x_prev = None
+    for i, p in enumerate(powers):
+        if p == 0:
+            x_new = np.log(x)
+        else:
+            x_new = x**p
+        if i > 0 and p == powers[i-1]:
+            x_new = x_prev * np.log(x)
+        X.append(x_new)
+        x_prev = x_new
+    return np.column_stack(X)
+
+def fp_power_sets(degree):
+    # all sets of powers for an FP of the given degree (1 or 2)
+    if degree == 1:
+        return [(p,) for p in FP_POWERS]
+    return [(p, q) for i, p in enumerate(FP_POWERS) for q in FP_POWERS[i:]]
+
+def fp_df(x, df=4):
+    # the degrees of freedom of a covariate, as in the R mfp package (and Stata's mfp):
+    # 1 (linear) with 3 or fewer distinct values, at most 2 (FP1) with 4 or 5, else df
+    n = np.unique(x).size
+    if n <= 3:
+        return 1
+    elif n <= 5:
+        return min(df, 2)
+    return df
+
+def fit_logit(X, y):
+    # fit a logistic regression with an intercept - returns the statsmodels result
+    X = sm.add_constant(X, prepend=True, has_constant='add')
+    return sm.Logit(y, X).fit(disp=0, method='newton', maxiter=100)
+
+def design_matrix(data, powers, transforms, lin_vars):
+    # build the design matrix given the current powers of each fp covariate
+    X = list()
+    for v in powers:
+        if powers[v] is not None:
+            X.append(fp_transform(data[v], powers[v], *transforms[v]))
+    for v in lin_vars:
+        X.append(np.reshape(data[v], [-1, 1]))
+    return np.column_stack(X)
+
+def fit_mfp(df, formula, alpha=0.05, max_cycles=50):
+    # fit a multivariable fractional polynomial logistic regression
+    # df is a dataframe, formula is an R style formula, e.g.
+    #   "hospital_expire_flag ~ fp(age) + fp(elixhauser_hospital) + is_male"
+    # covariates in fp() are always kept in the model (select=1 in R)
+    # their functional form is chosen by the closed test procedure at level alpha:
+    #   FP2 vs linear (3 df) -> if significant, FP2 vs FP1 (2 df)
+    # covariates with few distinct values have fewer degrees of freedom (see fp_df):
+    # with 4 or 5 values FP1 is tested against linear (1 df), and with 3 or fewer the
+    # covariate is linear
+    # the procedure cycles through the covariates until their powers do not change
+    # rows with missing data are excluded, as in R
+    # returns a dictionary with:
+    #   pred - predicted probabilities for the rows used to fit the model
+    #   powers - the selected powers of each fp covariate
+    #   model - the final statsmodels result
+    #   index - the index of the rows of df used to fit the model
+    target, fp_vars, lin_vars = parse_formula(formula)
+
+    df = df[[target] + fp_vars + lin_vars].dropna()
+    y = df[target].values.astype(float)
+    data = dict([(v, df[v].values.astype(float)) for v in fp_vars + lin_vars])
+    transforms = dict([(v, fp_scale(data[v])) for v in fp_vars])
+    dfs = dict([(v, fp_df(data[v])) for v in fp_vars])
+
+    # start with every fp covariate as linear
+    powers = OrderedDict([(v, (1,)) for v in fp_vars])
+
+    # covariates are processed in order of significance in the linear model
+    if len(fp_vars) > 1:
+        mdl = fit_logit(design_matrix(data, powers, transforms, lin_vars), y)
+        pvalues = mdl.pvalues[1:len(fp_vars)+1]
+        powers = OrderedDict([(fp_vars[i], (1,)) for i in np.argsort(pvalues, kind='mergesort')])
+
+    for cycle in range(max_cycles):
+        powers_prev = OrderedDict(powers)
+        for v in powers:
+            if dfs[v] == 1:
+                continue
+            # deviance of the model with covariate v using each set of powers
+            dev = dict()
+            for degree in [1, 2] if dfs[v] > 2 else [1]:
+                for pw in fp_power_sets(degree):
+                    powers_try = OrderedDict(powers)
+                    powers_try[v] = pw
+                    mdl = fit_logit(design_matrix(data, powers_try, transforms, lin_vars), y)
+                    dev[pw] = -2.0*mdl.llf
+
+            fp1 = min(fp_power_sets(1), key=lambda pw: dev[pw])
+            if dfs[v] == 2:
+                if scipy.stats.chi2.sf(dev[(1,)] - dev[fp1], 1) >= alpha:
+                    powers[v] = (1,)
+                else:
+                    powers[v] = fp1
+                continue
+            fp2 = min(fp_power_sets(2), key=lambda pw: dev[pw])
+
+            if scipy.stats.chi2.sf(dev[(1,)] - dev[fp2], 3) >= alpha:
+                powers[v] = (1,)
+            elif scipy.stats.chi2.sf(dev[fp1] - dev[fp2], 2) >= alpha:
+                powers[v] = fp1
+            else:
+                powers[v] = fp2
+
+        if powers == powers_prev:
+            break
+
+    mdl = fit_logit(design_matrix(data, powers, transforms, lin_vars), y)
+
+    return {'pred': mdl.predict(), 'powers': powers, 'model': mdl, 'index': df.index}
+
+def fit_mfp_job(job):
+    # fit a single MFP model - used to distribute fits across processes
+    df, formula, alpha = job
+    return fit_mfp(df, formula, alpha=alpha)
+
+def fit_mfp_many(df, formulas, alpha=0.05, n_jobs=1):
+    # fit an MFP model for each formula, optionally across n_jobs processes
+    # returns a list of the dictionaries returned by fit_mfp
+    jobs = list()
+    for formula in formulas:
+        target, fp_vars, lin_vars = parse_formula(formula)
+        jobs.append((df[[target] + fp_vars + lin_vars], formula, alpha))
+
+    if n_jobs == 1:
+        return [fit_mfp_job(job) for job in jobs]
+
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        res = pool.map(fit_mfp_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return res
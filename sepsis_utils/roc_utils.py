@@ -1,5 +1,7 @@
 # tools for calculating/comparing the area under the receiver operator characteristic curve
 
+import multiprocessing
+
 import numpy as np
 from scipy.stats import norm
 import scipy as sp
@@ -55,6 +57,35 @@ def calc_auc(pred, target, with_ci=False, alpha=0.05):
     auc_ci = norm.ppf([alpha/2.0, 1-(alpha/2.0)], loc=W, scale=np.sqrt(S))
     return W, auc_ci
 
+def calc_auc_batch(pred, target, columns=None, alpha=0.05):
+    # calculate the AUROC of many predictions of the same target in one pass
+    # pred is an N x P matrix of predictions, or a dataframe with the P predictions
+    # in columns (all columns are used if none are given)
+    # each column is sorted once, and the sort is shared by the AUROC, the
+    # DeLong covariance, and the confidence intervals
+    # returns the AUROCs (P,), the covariance matrix (P,P), and the CIs (P,2)
+
+    if columns is not None:
+        pred = pred[columns]
+
+    pred = np.asarray(pred, dtype=float)
+    if pred.ndim == 1:
+        pred = np.reshape(pred, [-1, 1])
+
+    target = np.asarray(target)
+    if pred.shape[0] != len(target):
+        raise ValueError('Predictions have {} rows but target has {} elements.'.format(
+            pred.shape[0], len(target)))
+
+    theta, V10, V01 = calc_auc_components(np.transpose(pred), target)
+    S = delong_cov(theta, V10, V01)
+
+    W = theta[:,0]
+    auc_ci = norm.ppf([[alpha/2.0, 1-(alpha/2.0)]],
+                      loc=np.reshape(W, [-1, 1]), scale=np.sqrt(np.reshape(np.diag(S), [-1, 1])))
+
+    return W, S, auc_ci
+
 def calc_auc_no_ties(pred, target):
     # calculate the AUROC given one prediction or a set of predictions
     # returns a float if only one set of predictions given
@@ -92,7 +123,90 @@ def calc_auc_no_ties(pred, target):
 
     return W
 
-def calc_auc_cov(pred, target):
+def calc_auc_cov(pred, target, method='midrank'):
+    # calculate the covariance matrix of the AUROCs for a set of predictions
+    # using the nonparametric approach of DeLong et al. (1988)
+    # method='midrank' uses the fast formulation of Sun and Xu (2014), O(P*N log N)
+    # method='delong' uses the pairwise comparison of every positive against
+    # every negative case, O(P*N_X*N_Y), and is kept to cross-check results
+
+    if method == 'midrank':
+        theta, V10, V01 = calc_auc_components(pred, target)
+    elif method == 'delong':
+        theta, V10, V01 = calc_auc_components_delong(pred, target)
+    else:
+        raise ValueError('Unrecognized method {} - use midrank or delong'.format(method))
+
+    return delong_cov(theta, V10, V01)
+
+def delong_cov(theta, V10, V01):
+    # combine the AUROCs (theta) and structural components (V10/V01) into S
+
+    N_X = V10.shape[0] # number of positive cases
+    N_Y = V01.shape[0] # number of negative cases
+
+    #  Calculate S01 and S10, covariance matrices of V01 and V10
+    theta_svd = np.dot(theta,np.transpose(theta))
+    S01 = (1.0/(N_Y-1))*(np.dot(np.transpose(V01),V01) - N_Y*theta_svd);
+    S10 = (1.0/(N_X-1))*(np.dot(np.transpose(V10),V10) - N_X*theta_svd);
+
+    # Combine for S, covariance matrix of theta
+    S = (1.0/N_Y)*S01 + (1.0/N_X)*S10;
+
+    return S
+
+def calc_auc_components(pred, target):
+    # calculate the AUROC (theta) and the DeLong structural components (V10/V01)
+    # from midranks - ties are handled exactly as they receive their average rank
+    # each prediction is sorted only once: midranks within the positive and
+    # negative cases are recovered from counts within each group of tied values
+
+    P = len(pred) # number of predictors
+
+    idx = np.asarray(target)==1
+
+    # DeLong and DeLong define X as the group with *positive* target
+    # Y as the group with *negative* target
+    N_X = sum( idx) # number of positive cases
+    N_Y = sum(~idx) # number of negative cases
+
+    theta=np.zeros([P,1],dtype=float);
+    V10=np.zeros([N_X,P],dtype=float);
+    V01=np.zeros([N_Y,P],dtype=float);
+
+    for p in range(P):
+        pred_p = np.asarray(pred[p], dtype=float)
+
+        order = np.argsort(pred_p, kind='mergesort')
+        pred_sorted = pred_p[order]
+        pos_sorted = idx[order].astype(float)
+
+        # assign each sorted observation to a group of tied values
+        grp = np.cumsum(np.concatenate([[True], pred_sorted[1:] != pred_sorted[:-1]])) - 1
+        n_pos = np.bincount(grp, weights=pos_sorted)
+        n_neg = np.bincount(grp, weights=1.0-pos_sorted)
+
+        # for each positive case, the number of negative cases ranked below it
+        # (ties count as half)
+        v10 = (np.cumsum(n_neg) - n_neg + 0.5*n_neg) / N_Y
+
+        # for each negative case, the number of positive cases ranked above it
+        v01 = (N_X - np.cumsum(n_pos) + 0.5*n_pos) / N_X
+
+        # map the group values back to the original order of observations
+        grp_unsorted = np.empty(grp.shape, dtype=int)
+        grp_unsorted[order] = grp
+
+        V10[:,p] = v10[grp_unsorted[ idx]]
+        V01[:,p] = v01[grp_unsorted[~idx]]
+
+        theta[p] = np.mean(V10[:,p])
+
+    return theta, V10, V01
+
+def calc_auc_components_delong(pred, target):
+    # calculate the AUROC (theta) and the DeLong structural components (V10/V01)
+    # by comparing every positive case against every negative case
 
     P = len(pred) # number of predictors
     N = len(target) # number of observations
@@ -136,23 +250,12 @@ def calc_auc_cov(pred, target):
     V10 = V10/N_Y
     V01 = V01/N_X
 
-    #  Calculate S01 and S10, covariance matrices of V01 and V10
-    theta_svd = np.dot(theta,np.transpose(theta))
-    S01 = (1.0/(N_Y-1))*(np.dot(np.transpose(V01),V01) - N_Y*theta_svd);
-    S10 = (1.0/(N_X-1))*(np.dot(np.transpose(V10),V10) - N_X*theta_svd);
-
-    # Combine for S, covariance matrix of theta
-    S = (1.0/N_Y)*S01 + (1.0/N_X)*S10;
-
-    return S
+    return theta, V10, V01
 
 def test_auroc(pred1, pred2, target, alpha=0.95):
     # compare if two predictions have AUROCs which are statistically significantly different
-    S       = calc_auc_cov(pred=(pred1, pred2), target=target);
-    theta   =     calc_auc(pred=(pred1, pred2), target=target)
-
-    S_sz = S.shape;
-    theta_sz = theta.shape;
+    theta, S, _ = calc_auc_batch(np.column_stack([pred1, pred2]), target)
+    theta = np.reshape(theta, [2,1])
 
     L = np.reshape(np.asarray([1, -1]),[1,2]) # the default contrast - compare pred1 to pred2
     LSL = np.dot(np.dot(L, S), np.transpose(L))
@@ -173,25 +276,123 @@ def test_auroc(pred1, pred2, target, alpha=0.95):
 
     return pval, ci
 
-#TODO: also allow for comparing using contrast matrix / chi2 test
+def compare_auroc(pred, target, L=None, columns=None, alpha=0.05):
+    # compare the AUROCs of K predictions of the same target
+    # theta and S are calculated once, and shared by all of the tests
+    # pred is an N x K matrix of predictions, or a dataframe with the K predictions in columns
+    # L is a contrast matrix with K columns - the omnibus chi-square tests L*theta = 0
+    # by default, L tests the hypothesis that all K AUROCs are equal
+    # returns a dictionary with:
+    #   auc, cov, ci - the AUROCs, their covariance and confidence intervals
+    #   pval - KxK matrix of two-sided p-values comparing each pair of AUROCs
+    #   chi2, dof, chi2_pval - the omnibus test of the contrast matrix L
+    theta, S, auc_ci = calc_auc_batch(pred, target, columns=columns, alpha=alpha)
+    K = len(theta)
+
+    # pairwise comparisons use the contrast [1, -1] for every pair of predictions
+    var_diff = np.reshape(np.diag(S), [-1,1]) + np.reshape(np.diag(S), [1,-1]) - 2*S
+    mu = np.reshape(theta, [-1,1]) - np.reshape(theta, [1,-1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pval = 2*norm.sf(np.abs(mu) / np.sqrt(var_diff))
+    pval[np.diag_indices(K)] = np.nan
+
+    if L is None:
+        # compare the first prediction to each of the others
+        L = np.column_stack([np.ones(K-1), -np.eye(K-1)])
+    L = np.reshape(np.asarray(L, dtype=float), [-1, K])
+
+    # chi-square test with degrees of freedom equal to the rank of L*S*L'
+    mu = np.dot(L, theta)
+    LSL = np.dot(np.dot(L, S), np.transpose(L))
+    chi2 = np.dot(np.dot(mu, np.linalg.pinv(LSL)), mu)
+    dof = np.linalg.matrix_rank(LSL)
+    chi2_pval = sp.stats.chi2.sf(chi2, dof)
 
-# bootstrap AUROC
-def bootstrap_auc(pred, target, B=100):
+    return {'auc': theta, 'cov': S, 'ci': auc_ci, 'pval': pval,
+            'chi2': chi2, 'dof': dof, 'chi2_pval': chi2_pval}
 
-    auc = np.zeros(B,dtype=float)
+# bootstrap AUROC
+def bootstrap_auc(pred, target, B=100, rng=None, n_jobs=1, chunk_size=None):
+    # bootstrap AUROC - return value and confidence intervals (percentile method)
+    # the predictions are sorted once, and each resample is represented by the
+    # number of times each observation was drawn, so that the AUROC of B
+    # resamples can be calculated together as a weighted AUROC
+    # rng is a numpy.random.Generator (or a seed) to make the results reproducible
+    # chunks of resamples are spread across n_jobs processes - each chunk gets its
+    # own seed drawn from rng, so the results do not depend on n_jobs
+
+    pred = np.asarray(pred, dtype=float)
+    target = np.asarray(target)
     N = len(target)
+    rng = np.random.default_rng(rng)
 
-    for b in range(B):
-        idx = np.random.randint(0, high=N, size=N)
-        auc[b] = calc_auc(pred[idx], target[idx])
+    # by default, keep each chunk of resamples to ~5 million counts
+    if chunk_size is None:
+        chunk_size = max(1, int(5e6 // N))
 
-    # get confidence intervals using percentiles of AUC
+    # sort once, and record the groups of tied predictions in the sorted order
+    order = np.argsort(pred, kind='mergesort')
+    pred_sorted = pred[order]
+    pos_sorted = target[order]==1
+    grp_start = np.flatnonzero(np.concatenate([[True], pred_sorted[1:] != pred_sorted[:-1]]))
+
+    n_chunks = int(np.ceil(B / float(chunk_size)))
+    seeds = rng.integers(0, 2**63 - 1, size=n_chunks)
+    jobs = [(pos_sorted, grp_start, min(chunk_size, B - c*chunk_size), seeds[c])
+            for c in range(n_chunks)]
+
+    if n_jobs == 1:
+        auc = [bootstrap_auc_chunk(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            auc = pool.map(bootstrap_auc_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    auc = np.concatenate(auc)
 
-    ci = np.percentile(auc, [5,95])
+    # get confidence intervals using percentiles of AUC
+    ci = np.nanpercentile(auc, [5,95])
     auc = calc_auc(pred, target)
 
     return auc, ci
 
+def bootstrap_auc_chunk(job):
+    # calculate the AUROC for a chunk of bootstrap resamples
+    # pos_sorted and grp_start describe the target and tie groups of the presorted
+    # predictions, so resamples are drawn directly over the sorted observations
+    pos_sorted, grp_start, B, seed = job
+    N = len(pos_sorted)
+    rng = np.random.default_rng(seed)
+
+    # count the number of times each observation appears in each resample
+    idx = rng.integers(0, N, size=[B, N]) + N*np.arange(B)[:, np.newaxis]
+    counts = np.bincount(idx.ravel(), minlength=B*N).reshape([B, N])
+
+    return weighted_auc(counts, pos_sorted, grp_start)
+
+def weighted_auc(weights, pos_sorted, grp_start):
+    # calculate the AUROC of presorted predictions under each row of weights
+    # weights is a B x N matrix, and grp_start indexes the start of each group of tied values
+    # ties between a positive and a negative case contribute one half, as in calc_auc
+
+    # total weight of positive/negative cases in each group of tied predictions
+    w_pos = np.add.reduceat(weights * pos_sorted, grp_start, axis=1).astype(float)
+    w_neg = np.add.reduceat(weights * ~pos_sorted, grp_start, axis=1).astype(float)
+
+    # weight of negative cases ranked below each group
+    w_neg_below = np.cumsum(w_neg, axis=1) - w_neg
+
+    num = np.sum(w_pos * (w_neg_below + 0.5*w_neg), axis=1)
+    den = np.sum(w_pos, axis=1) * np.sum(w_neg, axis=1)
+
+    # resamples without any positive/negative cases have an undefined AUROC
+    with np.errstate(invalid='ignore', divide='ignore'):
+        auc = num / den
+    return auc
+
 # === binormal AUROC is a parametric estimate of the ROC curve
 # can be useful if you have low sample sizes
 
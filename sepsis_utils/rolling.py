@@ -0,0 +1,196 @@
+# qSOFA, SIRS and SOFA on an hourly grid for each ICU stay
+# the scores follow query/tbls/qsofa-si.sql, sirs-si.sql and sofa-si.sql, computed over a
+# window ending at each hour of the stay rather than once around suspected infection
+#
+#   frames = get_rolling_events(con)
+#   events = rolling_events(frames)
+#   windows = hourly_windows(icustays, hours=24)
+#   df = rolling_scores(events, windows)
+#
+# hourly windows overlap, so reducing each window separately (as sofa.reduce_windows)
+# rescans the same events many times - minimums and maximums are read from a sparse
+# table and sums from cumulative sums, so each window costs O(1) whatever its length
+
+import numpy as np
+import pandas as pd
+
+from . import sepsis_extract_data as se
+from . import sofa as so
+
+def hourly_windows(icustays, hours=24, step=1, start='intime', end='outtime'):
+    # one window per ICU stay and hour, ending at start + hr hours for hr = 0, step, ...
+    # up to the end of the stay
+    # hours - the length of each window, or None for all data since the start of the stay
+    # returns a dataframe with icustay_id, hr, starttime and endtime
+    ie = icustays.loc[icustays[start].notnull() & icustays[end].notnull(),
+                      ['icustay_id', start, end]]
+    t0 = pd.to_datetime(ie[start]).values
+    length = (pd.to_datetime(ie[end]).values - t0) / np.timedelta64(1, 'h')
+    n = np.maximum(np.floor(length / step).astype(int) + 1, 0)
+
+    offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    hr = offset * step
+    endtime = np.repeat(t0, n) + (hr * 3600).astype('timedelta64[s]')
+    if hours is None:
+        starttime = np.repeat(t0, n)
+    else:
+        starttime = endtime - np.timedelta64(int(hours * 3600), 's')
+    windows = pd.DataFrame({'icustay_id': np.repeat(ie['icustay_id'].values, n), 'hr': hr,
+                            'starttime': starttime, 'endtime': endtime})
+    return windows.sort_values(['icustay_id', 'hr'], kind='mergesort').reset_index(drop=True)
+
+def sparse_table_reduce(ufunc, values, lo, hi):
+    # ufunc (np.fmin or np.fmax) over values[lo:hi] for each window, or NaN if it is empty
+    # level j of the sparse table holds the reduction of each run of 2**j values, so a
+    # window of length n is covered by two overlapping runs of length 2**floor(log2(n))
+    # levels are only built up to the longest window L, in O(N log L) time - each level
+    # replaces the one before it once its windows are reduced, so memory is O(N)
+    values = np.asarray(values, dtype=float)
+    res = np.full(lo.size, np.nan)
+    length = hi - lo
+    nonempty = np.flatnonzero(length > 0)
+    if nonempty.size == 0:
+        return res
+    level = np.floor(np.log2(length[nonempty])).astype(int)
+
+    table = values
+    for j in range(level.max() + 1):
+        if j > 0:
+            half = 1 << (j - 1)
+            table = ufunc(table[:-half], table[half:])
+        k = nonempty[level == j]
+        if k.size > 0:
+            res[k] = ufunc(table[lo[k]], table[hi[k] - (1 << j)])
+    return res
+
+def rolling_reduce(ufunc, values, lo, hi):
+    # a drop in for sofa.reduce_windows whose cost does not grow with the window length
+    # minimums and maximums use a sparse table, and sums use cumulative sums
+    if ufunc is np.fmin or ufunc is np.minimum:
+        return sparse_table_reduce(np.fmin, values, lo, hi)
+    elif ufunc is np.fmax or ufunc is np.maximum:
+        return sparse_table_reduce(np.fmax, values, lo, hi)
+    elif ufunc is np.add:
+        total = np.concatenate([[0], np.cumsum(values)])
+        res = total[hi] - total[lo]
+        return np.where(hi > lo, res, np.nan)
+    else:
+        raise ValueError('Unrecognized ufunc {} - use np.fmin, np.fmax or np.add'.format(ufunc))
+
+def get_rolling_events(con, bloodgas_table=None):
+    # read the events used by rolling_scores, i.e. those of sofa.get_sofa_events and the
+    # vital signs, white blood cell counts and PaCO2 used by qSOFA and SIRS
+    # PaCO2 is taken from the arterial blood gases of sofa.get_sofa_events
+    frames = so.get_sofa_events(con, bloodgas_table=bloodgas_table)
+    frames['vitals'] = se.read_sql(con, """
+    select icustay_id, charttime
+      , case when itemid in (211,220045) and valuenum > 0 and valuenum < 300
+          then valuenum end as heartrate
+      , case when itemid in (51,442,455,6701,220179,220050) and valuenum > 0 and valuenum < 400
+          then valuenum end as sysbp
+      , case when itemid in (615,618,220210,224690) and valuenum > 0 and valuenum < 70
+          then valuenum end as resprate
+      , case
+          when itemid in (223761,678) and valuenum > 70 and valuenum < 120
+            then (valuenum-32)/1.8
+          when itemid in (223762,676) and valuenum > 10 and valuenum < 50
+            then valuenum
+        end as tempc
+    from chartevents
+    where itemid in
+    (
+      211, 220045
+    , 51, 442, 455, 6701, 220179, 220050
+    , 615, 618, 220210, 224690
+    , 223761, 678, 223762, 676
+    )
+    and error is distinct from 1
+    """, name='rolling_vitals')
+
+    # labs are charted for the hospitalization, and apply to each of its ICU stays
+    frames['wbc'] = se.read_sql(con, """
+    select ie.icustay_id, le.charttime
+      , case when itemid in (51300,51301) and valuenum <= 1000 then valuenum end as wbc
+      , case when itemid = 51144 and valuenum <= 100 then valuenum end as bands
+    from icustays ie
+    inner join labevents le
+      on le.hadm_id = ie.hadm_id
+    where le.itemid in (51300, 51301, 51144)
+    and valuenum is not null and valuenum > 0
+    """, name='rolling_wbc')
+
+    bg = frames['bloodgas']
+    bg = bg.loc[bg['specimen_pred'] == 'ART']
+    frames['paco2'] = pd.DataFrame({'icustay_id': bg['icustay_id'].values,
+                                    'charttime': bg['charttime'].values,
+                                    'paco2': bg['pco2'].values})
+    return frames
+
+def rolling_events(frames):
+    # sort the events of each kind, as sofa.sofa_events, adding:
+    #   vitals - icustay_id, charttime, heartrate, sysbp, resprate, tempc
+    #   wbc    - icustay_id, charttime, wbc, bands
+    #   paco2  - icustay_id, charttime, paco2 (arterial blood gases)
+    events = so.sofa_events(frames)
+    for name, columns in [('vitals', ['heartrate', 'sysbp', 'resprate', 'tempc']),
+                          ('wbc', ['wbc', 'bands']), ('paco2', ['paco2'])]:
+        df = frames[name] if name in frames \
+            else pd.DataFrame(dict([(c, []) for c in ['icustay_id', 'charttime'] + columns]))
+        events[name] = so.EventArrays.from_frame(df, columns)
+    return events
+
+def qsofa_scores(events, windows, reduce=rolling_reduce):
+    # qSOFA for each window, as qsofa-si.sql
+    icustay_id = windows['icustay_id'].values
+    starttime, endtime = windows['starttime'], windows['endtime']
+    ev = events['vitals']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    sysbp = reduce(np.fmin, ev.columns['sysbp'], lo, hi)
+    resprate = reduce(np.fmax, ev.columns['resprate'], lo, hi)
+    gcs = so.min_gcs(events['gcs'], icustay_id, starttime, endtime, reduce=reduce)
+
+    scores = pd.DataFrame({'sysbp_score': so.score([sysbp <= 100], [1], np.isnan(sysbp)),
+                           'gcs_score': so.score([gcs <= 13], [1], np.isnan(gcs)),
+                           'resprate_score': so.score([resprate >= 22], [1], np.isnan(resprate))})
+    scores.insert(0, 'qsofa', scores.fillna(0).sum(axis=1).astype(int))
+    return scores
+
+def sirs_scores(events, windows, reduce=rolling_reduce):
+    # SIRS for each window, as sirs-si.sql
+    icustay_id = windows['icustay_id'].values
+    starttime, endtime = windows['starttime'], windows['endtime']
+    ev = events['vitals']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    temp_min = reduce(np.fmin, ev.columns['tempc'], lo, hi)
+    temp_max = reduce(np.fmax, ev.columns['tempc'], lo, hi)
+    heartrate = reduce(np.fmax, ev.columns['heartrate'], lo, hi)
+    resprate = reduce(np.fmax, ev.columns['resprate'], lo, hi)
+
+    ev = events['paco2']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    paco2 = reduce(np.fmin, ev.columns['paco2'], lo, hi)
+
+    ev = events['wbc']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    wbc_min = reduce(np.fmin, ev.columns['wbc'], lo, hi)
+    wbc_max = reduce(np.fmax, ev.columns['wbc'], lo, hi)
+    bands = reduce(np.fmax, ev.columns['bands'], lo, hi)
+
+    scores = pd.DataFrame({
+        'temp_score': so.score([temp_min < 36.0, temp_max > 38.0], [1, 1], np.isnan(temp_min)),
+        'heartrate_score': so.score([heartrate > 90.0], [1], np.isnan(heartrate)),
+        'resp_score': so.score([resprate > 20.0, paco2 < 32.0], [1, 1],
+                            np.isnan(resprate) & np.isnan(paco2)),
+        'wbc_score': so.score([wbc_min < 4.0, wbc_max > 12.0, bands > 10], [1, 1, 1],
+                           np.isnan(wbc_min) & np.isnan(bands))})
+    scores.insert(0, 'sirs', scores.fillna(0).sum(axis=1).astype(int))
+    return scores
+
+def rolling_scores(events, windows, reduce=rolling_reduce):
+    # qSOFA, SIRS and SOFA, with their components, for each window
+    # windows are usually those of hourly_windows, but any windows can be given
+    windows = windows.reset_index(drop=True)
+    sofa = so.sofa(events, windows, reduce=reduce)
+    return pd.concat([windows, qsofa_scores(events, windows, reduce=reduce),
+                      sirs_scores(events, windows, reduce=reduce),
+                      sofa.drop(['icustay_id', 'starttime', 'endtime'], axis=1)], axis=1)
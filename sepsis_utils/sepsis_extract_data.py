@@ -1,164 +1,87 @@
 import sys
 import os
+import uuid
 import psycopg2
 import pandas as pd
 import numpy as np
+from multiprocessing.pool import ThreadPool
+from . import db
+from . import cache as qc
+from . import instrument
+from .duckdb_backend import DuckDBBackend
 
 # === also define queries for custom time spans === #
 # "T" is the number of hours after ICU admission to include at a minimum
 
-def get_scores_at_time(con, T=3):
+def get_scores_at_time(con, T=3, cache=None, log=None):
+    # extract qSOFA using data from ICU admission up to T hours after ICU admission
+    # T can be a single number of hours, or a list of hours, e.g. [1, 3, 6, 12, 24]
+    # all windows are calculated in a single query on the given connection
+    # con can also be a db.ConnectionPool, in which case a pooled connection is used,
+    # or a DuckDBBackend to query local parquet copies of the tables
+    # cache - a cache.QueryCache, if given the result is only queried once
+    # log - an instrument.QueryLog, if given the plan and timings of the query are logged
+    # returns a dataframe with one row per (icustay_id, window_hr)
     schema_name = "mimiciii"
 
-    query_vd = """
-    ventsettings as
-    (
-      select
-        ce.icustay_id, charttime
-        -- case statement determining whether it is an instance of mech vent
-        , max(
-          case
-            when itemid is null or value is null then 0 -- can't have null values
-            when itemid = 720 and value != 'Other/Remarks' THEN 1  -- VentTypeRecorded
-            when itemid = 467 and value = 'Ventilator' THEN 1 -- O2 delivery device == ventilator
-            when itemid = 648 and value = 'Intubated/trach' THEN 1 -- Speech = intubated
-            when itemid in
-              (
-              445, 448, 449, 450, 1340, 1486, 1600, 224687 -- minute volume
-              , 639, 654, 681, 682, 683, 684,224685,224684,224686 -- tidal volume
-              , 218,436,535,444,459,224697,224695,224696,224746,224747 -- High/Low/Peak/Mean/Neg insp force ("RespPressure")
-              , 221,1,1211,1655,2000,226873,224738,224419,224750,227187 -- Insp pressure
-              , 543 -- PlateauPressure
-              , 5865,5866,224707,224709,224705,224706 -- APRV pressure
-              , 60,437,505,506,686,220339,224700 -- PEEP
-              , 3459 -- high pressure relief
-              , 501,502,503,224702 -- PCV
-              , 223,667,668,669,670,671,672 -- TCPCV
-              , 157,158,1852,3398,3399,3400,3401,3402,3403,3404,8382,227809,227810 -- ETT
-              , 224701 -- PSVlevel
-              )
-              THEN 1
-            else 0
-          end
-          ) as MechVent
-          , max(
-            case when itemid is null or value is null then 0
-              when itemid = 640 and value = 'Extubated' then 1
-              when itemid = 640 and value = 'Self Extubation' then 1
-            else 0
-            end
-            )
-            as Extubated
-          , max(
-            case when itemid is null or value is null then 0
-              when itemid = 640 and value = 'Self Extubation' then 1
-            else 0
-            end
-            )
-            as SelfExtubated
-
-      from mimiciii.chartevents ce
-      where value is not null
-      and itemid in
-      (
-          640 -- extubated
-          , 648 -- speech
-          , 720 -- vent type
-          , 467 -- O2 delivery device
-          , 445, 448, 449, 450, 1340, 1486, 1600, 224687 -- minute volume
-          , 639, 654, 681, 682, 683, 684,224685,224684,224686 -- tidal volume
-          , 218,436,535,444,459,224697,224695,224696,224746,224747 -- High/Low/Peak/Mean/Neg insp force ("RespPressure")
-          , 221,1,1211,1655,2000,226873,224738,224419,224750,227187 -- Insp pressure
-          , 543 -- PlateauPressure
-          , 5865,5866,224707,224709,224705,224706 -- APRV pressure
-          , 60,437,505,506,686,220339,224700 -- PEEP
-          , 3459 -- high pressure relief
-          , 501,502,503,224702 -- PCV
-          , 223,667,668,669,670,671,672 -- TCPCV
-          , 157,158,1852,3398,3399,3400,3401,3402,3403,3404,8382,227809,227810 -- ETT
-          , 224701 -- PSVlevel
-      )
-      group by icustay_id, charttime
-    )
-    -- now we convert CHARTTIME of ventilator settings into durations
-    , vd1 as
-    (
-    select
-        icustay_id
-        -- this carries over the previous charttime which had a mechanical ventilation event
-        , case
-            when MechVent=1 then
-              LAG(CHARTTIME, 1) OVER (partition by icustay_id, MechVent order by charttime)
-            else null
-          end as charttime_lag
-        , charttime
-        , MechVent
-        , Extubated
-        , SelfExtubated
+    query = get_scores_at_time_query(T)
 
-        -- if this is a mechanical ventilation event, we calculate the time since the last event
-        , case
-            -- if the current observation indicates mechanical ventilation is present
-            when MechVent=1 then
-            -- copy over the previous charttime where mechanical ventilation was present
-              CHARTTIME - (LAG(CHARTTIME, 1) OVER (partition by icustay_id, MechVent order by charttime))
-            else null
-          end as ventduration
+    # the same search_path as a db.ConnectionPool, which is part of the fingerprint used
+    # by the cache, so both share a cache entry (see get_scores_at_time_partitioned)
+    if not isinstance(con, (db.ConnectionPool, DuckDBBackend)):
+        cur = con.cursor()
+        cur.execute('SET search_path to public,' + schema_name)
+        cur.close()
 
-        -- now we determine if the current mech vent event is a "new", i.e. they've just been intubated
-        , case
-          -- if there is an extubation flag, we mark any subsequent ventilation as a new ventilation event
-            when Extubated = 1 then 0 -- extubation is *not* a new ventilation event, the *subsequent* row is
-            when
-              LAG(Extubated,1)
-              OVER
-              (
-              partition by icustay_id, case when MechVent=1 or Extubated=1 then 1 else 0 end
-              order by charttime
-              )
-              = 1 then 1
-              -- if there is less than 8 hours between vent settings, we do not treat this as a new ventilation event
-            when (CHARTTIME - (LAG(CHARTTIME, 1) OVER (partition by icustay_id, MechVent order by charttime))) <= interval '8' hour
-              then 0
-          else 1
-          end as newvent
-    FROM
-      ventsettings
-    )
-    , vd2 as
-    (
-    select vd1.*
-    -- create a cumulative sum of the instances of new ventilation
-    -- this results in a monotonic integer assigned to each instance of ventilation
-    , case when MechVent=1 or Extubated = 1 then
-        SUM( newvent )
-        OVER ( partition by icustay_id order by charttime )
-      else null end
-      as ventnum
-    from vd1
-    -- now we can isolate to just rows with ventilation settings/extubation settings
-    -- (before we had rows with extubation flags)
-    -- this removes any null values for newvent
-    where
-      MechVent = 1 or Extubated = 1
-    )
-    , vd as
-    (
-    -- finally, create the durations for each mechanical ventilation instance
-    select icustay_id, ventnum
-      , min(charttime) as starttime
-      , max(charttime) as endtime
-    from vd2
-    group by icustay_id, ventnum
-    order by icustay_id, ventnum
-    )
-    """
+    return read_sql(con, query, name='get_scores_at_time', cache=cache, log=log)
+
+def read_sql(con, query, params=None, name='query', cache=None, log=None):
+    # run a query on a connection, a db.ConnectionPool or a DuckDBBackend, optionally
+    # reading the result from a cache.QueryCache, and logging the run to an
+    # instrument.QueryLog (plans are only captured from postgres)
+    def compute():
+        if isinstance(con, DuckDBBackend):
+            return con.read_sql(query, params)
+        if log is None:
+            return qc.read_sql(con, query, params)
+        if isinstance(con, db.ConnectionPool):
+            with con.session() as s:
+                return instrument.read_sql(s.con, query, params, name=name, log=log)
+        return instrument.read_sql(con, query, params, name=name, log=log)
+
+    if cache is not None:
+        return cache.fetch(con, query, params, compute=compute)
+    return compute()
 
+def get_scores_at_time_query(T=3, partition=None):
+    # build the query used by get_scores_at_time - see that function for details
+    # each row of the "times" CTE is an (icustay_id, window_hr) pair, and every
+    # subsequent CTE groups by window_hr, so events are read once for all windows
+    # partition restricts the ICU stays to a subset given by query parameters:
+    #   'range' - icustay_id in [%(icustay_id_min)s, %(icustay_id_max)s)
+    #   'hash'  - mod(icustay_id, %(n_partitions)s) = %(partition)s
+    windows = [float(t) for t in np.atleast_1d(T)]
+    if len(windows) == 0:
+        raise ValueError('At least one window must be given.')
+
+    if partition is None:
+        partition_filter = ''
+    elif partition == 'range':
+        partition_filter = """
+    where ie.icustay_id >= %(icustay_id_min)s and ie.icustay_id < %(icustay_id_max)s"""
+    elif partition == 'hash':
+        partition_filter = """
+    where mod(ie.icustay_id, %(n_partitions)s) = %(partition)s"""
+    else:
+        raise ValueError('Unrecognized partition {} - use range or hash'.format(partition))
+
+    # ventilation durations (the ventsettings, vd1, vd2 and vd CTEs) are not used by the
+    # scores below - see durations.get_ventilation_durations to compute them
     query_bgart = """
     bg_stg1 as
     (
     select
-        pvt.SUBJECT_ID, pvt.HADM_ID, pvt.ICUSTAY_ID, pvt.CHARTTIME
+        pvt.SUBJECT_ID, pvt.HADM_ID, pvt.ICUSTAY_ID, pvt.window_hr, pvt.CHARTTIME
         , max(case when label = 'SPECIMEN' then value else null end) as SPECIMEN
         , max(case when label = 'AADO2' then valuenum else null end) as AADO2
         , max(case when label = 'BASEEXCESS' then valuenum else null end) as BASEEXCESS
@@ -189,7 +112,7 @@ def get_scores_at_time(con, T=3):
         , max(case when label = 'VENTILATOR' then valuenum else null end) as VENTILATOR
         from
         ( -- begin query that extracts the data
-          select ie.subject_id, ie.hadm_id, ie.icustay_id
+          select ie.subject_id, ie.hadm_id, ie.icustay_id, tt.window_hr
           -- here we assign labels to ITEMIDs
           -- this also fuses together multiple ITEMIDs containing the same data
               , case
@@ -251,8 +174,8 @@ def get_scores_at_time(con, T=3):
                 , 51545
               )
         ) pvt
-        group by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.CHARTTIME
-        order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.CHARTTIME
+        group by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr, pvt.CHARTTIME
+        order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr, pvt.CHARTTIME
     )
     , stg_spo2 as
     (
@@ -260,7 +183,7 @@ def get_scores_at_time(con, T=3):
         -- max here is just used to group SpO2 by charttime
         , max(case when valuenum <= 0 or valuenum > 100 then null else valuenum end) as SpO2
       from CHARTEVENTS ce
-      inner join times tt
+      inner join (select distinct icustay_id from times) tt
           on ce.icustay_id = tt.icustay_id
       -- o2 sat
       where ITEMID in
@@ -295,7 +218,7 @@ def get_scores_at_time(con, T=3):
           else null end
         ) as fio2_chartevents
       from CHARTEVENTS ce
-      inner join times tt
+      inner join (select distinct icustay_id from times) tt
           on ce.icustay_id = tt.icustay_id
       where ITEMID in
       (
@@ -309,7 +232,7 @@ def get_scores_at_time(con, T=3):
     , bg_stg2 as
     (
         select bg.*
-          , ROW_NUMBER() OVER (partition by bg.icustay_id, bg.charttime order by s1.charttime DESC) as lastRowSpO2
+          , ROW_NUMBER() OVER (partition by bg.icustay_id, bg.window_hr, bg.charttime order by s1.charttime DESC) as lastRowSpO2
           , s1.spo2
         from bg_stg1 bg
         left join stg_spo2 s1
@@ -322,7 +245,7 @@ def get_scores_at_time(con, T=3):
     , bg_stg3 as
     (
         select bg.*
-          , ROW_NUMBER() OVER (partition by bg.icustay_id, bg.charttime order by s2.charttime DESC) as lastRowFiO2
+          , ROW_NUMBER() OVER (partition by bg.icustay_id, bg.window_hr, bg.charttime order by s2.charttime DESC) as lastRowFiO2
           , s2.fio2_chartevents
 
           -- create our specimen prediction
@@ -352,7 +275,7 @@ def get_scores_at_time(con, T=3):
     , bgart as
     (
         select subject_id, hadm_id,
-        icustay_id, charttime
+        icustay_id, window_hr, charttime
         , SPECIMEN -- raw data indicating sample type, only present 80% of the time
 
         -- prediction of specimen for missing data
@@ -413,7 +336,7 @@ def get_scores_at_time(con, T=3):
     query_labs = """
     labs as (
     select
-      pvt.subject_id, pvt.hadm_id, pvt.icustay_id
+      pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr
       , min(case when label = 'ANION GAP' then valuenum else null end) as ANIONGAP_min
       , max(case when label = 'ANION GAP' then valuenum else null end) as ANIONGAP_max
       , min(case when label = 'ALBUMIN' then valuenum else null end) as ALBUMIN_min
@@ -456,7 +379,7 @@ def get_scores_at_time(con, T=3):
 
     from
     ( -- begin query that extracts the data
-      select ie.subject_id, ie.hadm_id, ie.icustay_id
+      select ie.subject_id, ie.hadm_id, ie.icustay_id, tt.window_hr
       -- here we assign labels to ITEMIDs
       -- this also fuses together multiple ITEMIDs containing the same data
       , case
@@ -559,15 +482,15 @@ def get_scores_at_time(con, T=3):
         )
         and valuenum is not null and valuenum > 0 -- lab values cannot be 0 and cannot be negative
     ) pvt
-    group by pvt.subject_id, pvt.hadm_id, pvt.icustay_id
-    order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id
+    group by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr
+    order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr
     )
     """
 
     query_gcs = """
     gcs_stg0 as
     (
-        SELECT pvt.ICUSTAY_ID
+        SELECT pvt.ICUSTAY_ID, pvt.window_hr
       , pvt.charttime
       -- Easier names - note we coalesced Metavision and CareVue IDs below
       , max(case when pvt.itemid = 454 then pvt.valuenum else null end) as GCSMotor
@@ -582,10 +505,10 @@ def get_scores_at_time(con, T=3):
         end as EndoTrachFlag
 
       , ROW_NUMBER ()
-              OVER (PARTITION BY pvt.ICUSTAY_ID ORDER BY pvt.charttime ASC) as rn
+              OVER (PARTITION BY pvt.ICUSTAY_ID, pvt.window_hr ORDER BY pvt.charttime ASC) as rn
 
       FROM  (
-      select l.ICUSTAY_ID
+      select l.ICUSTAY_ID, tt.window_hr
       -- merge the ITEMIDs so that the pivot applies to both metavision/carevue data
       , case
           when l.ITEMID in (723,223900) then 723
@@ -622,7 +545,7 @@ def get_scores_at_time(con, T=3):
       )
       and l.charttime between b.intime and tt.endtime
       ) pvt
-      group by pvt.ICUSTAY_ID, pvt.charttime
+      group by pvt.ICUSTAY_ID, pvt.window_hr, pvt.charttime
     )
     , gcs_stg1 as (
       select b.*
@@ -656,20 +579,21 @@ def get_scores_at_time(con, T=3):
       from gcs_stg0 b
       -- join to itself within 6 hours to get previous value
       left join gcs_stg0 b2
-        on b.ICUSTAY_ID = b2.ICUSTAY_ID and b.rn = b2.rn+1 and b2.charttime > b.charttime - interval '6' hour
+        on b.ICUSTAY_ID = b2.ICUSTAY_ID and b.window_hr = b2.window_hr
+        and b.rn = b2.rn+1 and b2.charttime > b.charttime - interval '6' hour
     )
     , gcs_final as (
       select gcs.*
       -- This sorts the data by GCS, so rn=1 is the the lowest GCS values to keep
       , ROW_NUMBER ()
-              OVER (PARTITION BY gcs.ICUSTAY_ID
+              OVER (PARTITION BY gcs.ICUSTAY_ID, gcs.window_hr
                     ORDER BY gcs.GCS
                    ) as IsMinGCS
       from gcs_stg1 gcs
     )
     , gcs as
     (
-        select ie.SUBJECT_ID, ie.HADM_ID, ie.ICUSTAY_ID
+        select ie.SUBJECT_ID, ie.HADM_ID, ie.ICUSTAY_ID, tt.window_hr
         -- The minimum GCS is determined by the above row partition, we only join if IsMinGCS=1
         , GCS as MinGCS
         , coalesce(GCSMotor,GCSMotorPrev) as GCSMotor
@@ -679,16 +603,18 @@ def get_scores_at_time(con, T=3):
 
         -- subselect down to the cohort of eligible patients
         from mimiciii.icustays ie
+        inner join times tt
+          on ie.icustay_id = tt.icustay_id
         left join gcs_final gs
-          on ie.ICUSTAY_ID = gs.ICUSTAY_ID and gs.IsMinGCS = 1
-        ORDER BY ie.ICUSTAY_ID
+          on tt.ICUSTAY_ID = gs.ICUSTAY_ID and tt.window_hr = gs.window_hr and gs.IsMinGCS = 1
+        ORDER BY ie.ICUSTAY_ID, tt.window_hr
     )
     """
 
     query_vitals = """
     vitals as
     (
-        SELECT pvt.subject_id, pvt.hadm_id, pvt.icustay_id
+        SELECT pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr
 
         -- Easier names
         , min(case when VitalID = 1 then valuenum else null end) as HeartRate_Min
@@ -709,7 +635,7 @@ def get_scores_at_time(con, T=3):
         , max(case when VitalID = 8 then valuenum else null end) as Glucose_Max
 
         FROM  (
-          select ie.subject_id, ie.hadm_id, ie.icustay_id
+          select ie.subject_id, ie.hadm_id, ie.icustay_id, tt.window_hr
           , case
             when itemid in (211,220045) and valuenum > 0 and valuenum < 300 then 1 -- HeartRate
             when itemid in (51,442,455,6701,220179,220050) and valuenum > 0 and valuenum < 400 then 2 -- SysBP
@@ -790,8 +716,8 @@ def get_scores_at_time(con, T=3):
           678 --    "Temperature F"
           )
         ) pvt
-        group by pvt.subject_id, pvt.hadm_id, pvt.icustay_id
-        order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id
+        group by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr
+        order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.window_hr
     )
     """
 
@@ -799,11 +725,11 @@ def get_scores_at_time(con, T=3):
     vent as
     (
         select
-            icustay_id, MechVent
+            icustay_id, window_hr, MechVent
         from
         (
           select
-            ce.icustay_id
+            ce.icustay_id, tt.window_hr
             -- case statement determining whether it is an instance of mech vent
             , max(
               case
@@ -850,7 +776,8 @@ def get_scores_at_time(con, T=3):
           inner join icustays ie
             on ce.icustay_id = ie.icustay_id
           inner join times tt
-            on ce.charttime between tt.starttime and tt.endtime
+            on ce.icustay_id = tt.icustay_id
+            and ce.charttime between tt.starttime and tt.endtime
           where value is not null
           and itemid in
           (
@@ -871,7 +798,7 @@ def get_scores_at_time(con, T=3):
               , 157,158,1852,3398,3399,3400,3401,3402,3403,3404,8382,227809,227810 -- ETT
               , 224701 -- PSVlevel
           )
-          group by ce.icustay_id
+          group by ce.icustay_id, tt.window_hr
          ) ventsettings
     )
     """
@@ -881,7 +808,7 @@ def get_scores_at_time(con, T=3):
     (
     select
       -- patient identifiers
-      ie.subject_id, ie.hadm_id, ie.icustay_id
+      ie.subject_id, ie.hadm_id, ie.icustay_id, tt.window_hr
 
       -- volumes associated with urine output ITEMIDs
       , sum(VALUE) as UrineOutput
@@ -926,30 +853,30 @@ def get_scores_at_time(con, T=3):
     226557, -- "R Ureteral Stent"
     226558  -- "L Ureteral Stent"
     )
-    group by ie.subject_id, ie.hadm_id, ie.icustay_id
-    order by ie.subject_id, ie.hadm_id, ie.icustay_id
+    group by ie.subject_id, ie.hadm_id, ie.icustay_id, tt.window_hr
+    order by ie.subject_id, ie.hadm_id, ie.icustay_id, tt.window_hr
     )
     """
 
     query_qsofa = """
     qsofa_scorecomp as
     (
-        select ie.icustay_id
+        select tt.icustay_id, tt.window_hr
           , v.SysBP_Min
           , v.RespRate_max
           , gcs.MinGCS
-        from icustays ie
+        from times tt
         left join vitals v
-          on ie.icustay_id = v.icustay_id
+          on tt.icustay_id = v.icustay_id and tt.window_hr = v.window_hr
         left join gcs gcs
-          on ie.icustay_id = gcs.icustay_id
+          on tt.icustay_id = gcs.icustay_id and tt.window_hr = gcs.window_hr
     )
     , qsofa_scorecalc as
     (
       -- Calculate the final score
       -- note that if the underlying data is missing, the component is null
       -- eventually these are treated as 0 (normal), but knowing when data is missing is useful for debugging
-      select icustay_id
+      select icustay_id, window_hr
       , case
           when SysBP_Min is null then null
           when SysBP_Min   < 100 then 1
@@ -969,7 +896,7 @@ def get_scores_at_time(con, T=3):
     )
     , qsofa as
     (
-        select ie.subject_id, ie.hadm_id, ie.icustay_id
+        select ie.subject_id, ie.hadm_id, ie.icustay_id, s.window_hr
         , coalesce(SysBP_score,0)
          + coalesce(GCS_score,0)
          + coalesce(RespRate_score,0)
@@ -978,7 +905,7 @@ def get_scores_at_time(con, T=3):
         , GCS_score
         , RespRate_score
         from icustays ie
-        left join qsofa_scorecalc s
+        inner join qsofa_scorecalc s
           on ie.icustay_id = s.icustay_id
     )
     """
@@ -988,34 +915,187 @@ def get_scores_at_time(con, T=3):
     times as
     (
     select
-        icustay_id
+        ie.icustay_id
+        , w.window_hr
         , ie.intime as starttime
-        , ie.intime + interval '3' hour as endtime
+        , ie.intime + w.window_hr * interval '1' hour as endtime
     from icustays ie
+    cross join (values """ + ', '.join(['({:g})'.format(t) for t in windows]) + """) as w(window_hr)""" \
+    + partition_filter + """
     )
     """
 
-    query = 'SET search_path to ' + schema_name + ';' + '\n' \
-    + 'with ' + query_tt \
-    + ', ' + query_uo \
+    query = ', ' + query_uo \
     + ', ' + query_vent \
     + ', ' + query_vitals \
     + ', ' + query_gcs \
     + ', ' + query_labs \
     + ', ' + query_bgart \
-    + ', ' + query_vd \
     + ', ' + query_qsofa \
     + """
-    select ie.icustay_id
+    select tt.icustay_id, tt.window_hr
     , tt.starttime, tt.endtime
     , qsofa.qsofa
-    from icustays ie
-    left join times tt
-        on ie.icustay_id = tt.icustay_id
+    , qsofa.SysBP_score, qsofa.GCS_score, qsofa.RespRate_score
+    from times tt
     left join qsofa
-        on ie.icustay_id = qsofa.icustay_id
-    order by icustay_id
+        on tt.icustay_id = qsofa.icustay_id and tt.window_hr = qsofa.window_hr
+    order by tt.icustay_id, tt.window_hr
     """
 
-    #qsofa = pd.read_sql_query(query,con)
+    # literal % must be escaped when the query is passed with parameters
+    if partition is not None:
+        query = query.replace('%', '%%')
+
+    query = 'with ' + query_tt + query
     return query
+
+def get_scores_at_time_partitioned(pool, T=3, n_partitions=8, n_jobs=None, partition='hash',
+                                   cache=None):
+    # run the get_scores_at_time query in parallel over partitions of icustay_id
+    # pool is a db.ConnectionPool, e.g.
+    #   pool = db.ConnectionPool(dbname='mimic', user='postgres', maxconn=8)
+    # each partition runs on its own pooled connection, so the database can execute
+    # them on separate backends; threads are sufficient as psycopg2 releases the GIL
+    # the query is prepared once per connection and executed for each partition
+    # partition is 'hash' (icustay_id modulo n_partitions) or 'range' (equal width
+    # ranges of icustay_id)
+    # returns a dataframe identical to get_scores_at_time, and shares its cache entry
+    # when both use the default schema_name, as the search_path is in the fingerprint
+    if cache is not None:
+        return cache.fetch(pool, get_scores_at_time_query(T),
+                           compute=lambda: get_scores_at_time_partitioned(
+                               pool, T, n_partitions=n_partitions, n_jobs=n_jobs,
+                               partition=partition))
+
+    if n_jobs is None:
+        n_jobs = n_partitions
+
+    query = get_scores_at_time_query(T, partition=partition)
+
+    if partition == 'range':
+        with pool.session() as s:
+            cur = s.cursor()
+            cur.execute('select min(icustay_id), max(icustay_id) from icustays')
+            icustay_id_min, icustay_id_max = cur.fetchone()
+            cur.close()
+        edges = np.linspace(icustay_id_min, icustay_id_max + 1, n_partitions + 1).astype(int)
+        params = [{'icustay_id_min': int(edges[i]), 'icustay_id_max': int(edges[i+1])}
+                  for i in range(n_partitions)]
+    else:
+        params = [{'n_partitions': n_partitions, 'partition': i} for i in range(n_partitions)]
+
+    def run_partition(p):
+        with pool.session() as s:
+            return s.read_prepared(query, p)
+
+    workers = ThreadPool(n_jobs)
+    try:
+        df = workers.map(run_partition, params)
+    finally:
+        workers.close()
+        workers.join()
+
+    df = pd.concat(df, ignore_index=True)
+    df = df.sort_values(['icustay_id', 'window_hr']).reset_index(drop=True)
+    return df
+
+# === stream large results from the database === #
+
+def get_sepsis3_query(exclusions=True):
+    # query for the final sepsis3 table, by default applying the exclusion criteria
+    query = "select * from sepsis3"
+    if exclusions:
+        query += " where excluded = 0"
+    return query
+
+def get_sepsis3(con, exclusions=True, cache=None, log=None):
+    # read the final sepsis3 table from a connection or a db.ConnectionPool
+    # cache - a cache.QueryCache, if given the table is only read once
+    # log - an instrument.QueryLog, if given the plan and timings of the query are logged
+    query = get_sepsis3_query(exclusions=exclusions)
+    return read_sql(con, query, name='get_sepsis3', cache=cache, log=log)
+
+def stream_cursor(con, query, itersize=10000, columns=None, params=None, cursor_name=None):
+    # execute a query on a named (server-side) cursor, which fetches itersize rows at a time
+    # each cursor is given a unique name, so several streams can be open on one connection
+    # columns - only these columns are selected, so others are never transferred
+    if columns is not None:
+        query = 'select ' + ', '.join(columns) + ' from (' + query.strip().rstrip(';') + ') as q'
+    if cursor_name is None:
+        cursor_name = 'sepsis3_stream_' + uuid.uuid4().hex
+
+    cur = con.cursor(name=cursor_name)
+    cur.itersize = itersize
+    try:
+        cur.execute(query, params)
+    except:
+        cur.close()
+        raise
+    return cur
+
+def fetch_chunks(cur, itersize=10000, dtypes=None):
+    # fetch the rows of an executed cursor as dataframes of at most itersize rows
+    # dtypes - dictionary mapping columns to the dtype of the output dataframes
+    while True:
+        rows = cur.fetchmany(itersize)
+        if len(rows) == 0:
+            break
+        df = pd.DataFrame.from_records(rows, columns=[c[0] for c in cur.description])
+        if dtypes is not None:
+            df = df.astype(dtypes)
+        yield df
+
+def read_sql_chunks(con, query, itersize=10000, columns=None, dtypes=None, params=None,
+                    cursor_name=None):
+    # stream the result of a query as dataframes of at most itersize rows
+    # a named (server-side) cursor is used, so only one chunk is held in memory
+    # columns - only these columns are selected, so others are never transferred
+    # dtypes - dictionary mapping columns to the dtype of the output dataframes
+    cur = stream_cursor(con, query, itersize=itersize, columns=columns, params=params,
+                        cursor_name=cursor_name)
+    try:
+        for df in fetch_chunks(cur, itersize=itersize, dtypes=dtypes):
+            yield df
+    finally:
+        cur.close()
+
+def arrow_type(type_code):
+    # the arrow type of a postgres type oid, from cursor.description - text by default
+    import pyarrow as pa
+
+    types = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(),
+             700: pa.float32(), 701: pa.float64(), 1700: pa.float64(),
+             1082: pa.date32(), 1114: pa.timestamp('us'), 1184: pa.timestamp('us', tz='UTC')}
+    return types.get(type_code, pa.string())
+
+def write_sql_to_parquet(con, query, filename, itersize=10000, columns=None, dtypes=None,
+                         params=None):
+    # stream the result of a query to a parquet file, one row group per chunk
+    # peak memory is bounded by itersize, regardless of the size of the result
+    # returns the number of rows written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    N = 0
+    cur = stream_cursor(con, query, itersize=itersize, columns=columns, params=params)
+    try:
+        for df in fetch_chunks(cur, itersize=itersize, dtypes=dtypes):
+            tbl = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                # the schema is defined by the first chunk, except for columns which are
+                # all null in it - their type is taken from the database
+                types = dict([(c[0], arrow_type(c[1])) for c in cur.description])
+                schema = pa.schema([pa.field(f.name, types[f.name])
+                                    if pa.types.is_null(f.type) else f for f in tbl.schema])
+                writer = pq.ParquetWriter(filename, schema)
+            if not tbl.schema.equals(schema):
+                tbl = tbl.cast(schema)
+            writer.write_table(tbl)
+            N += df.shape[0]
+    finally:
+        cur.close()
+        if writer is not None:
+            writer.close()
+    return N
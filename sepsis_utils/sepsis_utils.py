@@ -6,6 +6,7 @@ import psycopg2
 import pandas as pd
 import numpy as np
 import subprocess
+import multiprocessing
 
 # we use ordered dictionaries to ensure consistent output order
 from collections import OrderedDict
@@ -15,10 +16,13 @@ import matplotlib.pyplot as plt
 from matplotlib_venn import venn3
 
 from . import roc_utils as ru
+from . import mfp
 
-from statsmodels.formula.api import logit
+import patsy
+import statsmodels.api as sm
 
 from sklearn import metrics
+from sklearn.model_selection import StratifiedKFold
 import scipy.stats
 
 def print_cm(y, yhat, header1='y', header2='yhat'):
@@ -86,25 +90,119 @@ def get_op_stats(yhat_dict, y):
     return stats_all
 
 
+def get_op_stats_sweep(score_dict, y, score_names=None, cutoffs=None, alpha=0.05):
+    # for a set of continuous scores, calculates the operating point at each cutoff
+    # a score is classified as positive if it is greater than or equal to the cutoff
+    # score_dict should be a dictionary (or dataframe) of numpy arrays of length N
+    # y is a length N numpy array
+    # by default, every integer cutoff between the min and max of each score is used
+    # returns an ordered dictionary in the same format as get_op_stats, keyed by
+    # 'score>=cutoff', with confidence intervals for sens/spec/ppv/npv added
+
+    if score_names is None:
+        score_names = list(score_dict.keys())
+
+    y = np.asarray(y) == 1
+    N = len(y)
+    n_pos = np.sum(y)
+
+    # each score is sorted once - the cumulative sum of positives in the sorted
+    # order gives the confusion matrix at every cutoff
+    names, cuts = list(), list()
+    TP, FP = list(), list()
+    for score_name in score_names:
+        score = np.asarray(score_dict[score_name], dtype=float)
+
+        # missing scores are always classified as negative
+        idx = ~np.isnan(score)
+        order = np.argsort(score[idx], kind='mergesort')
+        score_sorted = score[idx][order]
+        pos_cumsum = np.concatenate([[0], np.cumsum(y[idx][order])])
+
+        if cutoffs is None:
+            if score_sorted.size == 0:
+                continue
+            c = np.arange(np.floor(score_sorted[0]), np.ceil(score_sorted[-1])+1)
+        else:
+            c = np.asarray(cutoffs, dtype=float)
+
+        # number of observations below each cutoff
+        k = np.searchsorted(score_sorted, c, side='left')
+        tp = pos_cumsum[-1] - pos_cumsum[k]
+        TP.append(tp)
+        FP.append(score_sorted.size - k - tp)
+        names.extend([score_name]*len(c))
+        cuts.append(c)
+
+    # every score was skipped, e.g. all missing
+    if len(cuts) == 0:
+        return OrderedDict()
+
+    cuts = np.concatenate(cuts)
+    TP = np.concatenate(TP).astype(float)
+    FP = np.concatenate(FP).astype(float)
+    FN = n_pos - TP
+    TN = (N - n_pos) - FP
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sens = 100.0*TP/(TP+FN)
+        spec = 100.0*TN/(TN+FP)
+        ppv = 100.0*TP/(TP+FP)
+        npv = 100.0*TN/(TN+FN)
+        f1 = 2.0*(sens * ppv) / (ppv + sens)
+        ntp = 100.0 * (TP+FP)/N * (ppv/100.0)
+        nfp = 100.0 * (TP+FP)/N * (1-ppv/100.0)
+
+    M = len(cuts)
+    ci = binomial_proportion_cis(np.concatenate([TP, TN, TP, TN]),
+                                 np.concatenate([TP+FN, TN+FP, TP+FP, TN+FN]),
+                                 alpha = alpha)
+    ci = np.reshape(ci, [4, M, 2])
+
+    stats_all = OrderedDict()
+    for i in range(M):
+        stats = dict()
+        stats['score'] = names[i]
+        stats['cutoff'] = cuts[i]
+        stats['sens'] = sens[i]
+        stats['spec'] = spec[i]
+        stats['ppv'] = ppv[i]
+        stats['npv'] = npv[i]
+        stats['f1'] = f1[i]
+        stats['ntp'] = ntp[i]
+        stats['nfp'] = nfp[i]
+        stats['tn'] = TN[i]
+        stats['fp'] = FP[i]
+        stats['fn'] = FN[i]
+        stats['tp'] = TP[i]
+        stats['sens_ci'] = ci[0,i,:]
+        stats['spec_ci'] = ci[1,i,:]
+        stats['ppv_ci'] = ci[2,i,:]
+        stats['npv_ci'] = ci[3,i,:]
+
+        stats_all.update({'{}>={:g}'.format(names[i], cuts[i]): stats})
+    return stats_all
+
+
 def print_op_stats(stats_all):
     stats_names = [ 'TN','FP','FN','TP','Sens','Spec','PPV','NPV','F1','NTP','NFP']
 
-    # calculate confidence intervals
-    ci = dict()
+    # calculate confidence intervals - all predictions in a single call
+    TN = np.asarray([stats_all[yhat_name]['tn'] for yhat_name in stats_all])
+    FP = np.asarray([stats_all[yhat_name]['fp'] for yhat_name in stats_all])
+    FN = np.asarray([stats_all[yhat_name]['fn'] for yhat_name in stats_all])
+    TP = np.asarray([stats_all[yhat_name]['tp'] for yhat_name in stats_all])
 
-    for i, yhat_name in enumerate(stats_all):
-        stats = stats_all[yhat_name]
-        TN = stats['tn']
-        FP = stats['fp']
-        FN = stats['fn']
-        TP = stats['tp']
+    ci_all = binomial_proportion_cis(np.concatenate([TP, TN, TP, TN]),
+                                     np.concatenate([TP+FN, TN+FP, TP+FP, TN+FN]),
+                                     alpha = 0.05)
+    ci_all = np.reshape(ci_all, [4, len(stats_all), 2])
 
-        # add the CI
+    ci = dict()
+    for i, yhat_name in enumerate(stats_all):
         ci[yhat_name] = dict()
-        ci[yhat_name]['sens'] = binomial_proportion_ci(TP, TP+FN, alpha = 0.05)
-        ci[yhat_name]['spec'] = binomial_proportion_ci(TN, TN+FP, alpha = 0.05)
-        ci[yhat_name]['ppv'] = binomial_proportion_ci(TP, TP+FP, alpha = 0.05)
-        ci[yhat_name]['npv'] = binomial_proportion_ci(TN, TN+FN, alpha = 0.05)
+        for j, stats_name in enumerate(['sens', 'spec', 'ppv', 'npv']):
+            ci[yhat_name][stats_name] = ci_all[j, i, :]
 
     print('Metric')
 
@@ -145,19 +243,17 @@ def print_stats_to_file(filename, yhat_names, stats_all):
     f = open(filename,'w')
     stats_names = [ 'TN','FP','FN','TP','N','Sens','Spec','PPV','NPV','F1','NTP','NFP']
 
-    # derive CIs
+    # derive CIs for sens/spec/ppv/npv (columns 5-8) of all rows in a single call
     ci = np.zeros( [stats_all.shape[0], stats_all.shape[1], 2] )
-    for i in range(stats_all.shape[0]):
-        # add the CI
-        TN = stats_all[i,0]
-        FP = stats_all[i,1]
-        FN = stats_all[i,2]
-        TP = stats_all[i,3]
-
-        ci[i,4,:] = binomial_proportion_ci(TP, TP+FN, alpha = 0.05)
-        ci[i,5,:] = binomial_proportion_ci(TN, TN+FP, alpha = 0.05)
-        ci[i,6,:] = binomial_proportion_ci(TP, TP+FP, alpha = 0.05)
-        ci[i,7,:] = binomial_proportion_ci(TN, TN+FN, alpha = 0.05)
+    TN = stats_all[:,0]
+    FP = stats_all[:,1]
+    FN = stats_all[:,2]
+    TP = stats_all[:,3]
+
+    ci_all = binomial_proportion_cis(np.concatenate([TP, TN, TP, TN]),
+                                     np.concatenate([TP+FN, TN+FP, TP+FP, TN+FN]),
+                                     alpha = 0.05)
+    ci[:,5:9,:] = np.transpose(np.reshape(ci_all, [4, stats_all.shape[0], 2]), [1, 0, 2])
 
     f.write('Subgroup')
     for n, stats_name in enumerate(stats_names):
@@ -171,8 +267,8 @@ def print_stats_to_file(filename, yhat_names, stats_all):
         for n, stats_name in enumerate(stats_names):
             if n < 5: # use integer format for the tp/fp
                 f.write('\t%10.0f' % stats_all[i,n])
-            elif n < 8: # print sensitivity, specificity, etc with CI
-                f.write('\t%4.2f [{:2.2f}, {:2.2f}]' % stats_all[i,n], ci[i,n,0], ci[i,n,1])
+            elif n < 9: # print sensitivity, specificity, etc with CI
+                f.write('\t{:4.2f} [{:2.2f}, {:2.2f}]'.format(stats_all[i,n], ci[i,n,0]*100, ci[i,n,1]*100))
             else: # use decimal format for the sensitivity, specificity, etc
                 f.write('\t%10.2f' % stats_all[i,n])
 
@@ -430,8 +526,13 @@ def print_demographics(df, idx=None):
                 print('{:20s}'.format(curr_var))
 
 
-def calc_predictions(df, preds_header, target_header, model=None, print_summary=False):
+def calc_predictions(df, preds_header, target_header, model=None, print_summary=False,
+                     engine='R', n_jobs=1, cv=None):
     # default formula: evaluate the MFP model without severity of illness
+    # for the MFP models, engine='R' calls appendix/r-make-sepsis3-models.R once per model,
+    # while engine='python' fits all models in this process using the mfp module
+    # the python MFP and the logreg models can be spread across n_jobs processes
+    # for logreg, cv=K returns out-of-fold predictions from K-fold cross-validation
     formula = target_header + " ~ age + elixhauser_hospital + is_male + race_black + race_other"
     if model is None:
         preds = dict()
@@ -442,6 +543,13 @@ def calc_predictions(df, preds_header, target_header, model=None, print_summary=
     elif model == 'mfp_baseline':
         # call a subprocess to run the R script to generate fractional polynomial predictions
         formula = formula.replace(" age ", " fp(age) ").replace(" elixhauser_hospital "," fp(elixhauser_hospital) ")
+        if engine == 'python':
+            res = mfp.fit_mfp(df, formula)
+            if print_summary == True:
+                print(res['powers'])
+                print(res['model'].summary())
+            return res['pred']
+
         # loop through each severity score, build an MFP model for each
         fn_in = "sepsis3-design-matrix.csv"
         fn_out = "sepsis3-preds.csv"
@@ -461,22 +569,54 @@ def calc_predictions(df, preds_header, target_header, model=None, print_summary=
         return pred
 
     elif model == 'logreg':
-        P = len(preds_header)
-        y = df[target_header].values == 1
-        preds = dict()
-        for p in range(P):
-            # build the models adding each predictor as a covariate
-            model = logit(formula=formula + " + " + preds_header[p],data=df).fit(disp=0)
+        # the baseline design matrix is built once and each score is appended as a column
+        y, X_base = patsy.dmatrices(formula, data=df, return_type='dataframe')
+        y = y.iloc[:,0]
 
+        # each model is warm started from the coefficients of the baseline model
+        params_base = sm.Logit(y, X_base).fit(disp=0).params.values
+
+        jobs = list()
+        for p in preds_header:
+            # rows with a missing score are excluded, as they would be by the formula
+            score = df.loc[X_base.index, p]
+            idx = score.notnull().values
+            X = X_base.loc[idx].assign(**{p: score[idx]})
+            jobs.append((X, y[idx], np.append(params_base, 0.0), cv, print_summary))
+
+        if n_jobs == 1:
+            res = [fit_logreg_job(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                res = pool.map(fit_logreg_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        preds = dict()
+        for p, (pred, summary) in zip(preds_header, res):
             # create a list, each element containing the predictions
-            preds[preds_header[p]] = model.predict()
+            preds[p] = pred
             if print_summary == True:
-                print(model.summary())
+                print(summary)
         return preds
 
     elif model == 'mfp':
         # call a subprocess to run the R script to generate fractional polynomial predictions
         formula = formula.replace(" age ", " fp(age) ").replace(" elixhauser_hospital "," fp(elixhauser_hospital) ")
+        if engine == 'python':
+            # note we add covariate 'p' to the formula
+            res = mfp.fit_mfp_many(df, [formula + " + fp(" + p + ")" for p in preds_header],
+                                   n_jobs=n_jobs)
+            preds = dict()
+            for i, p in enumerate(preds_header):
+                preds[p] = res[i]['pred']
+                if print_summary == True:
+                    print(res[i]['powers'])
+                    print(res[i]['model'].summary())
+            return preds
+
         # loop through each severity score, build an MFP model for each
         fn_in = "sepsis3-design-matrix.csv"
         fn_out = "sepsis3-preds.csv"
@@ -499,6 +639,27 @@ def calc_predictions(df, preds_header, target_header, model=None, print_summary=
         return None
 
 
+def fit_logreg_job(job):
+    # fit a logistic regression for a single score - used by calc_predictions
+    # returns the predictions and the model summary
+    # if cv is given, the predictions are out-of-fold from stratified K-fold cross-validation
+    X, y, start_params, cv, print_summary = job
+
+    mdl = sm.Logit(y, X).fit(disp=0, start_params=start_params)
+    summary = mdl.summary() if print_summary else None
+
+    if cv is None:
+        return mdl.predict(), summary
+
+    pred = np.zeros(y.shape[0])
+    folds = StratifiedKFold(n_splits=cv, shuffle=True, random_state=0)
+    for idx_train, idx_test in folds.split(X, y):
+        mdl_cv = sm.Logit(y.iloc[idx_train], X.iloc[idx_train]).fit(disp=0, start_params=mdl.params.values)
+        pred[idx_test] = mdl_cv.predict(X.iloc[idx_test])
+
+    return pred, summary
+
+
 # measure of internal consistency for dicotomous data
 # kuder richardson formula 20
 def kr20(X):
@@ -509,17 +670,13 @@ def kr20(X):
 
     return norm_factor * (1-(kr20/kr20_var))
 
-def kr20_bootstrap(X,B=1000):
-    # bootstrap cronbach - return value and confidence intervals (percentile method)
-    alpha = np.zeros(B,dtype=float)
-    N = X.shape[1]
-
-    for b in range(B):
-        idx = np.random.randint(0, high=N, size=N)
-        alpha[b] = cronbach_alpha(X[:,idx])
-
-    ci = np.percentile(alpha, [5,95])
-    alpha = cronbach_alpha(X)
+def kr20_bootstrap(X,B=1000,rng=None):
+    # bootstrap KR-20 - return value and confidence intervals (percentile method)
+    # X has K components (K rows) of N observations (N columns), as in cronbach_alpha
+    est, boot = reliability_bootstrap(X, groups=[range(X.shape[0])], B=B,
+                                      stats=['kr20'], rng=rng)['kr20']
+    ci = np.percentile(boot[:,0], [5,95])
+    alpha = kr20(np.transpose(X))
     return alpha, ci
 
 def cronbach_alpha(X):
@@ -528,16 +685,11 @@ def cronbach_alpha(X):
     X = np.asarray(X)
     return X.shape[0] / (X.shape[0] - 1.0) * (1.0 - (X.var(axis=1, ddof=1).sum() / X.sum(axis=0).var(ddof=1)))
 
-def cronbach_alpha_bootstrap(X,B=1000):
+def cronbach_alpha_bootstrap(X,B=1000,rng=None):
     # bootstrap cronbach - return value and confidence intervals (percentile method)
-    alpha = np.zeros(B,dtype=float)
-    N = X.shape[1]
-
-    for b in range(B):
-        idx = np.random.randint(0, high=N, size=N)
-        alpha[b] = cronbach_alpha(X[:,idx])
-
-    ci = np.percentile(alpha, [5,95])
+    est, boot = reliability_bootstrap(X, groups=[range(X.shape[0])], B=B,
+                                      stats=['cronbach_alpha'], rng=rng)['cronbach_alpha']
+    ci = np.percentile(boot[:,0], [5,95])
     alpha = cronbach_alpha(X)
     return alpha, ci
 
@@ -560,28 +712,135 @@ def corrcoef_bootstrap_tetrachoric(df, B=100):
     alpha = np.mean(alpha)
     return alpha, ci
 
-def corrcoef_bootstrap(X,B=1000):
+def corrcoef_bootstrap(X,B=1000,rng=None):
     # bootstrap correlation coefficient - return value and confidence intervals
     # (percentile method)
-    alpha = np.zeros(B,dtype=float)
-    N = X.shape[1]
-
-    for b in range(B):
-        idx = np.random.randint(0, high=N, size=N)
-        # for 2 variables, corrcoef returns a 2x2 matrix
-        corrcoef_mat = np.corrcoef(X[:,idx])
-        # extract the correlation from the off-diagonal element
-        alpha[b] = corrcoef_mat[0,1]
-
-    ci = np.percentile(alpha, [5,95])
+    est, boot = reliability_bootstrap(X, groups=[(0, 1)], B=B,
+                                      stats=['corrcoef'], rng=rng)['corrcoef']
+    ci = np.percentile(boot[:,0], [5,95])
     alpha = np.corrcoef(X)[0,1]
     return alpha, ci
 
+def reliability_bootstrap(X, groups=None, B=1000, stats=('cronbach_alpha',), rng=None, chunk_size=None):
+    # bootstrap measures of agreement for groups of components
+    # X has P components (P rows) of N observations (N columns)
+    # groups is a list of tuples of row indices - by default, every pair of rows
+    # stats can include 'cronbach_alpha', 'kr20' and 'corrcoef' (only for pairs)
+    # a single set of resamples is drawn and shared by all groups and statistics
+    # each resample is stored as the number of times each observation was drawn,
+    # so the statistics are calculated from count-weighted sums of X
+    # returns an ordered dictionary mapping each statistic to a tuple of:
+    #   the statistic for each group on the full data, size (G,)
+    #   the statistic for each group on each resample, size (B, G)
+    X = np.asarray(X, dtype=float)
+    P, N = X.shape
+    if groups is None:
+        groups = [(p, q) for p in range(P) for q in range(p+1, P)]
+    groups = [list(g) for g in groups]
+    rng = np.random.default_rng(rng)
+
+    # by default, keep each chunk of resamples to ~5 million counts
+    if chunk_size is None:
+        chunk_size = max(1, int(5e6 // N))
+
+    # sum of the components in each group - needed for the variance of the total
+    X_total = np.vstack([np.sum(X[g,:], axis=0) for g in groups])
+
+    boot = OrderedDict([(s, list()) for s in stats])
+    for b in range(0, B, chunk_size):
+        n_boot = min(chunk_size, B - b)
+        idx = rng.integers(0, N, size=[n_boot, N]) + N*np.arange(n_boot)[:, np.newaxis]
+        counts = np.bincount(idx.ravel(), minlength=n_boot*N).reshape([n_boot, N])
+
+        stats_chunk = reliability_stats(counts, X, X_total, groups, stats)
+        for s in stats:
+            boot[s].append(stats_chunk[s])
+
+    # the full data corresponds to every observation being drawn once
+    est = reliability_stats(np.ones([1, N]), X, X_total, groups, stats)
+
+    out = OrderedDict()
+    for s in stats:
+        out[s] = (est[s][0,:], np.concatenate(boot[s], axis=0))
+    return out
+
+def reliability_stats(counts, X, X_total, groups, stats):
+    # calculate measures of agreement for each group of components of X, weighting
+    # observations by each row of counts (a B x N matrix of resample counts)
+    # returns a dictionary mapping each statistic to a (B, G) array
+    counts = counts.astype(float)
+    N = X.shape[1]
+
+    # first/second moments of each component and of each group total
+    S1 = np.dot(counts, np.transpose(X))
+    S2 = np.dot(counts, np.transpose(X**2))
+    T1 = np.dot(counts, np.transpose(X_total))
+    T2 = np.dot(counts, np.transpose(X_total**2))
+
+    # variances with ddof=1 - kr20 uses the population variance, rescaled below
+    var_comp = (S2 - S1**2/N) / (N-1)
+    var_total = (T2 - T1**2/N) / (N-1)
+    mean_comp = S1 / N
+
+    out = dict()
+    for s in stats:
+        out[s] = np.zeros([counts.shape[0], len(groups)])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, g in enumerate(groups):
+            K = len(g)
+            if 'cronbach_alpha' in stats:
+                out['cronbach_alpha'][:,i] = K / (K - 1.0) * (1.0 - np.sum(var_comp[:,g], axis=1) / var_total[:,i])
+            if 'kr20' in stats:
+                kr20_num = np.sum(mean_comp[:,g] * (1 - mean_comp[:,g]), axis=1)
+                kr20_var = var_total[:,i] * (N-1) / N
+                out['kr20'][:,i] = K / (K - 1.0) * (1 - kr20_num/kr20_var)
+            if 'corrcoef' in stats:
+                if K != 2:
+                    raise ValueError('corrcoef is only defined for pairs of components.')
+                # covariance of the pair recovered from the variance of their sum
+                cov = (var_total[:,i] - var_comp[:,g[0]] - var_comp[:,g[1]]) / 2.0
+                out['corrcoef'][:,i] = cov / np.sqrt(var_comp[:,g[0]] * var_comp[:,g[1]])
+    return out
+
+def reliability_bootstrap_pairs(X, B=1000, stats=('cronbach_alpha',), rng=None):
+    # bootstrap measures of agreement for every pair of rows of X
+    # returns an ordered dictionary mapping each statistic to a tuple of:
+    #   a P x P matrix of the statistic on the full data (upper triangle)
+    #   a P x P x 2 array of confidence intervals (percentile method)
+    P = np.shape(X)[0]
+    groups = [(p, q) for p in range(P) for q in range(p+1, P)]
+    res = reliability_bootstrap(X, groups=groups, B=B, stats=stats, rng=rng)
+
+    out = OrderedDict()
+    for s in stats:
+        est, boot = res[s]
+        est_mat = np.ones([P, P]) * np.nan
+        ci_mat = np.ones([P, P, 2]) * np.nan
+        ci = np.percentile(boot, [5,95], axis=0)
+        for i, (p, q) in enumerate(groups):
+            est_mat[p, q] = est[i]
+            ci_mat[p, q, :] = ci[:, i]
+        out[s] = (est_mat, ci_mat)
+    return out
+
 def print_auc_table(preds, target, preds_header, with_alpha=True):
     # prints a table of AUROCs and p-values like what was presented in the sepsis 3 paper
     y = target == 1
     P = len(preds)
 
+    # compare all available predictions at once - AUROCs and their covariance
+    # are only calculated once for the whole table
+    preds_avail = [x for x in preds_header if x in preds]
+    if len(preds_avail) == 0:
+        raise ValueError('None of the predictions in preds_header are in preds.')
+    res = ru.compare_auroc(np.column_stack([preds[x] for x in preds_avail]), y, alpha=0.05)
+
+    # cronbach alpha for every pair shares one set of bootstrap resamples
+    if with_alpha == True:
+        alpha_all, alpha_ci = reliability_bootstrap_pairs(
+            np.vstack([preds[x] for x in preds_avail]), B=2000)['cronbach_alpha']
+
     print('{:5s}'.format(''),end='\t')
 
     for p in range(P):
@@ -597,7 +856,8 @@ def print_auc_table(preds, target, preds_header, with_alpha=True):
             if ppred not in preds:
                 print('{:20s}'.format(''),end='\t') # skip this as we do not have the prediction
             elif p==q:
-                auc, ci = ru.calc_auc(preds[ppred], y, with_ci=True, alpha=0.05)
+                i = preds_avail.index(ppred)
+                auc, ci = res['auc'][i], res['ci'][i]
                 print('{:0.3f} [{:0.3f}, {:0.3f}]'.format(auc, ci[0], ci[1]), end='\t')
             elif qpred not in preds:
                 print('{:20s}'.format(''),end='\t') # skip this as we do not have the prediction
@@ -606,10 +866,11 @@ def print_auc_table(preds, target, preds_header, with_alpha=True):
                     # skip printing cronbach alpha as requested by input
                     print('{:20s}'.format(''),end='\t')
                 else:
-                    alpha, ci = cronbach_alpha_bootstrap(np.row_stack([preds[ppred],preds[qpred]]),B=2000)
+                    i, j = preds_avail.index(ppred), preds_avail.index(qpred)
+                    alpha, ci = alpha_all[i, j], alpha_ci[i, j]
                     print('{:0.3f} [{:0.3f}, {:0.3f}]'.format(alpha, ci[0], ci[1]), end='\t')
             else:
-                pval, ci = ru.test_auroc(preds[ppred], preds[qpred], y)
+                pval = res['pval'][preds_avail.index(ppred), preds_avail.index(qpred)]
                 if pval > 0.001:
                     print('{:0.3f}{:15s}'.format(pval, ''), end='\t')
                 else:
@@ -625,14 +886,21 @@ def print_auc_table_to_file(preds, target, preds_header=None, filename=None):
     if filename is None:
         filename = 'auc_table.csv'
 
-    f = open(filename,'w')
-
-
     if preds_header is None:
-        preds_header = preds.keys()
+        preds_header = list(preds.keys())
 
     P = len(preds_header)
     y = target == 1
+
+    # compare all available predictions at once - AUROCs and their covariance
+    # are only calculated once for the whole table
+    preds_avail = [x for x in preds_header if x in preds]
+    if len(preds_avail) == 0:
+        raise ValueError('None of the predictions in preds_header are in preds.')
+    res = ru.compare_auroc(np.column_stack([preds[x] for x in preds_avail]), y, alpha=0.05)
+
+    f = open(filename,'w')
+
     f.write('{}\t'.format(''))
 
     # print header line
@@ -648,7 +916,8 @@ def print_auc_table_to_file(preds, target, preds_header=None, filename=None):
             if pname not in preds:
                 f.write('{}\t'.format('')) # skip this as we do not have the prediction
             elif p==q:
-                auc, ci = ru.calc_auc(preds[pname], y, with_ci=True, alpha=0.05)
+                i = preds_avail.index(pname)
+                auc, ci = res['auc'][i], res['ci'][i]
                 f.write('{:0.3f} [{:0.3f}, {:0.3f}]\t'.format(auc, ci[0], ci[1]))
             elif q>p:
                 #TODO: cronenback alpha
@@ -658,7 +927,7 @@ def print_auc_table_to_file(preds, target, preds_header=None, filename=None):
                 if qname not in preds:
                     f.write('{}\t'.format('')) # skip this as we do not have the prediction
                 else:
-                    pval, ci = ru.test_auroc(preds[pname], preds[qname], y)
+                    pval = res['pval'][preds_avail.index(pname), preds_avail.index(qname)]
                     if pval > 0.001:
                         f.write('{:0.3f}{}\t'.format(pval, ''))
                     else:
@@ -677,6 +946,12 @@ def cronbach_alpha_table(df, preds_header, with_ci=True):
 
     df_out = pd.DataFrame(columns=preds_header)
 
+    # all pairs share one set of bootstrap resamples
+    preds_avail = [x for x in preds_header if x in df.columns]
+    if with_ci:
+        alpha_all, alpha_ci = reliability_bootstrap_pairs(
+            np.vstack([df[x].values for x in preds_avail]), B=100)['cronbach_alpha']
+
     for p in range(P):
         ppred = preds_header[p]
         for q in range(P):
@@ -685,7 +960,8 @@ def cronbach_alpha_table(df, preds_header, with_ci=True):
             qpred = preds_header[q]
             if (ppred in df.columns) and (qpred in df.columns) and (p<q):
                 if with_ci:
-                    alpha, ci = cronbach_alpha_bootstrap(np.row_stack([df[ppred].values,df[qpred].values]),B=100)
+                    i, j = preds_avail.index(ppred), preds_avail.index(qpred)
+                    alpha, ci = alpha_all[i, j], alpha_ci[i, j]
                     df_out.loc[ppred, qpred] = '{:0.2f} [{:0.2f}-{:0.2f}]'.format(alpha, ci[0], ci[1])
                 else:
                     alpha = cronbach_alpha(np.row_stack([df[ppred].values,df[qpred].values]))
@@ -696,6 +972,13 @@ def cronbach_alpha_table(df, preds_header, with_ci=True):
 def corrcoef_table(df, preds_header, with_ci=True, corr_type=None):
     # prints a table of AUROCs and p-values like what was presented in the sepsis 3 paper
     P = len(preds_header)
+
+    # all pairs share one set of bootstrap resamples
+    preds_avail = [x for x in preds_header if x in df.columns]
+    if corr_type != 'tetrachoric':
+        alpha_all, alpha_ci = reliability_bootstrap_pairs(
+            np.vstack([df[x].values for x in preds_avail]), B=100, stats=['corrcoef'])['corrcoef']
+
     print('{:8s}'.format(''),end='\t')
 
     for p in range(P):
@@ -715,8 +998,8 @@ def corrcoef_table(df, preds_header, with_ci=True, corr_type=None):
                 if corr_type == 'tetrachoric':
                     alpha, ci = corrcoef_bootstrap_tetrachoric(df[[ppred,qpred]],B=100)
                 else:
-                    alpha, ci = corrcoef_bootstrap(np.row_stack([df[ppred].values,df[qpred].values]),
-                    B=100)
+                    i, j = preds_avail.index(ppred), preds_avail.index(qpred)
+                    alpha, ci = alpha_all[i, j], alpha_ci[i, j]
                 print('{:0.2f} [{:0.2f}-{:0.2f}]'.format(alpha, ci[0], ci[1]), end=' ')
             else:
                 # skip this for any other reason
@@ -727,6 +1010,11 @@ def kr20_table(df, preds_header, with_ci=True):
     # prints a table of AUROCs and p-values like what was presented in the sepsis 3 paper
     P = len(preds_header)
 
+    # all pairs share one set of bootstrap resamples
+    preds_avail = [x for x in preds_header if x in df.columns]
+    alpha_all, alpha_ci = reliability_bootstrap_pairs(
+        np.vstack([df[x].values for x in preds_avail]), B=100, stats=['kr20'])['kr20']
+
     print('{:10s}'.format(''),end='\t')
 
     for p in range(P):
@@ -740,7 +1028,8 @@ def kr20_table(df, preds_header, with_ci=True):
         for q in range(P):
             qpred = preds_header[q]
             if (ppred in df.columns) and (qpred in df.columns) and (p<q):
-                alpha, ci = kr20_bootstrap(np.row_stack([df[ppred].values,df[qpred].values]),B=100)
+                i, j = preds_avail.index(ppred), preds_avail.index(qpred)
+                alpha, ci = alpha_all[i, j], alpha_ci[i, j]
                 print('{:0.3f} [{:0.3f}, {:0.3f}]'.format(alpha, ci[0], ci[1]), end='\t')
             else:
                 # skip this for any other reason
@@ -775,52 +1064,62 @@ def binomial_proportion_ci(numerator, denominator, alpha = 0.05):
     Calculate the confidence interval for a proportion of binomial counts.
     Confidence intervals calculated are symmetric.
 
-    Sourced from @Kurtis from
-    http://stackoverflow.com/questions/13059011/is-there-any-python-function-library-for-calculate-binomial-confidence-intervals
-    ... which was based upon: http://statpages.info/confint.html
-    ... which was further based upon:
+    This is the exact (Clopper-Pearson) interval, see binomial_proportion_cis:
         CJ Clopper and ES Pearson, "The use of confidence or fiducial limits
         illustrated in the case of the binomial." Biometrika. 26:404-413, 1934.
-
-        F Garwood, "Fiducial Limits for the Poisson Distribution" Biometrica.
-        28:437-442, 1936.
     '''
-    numerator = float(numerator)
-    denominator = float(denominator)
-    p = alpha/2
+    ci = binomial_proportion_cis(numerator, denominator, alpha=alpha)
+    return (ci[0,0], ci[0,1])
 
-    ratio = numerator/denominator
-    if numerator==0:
-            interval_low = 0.0
-    else:
-            v = ratio/2
-            vsL = 0
-            vsH = ratio
-
-            while((vsH-vsL) > 10**-5):
-                    if(binomial_proportion(denominator, v, numerator, denominator) > p):
-                            vsH = v
-                            v = (vsL+v)/2
-                    else:
-                            vsL = v
-                            v = (v+vsH)/2
-            interval_low = v
+def binomial_proportion_cis(numerator, denominator, alpha = 0.05, method='exact'):
+    '''
+    Calculate confidence intervals for many proportions of binomial counts at once.
+    numerator and denominator are arrays (or scalars) of counts.
+    Returns an array of size (M, 2) with the lower/upper limit of each interval.
+
+    method is one of:
+        'exact' - Clopper-Pearson interval, calculated from quantiles of the beta
+            distribution rather than by bisection.
+            CJ Clopper and ES Pearson, "The use of confidence or fiducial limits
+            illustrated in the case of the binomial." Biometrika. 26:404-413, 1934.
+        'wilson' - Wilson score interval.
+            EB Wilson, "Probable inference, the law of succession, and statistical
+            inference." JASA. 22:209-212, 1927.
+        'agresti-coull' - Agresti-Coull interval.
+            A Agresti and BA Coull, "Approximate is better than 'exact' for interval
+            estimation of binomial proportions." Am Stat. 52:119-126, 1998.
+    '''
+    x = np.atleast_1d(np.asarray(numerator, dtype=float))
+    n = np.atleast_1d(np.asarray(denominator, dtype=float))
+    x, n = np.broadcast_arrays(x, n)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'exact':
+            # beta quantiles are undefined at the boundaries, which are 0 and 1
+            interval_low = scipy.stats.beta.ppf(alpha/2, x, n-x+1)
+            interval_high = scipy.stats.beta.ppf(1-alpha/2, x+1, n-x)
+            interval_low = np.where(x==0, 0.0, interval_low)
+            interval_high = np.where(x==n, 1.0, interval_high)
+        elif method == 'wilson':
+            z = scipy.stats.norm.ppf(1-alpha/2)
+            centre = (x + z**2/2) / (n + z**2)
+            width = z / (n + z**2) * np.sqrt(x*(n-x)/n + z**2/4)
+            interval_low = np.clip(centre - width, 0.0, 1.0)
+            interval_high = np.clip(centre + width, 0.0, 1.0)
+        elif method == 'agresti-coull':
+            z = scipy.stats.norm.ppf(1-alpha/2)
+            n_adj = n + z**2
+            p_adj = (x + z**2/2) / n_adj
+            width = z * np.sqrt(p_adj*(1-p_adj)/n_adj)
+            interval_low = np.clip(p_adj - width, 0.0, 1.0)
+            interval_high = np.clip(p_adj + width, 0.0, 1.0)
+        else:
+            raise ValueError('Unrecognized method {}.'.format(method))
 
-    if numerator==denominator:
-            interval_high = 1.0
-    else:
-            v = (1+ratio)/2
-            vsL = ratio
-            vsH = 1
-            while((vsH-vsL) > 10**-5):
-                    if(binomial_proportion(denominator, v, 0, numerator) < p):
-                            vsH = v
-                            v = (vsL+v)/2
-                    else:
-                            vsL = v
-                            v = (v+vsH)/2
-            interval_high = v
-    return (interval_low, interval_high)
+    # proportions with no observations have no interval
+    ci = np.column_stack([interval_low, interval_high])
+    ci[n==0, :] = np.nan
+    return ci
 
 def create_grouped_hist(df, groups, idxA, strAdd=None, targetStr='hospital_expire_flag'):
     x = np.zeros([2*len(groups),])
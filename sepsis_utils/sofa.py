@@ -0,0 +1,503 @@
+# SOFA over arbitrary windows, computed in memory from the events of each ICU stay
+# this follows query/tbls/sofa-si.sql and the tables it reads (vitals_si, labs_si,
+# uo_si, gcs_si, bloodgasarterial_si, ventdurations and the vasopressor CTEs), but the
+# window is an input rather than being fixed when the tables are built
+#
+#   frames = get_sofa_events(con)
+#   events = sofa_events(frames)
+#   windows = si_windows(suspicion.suspicion_of_infection(...))
+#   df = sofa(events, windows)
+#
+# the events of each kind are sorted once by ICU stay and time, and a window is the
+# range [lo, hi) of events found by binary search - each aggregate is then a single
+# ufunc.reduceat over all windows, so sweeping many windows does not touch the database
+
+import numpy as np
+import pandas as pd
+
+from . import sepsis_extract_data as se
+from .suspicion import seconds
+
+HOUR = 3600
+
+# vasopressors, whose maximum rates are kept separately for carevue and metavision
+VASOPRESSORS = ('norepinephrine', 'epinephrine', 'dopamine', 'dobutamine')
+
+class EventArrays(object):
+    # events of one kind sorted by ICU stay and time
+    # columns are float arrays of values, with NaN for missing (null) values
+    def __init__(self, icustay_id, charttime, **columns):
+        icustay_id = np.asarray(icustay_id, dtype=np.int64)
+        t = seconds(charttime)
+        valid = np.asarray(pd.notnull(charttime))
+        icustay_id, t = icustay_id[valid], t[valid]
+        columns = dict([(c, np.asarray(v, dtype=float)[valid]) for c, v in columns.items()])
+
+        # keys combine the ICU stay and the time, with one second either side of the
+        # events of a stay so that a window can be clipped without reaching other stays
+        self.t0 = (t.min() if t.size > 0 else 0) - 1
+        self.span = (t.max() if t.size > 0 else 0) - self.t0 + 2
+        keys = icustay_id * self.span + (t - self.t0)
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.icustay_id = icustay_id[order]
+        self.t = t[order]
+        self.columns = dict([(c, v[order]) for c, v in columns.items()])
+
+    @classmethod
+    def from_frame(cls, df, columns, time='charttime'):
+        return cls(df['icustay_id'].values, df[time], **dict([(c, df[c].values) for c in columns]))
+
+    def __len__(self):
+        return self.keys.size
+
+    def window(self, icustay_id, starttime, endtime):
+        # the range [lo, hi) of events with starttime <= charttime <= endtime
+        icustay_id = np.asarray(icustay_id, dtype=np.int64)
+        start = seconds(starttime)
+        end = seconds(endtime)
+        valid = np.asarray(pd.notnull(starttime)) & np.asarray(pd.notnull(endtime)) & (start <= end)
+        base = icustay_id * self.span
+        start = np.clip(start - self.t0, 0, self.span - 1)
+        end = np.clip(end - self.t0, 0, self.span - 1)
+        lo = np.searchsorted(self.keys, base + start, side='left')
+        hi = np.searchsorted(self.keys, base + end, side='right')
+        hi[~valid] = lo[~valid]
+        return lo, hi
+
+    def count(self, column, lo, hi):
+        # the number of non-null values of a column in each window
+        notnull = np.concatenate([[0], np.cumsum(~np.isnan(self.columns[column]))])
+        return notnull[hi] - notnull[lo]
+
+def reduce_windows(ufunc, values, lo, hi):
+    # ufunc.reduce over values[lo:hi] for each window, or NaN if the window is empty
+    # reduceat over the interleaved (lo, hi) indices reduces each [lo, hi) segment, and a
+    # NaN is appended so that lo and hi can be the end of the array
+    values = np.append(values, np.nan)
+    if lo.size == 0:
+        return np.zeros(0)
+    res = ufunc.reduceat(values, np.stack([lo, hi], axis=1).ravel())[::2]
+    res[hi <= lo] = np.nan
+    return res
+
+def ventilated(icustay_id, charttime, ventdurations):
+    # whether each time is within a ventilation episode of the same ICU stay, i.e.
+    # starttime <= charttime <= endtime, as pafi1 in sofa-si.sql
+    # ventdurations is a dataframe with icustay_id, starttime and endtime
+    vd = ventdurations.loc[ventdurations['starttime'].notnull() & ventdurations['endtime'].notnull()]
+    vd = vd.sort_values(['icustay_id', 'starttime'], kind='mergesort')
+    t = seconds(charttime)
+    if len(vd) == 0:
+        return np.zeros(t.size, dtype=bool)
+    # the latest end of the episodes started so far in the stay, in case they overlap
+    end = pd.Series(seconds(vd['endtime']), index=vd.index).groupby(vd['icustay_id']).cummax()
+
+    ep = EventArrays(vd['icustay_id'].values, vd['starttime'])
+    icustay_id = np.asarray(icustay_id, dtype=np.int64)
+    key = icustay_id * ep.span + np.clip(t - ep.t0, 0, ep.span - 1)
+    j = np.searchsorted(ep.keys, key, side='right') - 1
+    found = j >= 0
+    found[found] = (ep.icustay_id[j[found]] == icustay_id[found]) \
+        & (end.values[j[found]] >= t[found])
+    return found
+
+def gcs_totals(icustay_id, charttime, motor, verbal, eyes):
+    # the GCS of each charted time, as gcs-infect-time.sql, with a verbal score of 0 for
+    # an intubated patient - rows must be sorted by ICU stay and time, one per time
+    # returns (gcs, gcs_first): gcs uses the previous row of the stay if it is within
+    # 6 hours, and gcs_first is the GCS of a row which is the first of its window
+    motor, verbal, eyes = [np.asarray(v, dtype=float) for v in (motor, verbal, eyes)]
+    icustay_id = np.asarray(icustay_id)
+    t = seconds(charttime)
+
+    prev = np.ones(t.size, dtype=bool)
+    if t.size > 0:
+        prev[0] = False
+    prev[1:] = (icustay_id[1:] == icustay_id[:-1]) & (t[:-1] > t[1:] - 6*HOUR)
+    shift = lambda v: np.where(prev, np.concatenate([[np.nan], v[:-1]]), np.nan)
+    motor_prev, verbal_prev, eyes_prev = shift(motor), shift(verbal), shift(eyes)
+
+    fill = lambda v, default: np.where(np.isnan(v), default, v)
+    # no previous value, or the previous value was while intubated
+    gcs_own = fill(motor, 6) + fill(verbal, 5) + fill(eyes, 4)
+    gcs = np.select(
+        [verbal == 0, np.isnan(verbal) & (verbal_prev == 0), verbal_prev == 0],
+        [15, 15, gcs_own],
+        fill(motor, fill(motor_prev, 6)) + fill(verbal, fill(verbal_prev, 5))
+        + fill(eyes, fill(eyes_prev, 4)))
+    gcs_first = np.where(verbal == 0, 15, gcs_own)
+    return gcs, gcs_first
+
+def min_gcs(ev, icustay_id, starttime, endtime, reduce=reduce_windows):
+    # the lowest GCS in each window - the first GCS of a window has no previous value
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    first = reduce(np.fmin, ev.columns['gcs_first'], lo, np.minimum(lo + 1, hi))
+    rest = reduce(np.fmin, ev.columns['gcs'], np.minimum(lo + 1, hi), hi)
+    return np.fmin(first, rest)
+
+# arterial blood gases over the whole of each hospitalization, as bloodgas_si and
+# bloodgasarterial_si (query/tbls/blood-gas-infect-time.sql and
+# blood-gas-arterial-infect-time.sql) without restricting them to a window - samples
+# without a specimen type are arterial if the specimen prediction is above 0.75
+BLOODGAS_ARTERIAL_QUERY = """
+with bg as
+(
+select ie.icustay_id, le.charttime
+  , max(case when itemid = 50800 then value end) as specimen
+  , max(case when itemid = 50801 and valuenum > 0 then valuenum end) as aado2
+  , max(case when itemid = 50803 and valuenum > 0 then valuenum end) as bicarbonate
+  , max(case when itemid = 50804 and valuenum > 0 then valuenum end) as totalco2
+  , max(case when itemid = 50811 and valuenum > 0 then valuenum end) as hemoglobin
+  , max(case when itemid = 50813 and valuenum > 0 then valuenum end) as lactate
+  , max(case when itemid = 50815 and valuenum > 0 and valuenum <= 70 then valuenum end) as o2flow
+  , max(case when itemid = 50816 and valuenum > 0 and valuenum <= 100 then valuenum end) as fio2
+  , max(case when itemid = 50817 and valuenum > 0 and valuenum <= 100 then valuenum end) as so2
+  , max(case when itemid = 50818 and valuenum > 0 then valuenum end) as pco2
+  , max(case when itemid = 50820 and valuenum > 0 then valuenum end) as ph
+  , max(case when itemid = 50821 and valuenum > 0 and valuenum <= 800 then valuenum end) as po2
+from icustays ie
+inner join labevents le
+  on le.hadm_id = ie.hadm_id
+where le.itemid in (50800, 50801, 50803, 50804, 50811, 50813, 50815, 50816, 50817, 50818,
+                    50820, 50821)
+group by ie.icustay_id, le.charttime
+)
+, stg_spo2 as
+(
+  select icustay_id, charttime
+    , max(case when valuenum <= 0 or valuenum > 100 then null else valuenum end) as spo2
+  from chartevents
+  where itemid in (646, 220277)
+  and error is distinct from 1
+  group by icustay_id, charttime
+)
+, stg_fio2 as
+(
+  select icustay_id, charttime
+    , max(
+        case
+          when itemid = 223835
+            then case
+              when valuenum > 0 and valuenum <= 1 then valuenum * 100
+              when valuenum >= 21 and valuenum <= 100 then valuenum
+              else null end
+          when itemid in (3420, 3422) then valuenum
+          when itemid = 190 and valuenum > 0.20 and valuenum < 1 then valuenum * 100
+        else null end
+    ) as fio2_chartevents
+  from chartevents
+  where itemid in (3420, 190, 223835, 3422)
+  and error is distinct from 1
+  group by icustay_id, charttime
+)
+, stg2 as
+(
+select bg.*
+  , row_number() over (partition by bg.icustay_id, bg.charttime order by s1.charttime desc)
+    as lastrowspo2
+  , s1.spo2
+from bg
+left join stg_spo2 s1
+  on  bg.icustay_id = s1.icustay_id
+  and s1.charttime between bg.charttime - interval '2' hour and bg.charttime
+where bg.po2 is not null
+)
+, stg3 as
+(
+select bg.*
+  , row_number() over (partition by bg.icustay_id, bg.charttime order by s2.charttime desc)
+    as lastrowfio2
+  , s2.fio2_chartevents
+  ,  1/(1+exp(-(-0.02544
+  +    0.04598 * po2
+  + coalesce(-0.15356 * spo2             , -0.15356 *   97.49420 +    0.13429)
+  + coalesce( 0.00621 * fio2_chartevents ,  0.00621 *   51.49550 +   -0.24958)
+  + coalesce( 0.10559 * hemoglobin       ,  0.10559 *   10.32307 +    0.05954)
+  + coalesce( 0.13251 * so2              ,  0.13251 *   93.66539 +   -0.23172)
+  + coalesce(-0.01511 * pco2             , -0.01511 *   42.08866 +   -0.01630)
+  + coalesce( 0.01480 * fio2             ,  0.01480 *   63.97836 +   -0.31142)
+  + coalesce(-0.00200 * aado2            , -0.00200 *  442.21186 +   -0.01328)
+  + coalesce(-0.03220 * bicarbonate      , -0.03220 *   22.96894 +   -0.06535)
+  + coalesce( 0.05384 * totalco2         ,  0.05384 *   24.72632 +   -0.01405)
+  + coalesce( 0.08202 * lactate          ,  0.08202 *    3.06436 +    0.06038)
+  + coalesce( 0.10956 * ph               ,  0.10956 *    7.36233 +   -0.00617)
+  + coalesce( 0.00848 * o2flow           ,  0.00848 *    7.59362 +   -0.35803)
+  ))) as specimen_prob
+from stg2 bg
+left join stg_fio2 s2
+  on  bg.icustay_id = s2.icustay_id
+  and s2.charttime between bg.charttime - interval '4' hour and bg.charttime
+where bg.lastrowspo2 = 1
+)
+select icustay_id, charttime
+  , case
+      when specimen is not null then specimen
+      when specimen_prob > 0.75 then 'ART'
+    end as specimen_pred
+  , pco2
+  , case
+      when po2 is not null and coalesce(fio2, fio2_chartevents) is not null
+        then 100*po2/(coalesce(fio2, fio2_chartevents))
+    end as pao2fio2
+from stg3
+where lastrowfio2 = 1
+and (specimen = 'ART' or specimen_prob > 0.75)
+"""
+
+def get_sofa_events(con, bloodgas_table=None):
+    # read the events used by sofa from the database, over the whole of each ICU stay
+    # returns a dictionary of dataframes, see sofa_events
+    # blood gases are the arterial blood gases of the whole hospitalization (see
+    # BLOODGAS_ARTERIAL_QUERY), or are read from bloodgas_table if given, a table with
+    # icustay_id, charttime, pao2fio2, pco2 and specimen_pred - a table such as
+    # bloodgasfirstdayarterial only covers the times it was built for
+    frames = dict()
+    frames['meanbp'] = se.read_sql(con, """
+    select icustay_id, charttime, valuenum as meanbp
+    from chartevents
+    where itemid in (456,52,6702,443,220052,220181,225312)
+    and valuenum > 0 and valuenum < 300
+    and error is distinct from 1
+    """, name='sofa_meanbp')
+
+    # labs are charted for the hospitalization, and apply to each of its ICU stays
+    frames['labs'] = se.read_sql(con, """
+    select ie.icustay_id, le.charttime
+      , case when itemid = 50912 and valuenum <= 150 then valuenum end as creatinine
+      , case when itemid = 50885 and valuenum <= 150 then valuenum end as bilirubin
+      , case when itemid = 51265 and valuenum <= 10000 then valuenum end as platelet
+    from icustays ie
+    inner join labevents le
+      on le.hadm_id = ie.hadm_id
+    where le.itemid in (50912, 50885, 51265)
+    and valuenum is not null and valuenum > 0
+    """, name='sofa_labs')
+
+    frames['urine'] = se.read_sql(con, """
+    select icustay_id, charttime, value as urineoutput
+    from outputevents
+    where itemid in
+    (
+    40055, 43175, 40069, 40094, 40715, 40473, 40085, 40057, 40056, 40405, 40428, 40086
+    , 40096, 40651
+    , 226559, 226560, 227510, 226561, 226584, 226563, 226564, 226565, 226567, 226557
+    , 226558
+    )
+    """, name='sofa_urine')
+
+    # the GCS components of each charted time, with a verbal score of 0 when intubated
+    frames['gcs'] = se.read_sql(con, """
+    select icustay_id, charttime
+      , max(case when itemid in (454,223901) then valuenum end) as gcsmotor
+      , max(case
+              when itemid = 723 and value = '1.0 ET/Trach' then 0
+              when itemid = 223900 and value = 'No Response-ETT' then 0
+              when itemid in (723,223900) then valuenum
+            end) as gcsverbal
+      , max(case when itemid in (184,220739) then valuenum end) as gcseyes
+    from chartevents
+    where itemid in (184, 454, 723, 223900, 223901, 220739)
+    and error is distinct from 1
+    group by icustay_id, charttime
+    """, name='sofa_gcs')
+
+    if bloodgas_table is None:
+        frames['bloodgas'] = se.read_sql(con, BLOODGAS_ARTERIAL_QUERY, name='sofa_bloodgas')
+    else:
+        frames['bloodgas'] = se.read_sql(con, """
+        select icustay_id, charttime, specimen_pred, pco2, pao2fio2
+        from """ + bloodgas_table, name='sofa_bloodgas')
+    frames['ventdurations'] = se.read_sql(con, """
+    select icustay_id, starttime, endtime from ventdurations
+    """, name='sofa_ventdurations')
+
+    # vasopressor rates in mcg/kg/min - carevue rates in mcg/min are divided by weight
+    frames['vasopressors'] = se.read_sql(con, """
+    select cv.icustay_id, cv.charttime, 'cv' as source
+      , case
+          when itemid in (30047,30120) then 'norepinephrine'
+          when itemid in (30044,30119,30309) then 'epinephrine'
+          when itemid in (30043,30307) then 'dopamine'
+          when itemid in (30042,30306) then 'dobutamine'
+        end as drug
+      , case when itemid in (30047,30044) then rate / wt.weight else rate end as rate
+    from inputevents_cv cv
+    left join weightfirstday wt
+      on cv.icustay_id = wt.icustay_id
+    where itemid in (30047,30120,30044,30119,30309,30043,30307,30042,30306)
+    and rate is not null
+    union all
+    select icustay_id, starttime as charttime, 'mv' as source
+      , case
+          when itemid = 221906 then 'norepinephrine'
+          when itemid = 221289 then 'epinephrine'
+          when itemid = 221662 then 'dopamine'
+          when itemid = 221653 then 'dobutamine'
+        end as drug
+      , rate
+    from inputevents_mv
+    where itemid in (221906,221289,221662,221653)
+    and statusdescription != 'Rewritten'
+    """, name='sofa_vasopressors')
+    return frames
+
+def sofa_events(frames):
+    # sort the events of each kind for sofa, from a dictionary of dataframes:
+    #   meanbp        - icustay_id, charttime, meanbp
+    #   labs          - icustay_id, charttime, creatinine, bilirubin, platelet
+    #   urine         - icustay_id, charttime, urineoutput
+    #   gcs           - icustay_id, charttime, gcsmotor, gcsverbal, gcseyes (one row per time)
+    #   bloodgas      - icustay_id, charttime, pao2fio2 (arterial blood gases, with NaN
+    #                   where the FiO2 is unknown)
+    #   ventdurations - icustay_id, starttime, endtime
+    #   vasopressors  - icustay_id, charttime, source ('cv' or 'mv'), drug, rate
+    # missing frames are treated as having no events
+    empty = lambda columns: pd.DataFrame(dict([(c, []) for c in ['icustay_id', 'charttime'] + columns]))
+    get = lambda name, columns: frames[name] if name in frames else empty(columns)
+    events = dict()
+    events['meanbp'] = EventArrays.from_frame(get('meanbp', ['meanbp']), ['meanbp'])
+    events['labs'] = EventArrays.from_frame(get('labs', ['creatinine', 'bilirubin', 'platelet']),
+                                            ['creatinine', 'bilirubin', 'platelet'])
+    events['urine'] = EventArrays.from_frame(get('urine', ['urineoutput']), ['urineoutput'])
+
+    gcs = get('gcs', ['gcsmotor', 'gcsverbal', 'gcseyes'])
+    gcs = gcs.loc[gcs['charttime'].notnull()].sort_values(['icustay_id', 'charttime'], kind='mergesort')
+    total, first = gcs_totals(gcs['icustay_id'].values, gcs['charttime'], gcs['gcsmotor'].values,
+                              gcs['gcsverbal'].values, gcs['gcseyes'].values)
+    events['gcs'] = EventArrays(gcs['icustay_id'].values, gcs['charttime'], gcs=total,
+                                gcs_first=first)
+
+    # the lowest PaO2/FiO2 is kept separately for ventilated and unventilated patients
+    bg = get('bloodgas', ['pao2fio2'])
+    vd = frames['ventdurations'] if 'ventdurations' in frames \
+        else pd.DataFrame({'icustay_id': [], 'starttime': [], 'endtime': []})
+    vent = ventilated(bg['icustay_id'].values, bg['charttime'], vd)
+    pf = bg['pao2fio2'].values.astype(float)
+    events['bloodgas'] = EventArrays(bg['icustay_id'].values, bg['charttime'],
+                                     pao2fio2_vent=np.where(vent, pf, np.nan),
+                                     pao2fio2_novent=np.where(vent, np.nan, pf))
+
+    va = get('vasopressors', ['source', 'drug', 'rate'])
+    rate = va['rate'].values.astype(float)
+    events['vasopressors'] = EventArrays(va['icustay_id'].values, va['charttime'], **dict([
+        ('rate_' + d + '_' + s,
+         np.where((va['drug'] == d).values & (va['source'] == s).values, rate, np.nan))
+        for d in VASOPRESSORS for s in ('cv', 'mv')]))
+    return events
+
+def si_windows(suspinfect, before=48, after=24):
+    # windows around the suspected infection time, as si_starttime and si_endtime, which
+    # were 48 hours before and 24 hours after suspected infection
+    si = suspinfect.loc[suspinfect['suspected_infection_time'].notnull()]
+    t = pd.to_datetime(si['suspected_infection_time'])
+    return pd.DataFrame({'icustay_id': si['icustay_id'].values,
+                         'starttime': (t - pd.Timedelta(hours=before)).values,
+                         'endtime': (t + pd.Timedelta(hours=after)).values})
+
+def sofa_components(events, windows, reduce=reduce_windows):
+    # aggregate the events in each window, as the scorecomp CTE of sofa-si.sql
+    # windows is a dataframe with icustay_id, starttime and endtime - a stay may have
+    # any number of windows, and the events are included if starttime <= charttime <= endtime
+    # reduce(ufunc, values, lo, hi) aggregates values over each window [lo, hi), see
+    # rolling.rolling_reduce for windows which slide forward in time
+    icustay_id = windows['icustay_id'].values
+    starttime, endtime = windows['starttime'], windows['endtime']
+    comp = pd.DataFrame({'icustay_id': icustay_id, 'starttime': starttime.values,
+                         'endtime': endtime.values})
+
+    ev = events['meanbp']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    comp['meanbp_min'] = reduce(np.fmin, ev.columns['meanbp'], lo, hi)
+
+    ev = events['vasopressors']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    for d in VASOPRESSORS:
+        cv = reduce(np.fmax, ev.columns['rate_' + d + '_cv'], lo, hi)
+        mv = reduce(np.fmax, ev.columns['rate_' + d + '_mv'], lo, hi)
+        comp['rate_' + d] = np.where(np.isnan(cv), mv, cv)
+
+    ev = events['labs']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    comp['creatinine_max'] = reduce(np.fmax, ev.columns['creatinine'], lo, hi)
+    comp['bilirubin_max'] = reduce(np.fmax, ev.columns['bilirubin'], lo, hi)
+    comp['platelet_min'] = reduce(np.fmin, ev.columns['platelet'], lo, hi)
+
+    ev = events['bloodgas']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    comp['pao2fio2_novent_min'] = reduce(np.fmin, ev.columns['pao2fio2_novent'], lo, hi)
+    comp['pao2fio2_vent_min'] = reduce(np.fmin, ev.columns['pao2fio2_vent'], lo, hi)
+
+    # daily urine output, from the first to the last urine output of the window
+    ev = events['urine']
+    lo, hi = ev.window(icustay_id, starttime, endtime)
+    total = reduce(np.add, np.nan_to_num(ev.columns['urineoutput']), lo, hi)
+    total[ev.count('urineoutput', lo, hi) == 0] = np.nan
+    first = ev.t[np.minimum(lo, len(ev) - 1)] if len(ev) > 0 else np.zeros(lo.size)
+    last = ev.t[np.maximum(hi - 1, 0)] if len(ev) > 0 else np.zeros(lo.size)
+    days = np.where(hi - lo > 1, (last - first) / 60.0 / 60.0 / 24.0, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        comp['urineoutput'] = np.where(days > 0, total / days, np.nan)
+
+    comp['mingcs'] = min_gcs(events['gcs'], icustay_id, starttime, endtime, reduce=reduce)
+    return comp
+
+def score(conditions, choices, null):
+    # a CASE statement: the first true condition, else null where null is true, else 0
+    # scores are float, with NaN as null
+    return pd.Series(np.select(conditions + [null], choices + [np.nan], 0).astype(float))
+
+def sofa_scores(comp):
+    # score the components, as the scorecalc CTE and final select of sofa-si.sql
+    # a subscore is null if its data is missing, and the total treats it as 0
+    c = dict([(k, comp[k].values.astype(float)) for k in comp.columns
+              if k not in ('icustay_id', 'starttime', 'endtime')])
+    missing = lambda *names: np.all([np.isnan(c[n]) for n in names], axis=0)
+
+    scores = pd.DataFrame({'icustay_id': comp['icustay_id'].values,
+                           'starttime': comp['starttime'].values,
+                           'endtime': comp['endtime'].values})
+    scores['respiration'] = score(
+        [c['pao2fio2_vent_min'] < 100, c['pao2fio2_vent_min'] < 200,
+         c['pao2fio2_novent_min'] < 300, c['pao2fio2_novent_min'] < 400],
+        [4, 3, 2, 1], missing('pao2fio2_vent_min', 'pao2fio2_novent_min'))
+
+    scores['coagulation'] = score(
+        [c['platelet_min'] < 20, c['platelet_min'] < 50, c['platelet_min'] < 100,
+         c['platelet_min'] < 150],
+        [4, 3, 2, 1], missing('platelet_min'))
+
+    scores['liver'] = score(
+        [c['bilirubin_max'] >= 12.0, c['bilirubin_max'] >= 6.0, c['bilirubin_max'] >= 2.0,
+         c['bilirubin_max'] >= 1.2],
+        [4, 3, 2, 1], missing('bilirubin_max'))
+
+    scores['cardiovascular'] = score(
+        [(c['rate_dopamine'] > 15) | (c['rate_epinephrine'] > 0.1)
+         | (c['rate_norepinephrine'] > 0.1),
+         (c['rate_dopamine'] > 5) | (c['rate_epinephrine'] <= 0.1)
+         | (c['rate_norepinephrine'] <= 0.1),
+         (c['rate_dopamine'] > 0) | (c['rate_dobutamine'] > 0),
+         c['meanbp_min'] < 70],
+        [4, 3, 2, 1], missing('meanbp_min', 'rate_dopamine', 'rate_dobutamine',
+                              'rate_epinephrine', 'rate_norepinephrine'))
+
+    gcs = c['mingcs']
+    scores['cns'] = score(
+        [(gcs >= 13) & (gcs <= 14), (gcs >= 10) & (gcs <= 12), (gcs >= 6) & (gcs <= 9),
+         gcs < 6],
+        [1, 2, 3, 4], missing('mingcs'))
+
+    cr, uo = c['creatinine_max'], c['urineoutput']
+    scores['renal'] = score(
+        [cr >= 5.0, uo < 200, (cr >= 3.5) & (cr < 5.0), uo < 500, (cr >= 2.0) & (cr < 3.5),
+         (cr >= 1.2) & (cr < 2.0)],
+        [4, 4, 3, 3, 2, 1], missing('creatinine_max', 'urineoutput'))
+
+    organs = ['respiration', 'coagulation', 'liver', 'cardiovascular', 'cns', 'renal']
+    scores.insert(3, 'sofa', scores[organs].fillna(0).sum(axis=1).astype(int))
+    return scores
+
+def sofa(events, windows, reduce=reduce_windows):
+    # the SOFA score and its six subscores for each window, see sofa_components
+    return sofa_scores(sofa_components(events, windows, reduce=reduce))
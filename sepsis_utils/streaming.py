@@ -0,0 +1,544 @@
+# Sepsis-3 surveillance over a feed of events, one event at a time
+# suspicion of infection follows suspinfect_poe (see suspicion.py), and qSOFA and SOFA
+# are scored over the window 48 hours before to 24 hours after suspected infection, as
+# qsofa-si.sql and sofa-si.sql (see sofa.py) - an alert is emitted when suspicion of
+# infection is first known, and when qSOFA >= 2 or SOFA >= 2 (Sepsis-3) in its window
+# alerts are never withdrawn, so they only use scores which cannot go down as more of
+# the window is seen: daily urine output is extrapolated from the part of the window
+# seen so far, so the renal subscore of the sepsis3 alert only uses creatinine until
+# the window has closed, i.e. an event after its end arrives (or flush is called)
+#
+#   monitor = Sepsis3Monitor(antibiotics=suspicion.antibiotic_drugs(prescriptions))
+#   for alert in monitor.run(event_feed(icustays, chartevents, ...)):
+#       print(alert)
+#
+# events are tuples (time, kind, id, itemid, value, valuenum), ordered by time (seconds):
+#   icustay      - id is icustay_id, value is hadm_id and valuenum the weight (kg)
+#   discharge    - id is icustay_id, the state of the stay is dropped
+#   hospital_discharge - id is hadm_id, the state of the hospitalization is dropped
+#   chart        - id is icustay_id, a chartevents row (vital signs and GCS)
+#   output       - id is icustay_id, an outputevents row, with the volume as valuenum
+#   bloodgas     - id is icustay_id, valuenum is the PaO2/FiO2 of an arterial blood gas
+#                  and value is True if the patient was ventilated
+#   vasopressor  - id is icustay_id, an inputevents_cv/mv row, with the rate as valuenum
+#   lab          - id is hadm_id, a labevents row
+#   prescription - id is hadm_id, value is the drug
+#   culture      - id is hadm_id, a culture with a charttime, value is the specimen and
+#                  valuenum is 1 if an organism grew
+#   culture_date - as culture, for a culture with only a chartdate
+#
+# each stay and hospitalization keeps the events of the last lookback seconds, as the
+# suspected infection time can be up to 96 hours before the antibiotic which reveals
+# it, and the window starts 48 hours before that
+# a hospitalization which has had an ICU stay is kept until its hospital_discharge, so
+# that a later ICU stay shares its suspected infection time (as abx_micro_poe), and
+# one which has not is dropped once it has had no events for lookback seconds - so
+# memory is bounded by the active hospitalizations
+# once suspected infection is known, each event in its window updates a running
+# minimum or maximum, and the scores are recomputed only if an aggregate changed
+
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .suspicion import seconds
+
+HOUR = 3600
+NAN = float('nan')
+
+# itemid: (variable, lower, upper), for valuenum strictly between lower and upper
+CHART_ITEMS = dict(
+    [(i, ('meanbp', 0, 300)) for i in (456, 52, 6702, 443, 220052, 220181, 225312)]
+    + [(i, ('sysbp', 0, 400)) for i in (51, 442, 455, 6701, 220179, 220050)]
+    + [(i, ('resprate', 0, 70)) for i in (615, 618, 220210, 224690)])
+# GCS components: the index of the component (motor, verbal, eyes), and the values of
+# the verbal component which mean the patient is intubated
+GCS_ITEMS = {454: 0, 223901: 0, 723: 1, 223900: 1, 184: 2, 220739: 2}
+GCS_INTUBATED = {723: '1.0 ET/Trach', 223900: 'No Response-ETT'}
+# itemid: (variable, upper)
+LAB_ITEMS = {50912: ('creatinine', 150), 50885: ('bilirubin', 150), 51265: ('platelet', 10000)}
+URINE_ITEMS = frozenset([40055, 43175, 40069, 40094, 40715, 40473, 40085, 40057, 40056, 40405,
+                         40428, 40086, 40096, 40651, 226559, 226560, 227510, 226561, 226584,
+                         226563, 226564, 226565, 226567, 226557, 226558])
+# itemid: (variable, True if the rate is per minute and is divided by the weight)
+VASO_ITEMS = dict(
+    [(30047, ('rate_norepinephrine_cv', True)), (30120, ('rate_norepinephrine_cv', False)),
+     (30044, ('rate_epinephrine_cv', True)), (30119, ('rate_epinephrine_cv', False)),
+     (30309, ('rate_epinephrine_cv', False)), (30043, ('rate_dopamine_cv', False)),
+     (30307, ('rate_dopamine_cv', False)), (30042, ('rate_dobutamine_cv', False)),
+     (30306, ('rate_dobutamine_cv', False)), (221906, ('rate_norepinephrine_mv', False)),
+     (221289, ('rate_epinephrine_mv', False)), (221662, ('rate_dopamine_mv', False)),
+     (221653, ('rate_dobutamine_mv', False))])
+
+# aggregates which are a minimum - the others are a maximum
+MINIMUM = frozenset(['meanbp', 'sysbp', 'platelet', 'pao2fio2_vent', 'pao2fio2_novent', 'gcs'])
+STAY_VARIABLES = ['meanbp', 'sysbp', 'resprate', 'pao2fio2_vent', 'pao2fio2_novent'] \
+    + sorted(set([v for v, _ in VASO_ITEMS.values()]))
+LAB_VARIABLES = ['creatinine', 'bilirubin', 'platelet']
+
+Alert = namedtuple('Alert', ['time', 'icustay_id', 'alert', 'suspected_infection_time',
+                             'qsofa', 'sofa'])
+NO_ALERTS = ()
+
+def qsofa_score(a):
+    # qSOFA from the aggregates of a window, as qsofa-si.sql (NaN is null)
+    sysbp, gcs, resprate = a['sysbp'], a['gcs'], a['resprate']
+    return (sysbp <= 100) + (gcs <= 13) + (resprate >= 22)
+
+def sofa_subscores(a, urineoutput):
+    # the six SOFA subscores from the aggregates of a window, as sofa-si.sql
+    # a subscore is None if its data is missing
+    vent, novent = a['pao2fio2_vent'], a['pao2fio2_novent']
+    respiration = 4 if vent < 100 else 3 if vent < 200 else 2 if novent < 300 \
+        else 1 if novent < 400 else None if vent != vent and novent != novent else 0
+
+    platelet = a['platelet']
+    coagulation = 4 if platelet < 20 else 3 if platelet < 50 else 2 if platelet < 100 \
+        else 1 if platelet < 150 else None if platelet != platelet else 0
+
+    bilirubin = a['bilirubin']
+    liver = 4 if bilirubin >= 12.0 else 3 if bilirubin >= 6.0 else 2 if bilirubin >= 2.0 \
+        else 1 if bilirubin >= 1.2 else None if bilirubin != bilirubin else 0
+
+    rate = dict()
+    for d in ('norepinephrine', 'epinephrine', 'dopamine', 'dobutamine'):
+        cv = a['rate_' + d + '_cv']
+        rate[d] = a['rate_' + d + '_mv'] if cv != cv else cv
+    meanbp = a['meanbp']
+    if rate['dopamine'] > 15 or rate['epinephrine'] > 0.1 or rate['norepinephrine'] > 0.1:
+        cardiovascular = 4
+    elif rate['dopamine'] > 5 or rate['epinephrine'] <= 0.1 or rate['norepinephrine'] <= 0.1:
+        cardiovascular = 3
+    elif rate['dopamine'] > 0 or rate['dobutamine'] > 0:
+        cardiovascular = 2
+    elif meanbp < 70:
+        cardiovascular = 1
+    elif all([v != v for v in [meanbp] + list(rate.values())]):
+        cardiovascular = None
+    else:
+        cardiovascular = 0
+
+    gcs = a['gcs']
+    cns = 1 if 13 <= gcs <= 14 else 2 if 10 <= gcs <= 12 else 3 if 6 <= gcs <= 9 \
+        else 4 if gcs < 6 else None if gcs != gcs else 0
+
+    renal = renal_score(a['creatinine'], urineoutput)
+    return respiration, coagulation, liver, cardiovascular, cns, renal
+
+def renal_score(cr, uo):
+    # the renal SOFA subscore from the maximum creatinine and the daily urine output
+    return 4 if cr >= 5.0 else 4 if uo < 200 else 3 if 3.5 <= cr < 5.0 else 3 if uo < 500 \
+        else 2 if 2.0 <= cr < 3.5 else 1 if 1.2 <= cr < 2.0 \
+        else None if cr != cr and uo != uo else 0
+
+class Admission(object):
+    # the hospitalization level state: antibiotics, cultures and labs apply to its stays
+    __slots__ = ['stays', 'cultures', 'labs', 'suspected_infection_time', 'had_stay',
+                 'last_time']
+
+    def __init__(self):
+        self.stays = list()
+        self.cultures = deque()
+        self.labs = dict([(v, deque()) for v in LAB_VARIABLES])
+        self.suspected_infection_time = None
+        self.had_stay = False
+        self.last_time = None
+
+class Stay(object):
+    # the ICU stay level state
+    __slots__ = ['icustay_id', 'hadm_id', 'weight', 'buffers', 'urine', 'gcs', 'gcs_row',
+                 'gcs_last', 'start', 'end', 'closed', 'agg', 'urine_agg', 'qsofa', 'sofa',
+                 'subscores', 'alerted']
+
+    def __init__(self, icustay_id, hadm_id, weight):
+        self.icustay_id = icustay_id
+        self.hadm_id = hadm_id
+        self.weight = weight
+        self.buffers = dict([(v, deque()) for v in STAY_VARIABLES])
+        self.urine = deque()
+        # finished GCS rows (time, gcs, gcs if first in the window, time of previous row)
+        self.gcs = deque()
+        # the GCS components of the latest charted time, and the previous row
+        self.gcs_row = None
+        self.gcs_last = None
+        # the window around suspected infection, and its aggregates
+        self.start = None
+        self.end = None
+        self.closed = False
+        self.agg = None
+        self.urine_agg = None
+        self.qsofa = None
+        self.sofa = None
+        self.subscores = None
+        self.alerted = set()
+
+class Sepsis3Monitor(object):
+    # antibiotics - the drugs in abx_poe_list
+    # before, after - the window around suspected infection, in hours
+    def __init__(self, antibiotics, before=48, after=24):
+        self.antibiotics = frozenset(antibiotics)
+        self.before = before * HOUR
+        self.after = after * HOUR
+        self.lookback = 96 * HOUR + self.before
+        self.stays = dict()
+        self.admissions = dict()
+        self.next_sweep = None
+
+    def run(self, events):
+        # process a feed of events, yielding alerts as they are emitted
+        process = self.process
+        for event in events:
+            alerts = process(event)
+            if alerts:
+                for alert in alerts:
+                    yield alert
+
+    def process(self, event):
+        # process one event, returning a tuple of the alerts it caused
+        t, kind, i, itemid, value, valuenum = event
+        if self.next_sweep is None or t >= self.next_sweep:
+            self.sweep(t)
+        if kind == 'chart':
+            st = self.stays.get(i)
+            if st is None:
+                return NO_ALERTS
+            alerts = self.advance(st, t)
+            item = CHART_ITEMS.get(itemid)
+            if item is not None:
+                if item[1] < valuenum < item[2]:
+                    return alerts + self.add(st, st.buffers[item[0]], item[0], t, valuenum)
+                return alerts
+            c = GCS_ITEMS.get(itemid)
+            if c is not None:
+                if value is not None and GCS_INTUBATED.get(itemid) == value:
+                    valuenum = 0.0
+                if st.gcs_row is None or st.gcs_row[0] != t:
+                    st.gcs_row = [t, NAN, NAN, NAN]
+                # the maximum of each component at a charted time
+                if not st.gcs_row[c + 1] >= valuenum:
+                    st.gcs_row[c + 1] = valuenum
+            return alerts
+        elif kind == 'lab':
+            item = LAB_ITEMS.get(itemid)
+            if item is None or not 0 < valuenum <= item[1]:
+                return NO_ALERTS
+            adm = self.admission(i, t)
+            buf = adm.labs[item[0]]
+            buf.append((t, valuenum))
+            while buf[0][0] < t - self.lookback:
+                buf.popleft()
+            alerts = NO_ALERTS
+            for st in adm.stays:
+                alerts = alerts + self.advance(st, t) + self.update(st, item[0], t, valuenum)
+            return alerts
+        elif kind == 'output':
+            st = self.stays.get(i)
+            if st is None or itemid not in URINE_ITEMS:
+                return NO_ALERTS
+            alerts = self.advance(st, t)
+            st.urine.append((t, valuenum))
+            while st.urine[0][0] < t - self.lookback:
+                st.urine.popleft()
+            if st.start is not None and st.start <= t <= st.end:
+                u = st.urine_agg
+                if valuenum == valuenum:
+                    u[0] += valuenum
+                    u[1] += 1
+                if u[2] is None:
+                    u[2] = t
+                u[3] = t
+                alerts = alerts + self.score(st, t)
+            return alerts
+        elif kind == 'bloodgas':
+            st = self.stays.get(i)
+            if st is None or not valuenum == valuenum:
+                return NO_ALERTS
+            var = 'pao2fio2_vent' if value else 'pao2fio2_novent'
+            return self.advance(st, t) + self.add(st, st.buffers[var], var, t, valuenum)
+        elif kind == 'vasopressor':
+            st = self.stays.get(i)
+            item = VASO_ITEMS.get(itemid)
+            if st is None or item is None or not valuenum == valuenum:
+                return NO_ALERTS
+            if item[1]:
+                valuenum = valuenum / st.weight
+            return self.advance(st, t) + self.add(st, st.buffers[item[0]], item[0], t, valuenum)
+        elif kind == 'prescription':
+            if value not in self.antibiotics:
+                return NO_ALERTS
+            return self.antibiotic(self.admission(i, t), t)
+        elif kind == 'culture' or kind == 'culture_date':
+            adm = self.admission(i, t)
+            adm.cultures.append((t, kind == 'culture_date', value, valuenum))
+            while adm.cultures[0][0] <= t - 96 * HOUR:
+                adm.cultures.popleft()
+            return NO_ALERTS
+        elif kind == 'icustay':
+            st = Stay(i, value, valuenum)
+            self.stays[i] = st
+            adm = self.admission(value, t)
+            adm.stays.append(st)
+            adm.had_stay = True
+            if adm.suspected_infection_time is not None:
+                return self.set_window(st, adm.suspected_infection_time, t)
+            return NO_ALERTS
+        elif kind == 'discharge':
+            # the hospitalization is kept, as a later ICU stay shares its suspected infection
+            st = self.stays.pop(i, None)
+            if st is not None:
+                self.admissions[st.hadm_id].stays.remove(st)
+            return NO_ALERTS
+        elif kind == 'hospital_discharge':
+            adm = self.admissions.pop(i, None)
+            if adm is not None:
+                for st in adm.stays:
+                    del self.stays[st.icustay_id]
+            return NO_ALERTS
+        raise ValueError('Unrecognized event kind {}'.format(kind))
+
+    def admission(self, hadm_id, t):
+        adm = self.admissions.get(hadm_id)
+        if adm is None:
+            adm = Admission()
+            self.admissions[hadm_id] = adm
+        adm.last_time = t
+        return adm
+
+    def sweep(self, t):
+        # drop the hospitalizations which have never had an ICU stay and have had no
+        # events for lookback seconds, e.g. ward admissions - run once an hour
+        self.next_sweep = t + HOUR
+        for hadm_id in [h for h, adm in self.admissions.items()
+                        if not adm.had_stay and adm.last_time < t - self.lookback]:
+            del self.admissions[hadm_id]
+
+    def advance(self, st, t):
+        # bring a stay up to time t: finish its GCS row, and close its window once t is
+        # after the end of the window
+        alerts = self.finish_gcs(st, t)
+        if st.end is not None and not st.closed and t > st.end:
+            st.closed = True
+            alerts = alerts + self.score(st, t)
+        return alerts
+
+    def flush(self, t):
+        # bring every stay up to time t, e.g. at the end of a feed, returning the alerts
+        alerts = NO_ALERTS
+        for st in list(self.stays.values()):
+            alerts = alerts + self.advance(st, t)
+        return alerts
+
+    def add(self, st, buf, var, t, value):
+        # buffer an event of a stay, and update the window if it is in it
+        buf.append((t, value))
+        while buf[0][0] < t - self.lookback:
+            buf.popleft()
+        return self.update(st, var, t, value)
+
+    def update(self, st, var, t, value):
+        # update the running minimum or maximum of a window with an event
+        if st.start is None or not st.start <= t <= st.end:
+            return NO_ALERTS
+        old = st.agg[var]
+        if var in MINIMUM:
+            if old <= value:
+                return NO_ALERTS
+        elif old >= value:
+            return NO_ALERTS
+        st.agg[var] = value
+        return self.score(st, t)
+
+    def finish_gcs(self, st, t):
+        # the GCS components of a charted time are complete once a later event arrives
+        row = st.gcs_row
+        if row is None or row[0] >= t:
+            return NO_ALERTS
+        st.gcs_row = None
+        rt, motor, verbal, eyes = row
+        last = st.gcs_last
+        st.gcs_last = row
+        fill = lambda v, default: default if v != v else v
+        own = fill(motor, 6) + fill(verbal, 5) + fill(eyes, 4)
+        first = 15 if verbal == 0 else own
+        # the previous row is only used if it is within 6 hours
+        if last is None or not last[0] > rt - 6 * HOUR:
+            gcs = first
+        else:
+            _, motor_prev, verbal_prev, eyes_prev = last
+            if verbal == 0 or (verbal != verbal and verbal_prev == 0):
+                gcs = 15
+            elif verbal_prev == 0:
+                gcs = own
+            else:
+                gcs = fill(motor, fill(motor_prev, 6)) + fill(verbal, fill(verbal_prev, 5)) \
+                    + fill(eyes, fill(eyes_prev, 4))
+        st.gcs.append((rt, gcs, first, last[0] if last is not None else None))
+        while st.gcs[0][0] < rt - self.lookback:
+            st.gcs.popleft()
+        if st.start is None or not st.start <= rt <= st.end:
+            return NO_ALERTS
+        # the first row of the window has no previous row
+        value = gcs if last is not None and last[0] >= st.start else first
+        return self.update(st, 'gcs', rt, value)
+
+    def antibiotic(self, adm, t):
+        # the suspected infection time of an antibiotic is the earliest culture in the
+        # 72 hours before it (96 hours for a culture with only a chart date), else its time
+        sit = t
+        for ct, date_only, _, _ in adm.cultures:
+            if ct >= t:
+                break
+            if (date_only and ct > t - 96 * HOUR) or (not date_only and ct >= t - 72 * HOUR):
+                sit = ct
+                break
+        if adm.suspected_infection_time is not None and adm.suspected_infection_time <= sit:
+            return NO_ALERTS
+        adm.suspected_infection_time = sit
+        alerts = NO_ALERTS
+        for st in adm.stays:
+            alerts = alerts + self.set_window(st, sit, t)
+        return alerts
+
+    def set_window(self, st, sit, t):
+        # compute the aggregates of the window around suspected infection from the buffers
+        st.start = start = sit - self.before
+        st.end = end = sit + self.after
+        st.closed = t > end
+        adm = self.admissions[st.hadm_id]
+        agg = dict()
+        for var, buf in list(st.buffers.items()) + list(adm.labs.items()):
+            values = [v for bt, v in buf if start <= bt <= end]
+            agg[var] = (min(values) if var in MINIMUM else max(values)) if values else NAN
+        rows = [(g if pt is not None and pt >= start else f) for rt, g, f, pt in st.gcs
+                if start <= rt <= end]
+        agg['gcs'] = min(rows) if rows else NAN
+        st.agg = agg
+
+        urine = [(ut, v) for ut, v in st.urine if start <= ut <= end]
+        values = [v for _, v in urine if v == v]
+        st.urine_agg = [sum(values), len(values), urine[0][0] if urine else None,
+                        urine[-1][0] if urine else None]
+
+        alerts = NO_ALERTS
+        if 'suspected_infection' not in st.alerted:
+            st.alerted.add('suspected_infection')
+            alerts = (Alert(t, st.icustay_id, 'suspected_infection', sit, None, None),)
+        return alerts + self.score(st, t)
+
+    def urineoutput(self, st):
+        # daily urine output of the window, from its first to its last urine output
+        total, n, first, last = st.urine_agg
+        if n == 0 or first is None or last == first:
+            return NAN
+        return total / ((last - first) / 60.0 / 60.0 / 24.0)
+
+    def score(self, st, t):
+        # the scores of the window so far, and the alerts they cause
+        # until the window has closed, the sofa of the alerts leaves out urine output,
+        # which can fall as more of the window is seen - the full renal subscore is never
+        # lower than the one from creatinine alone, so the alerts are never withdrawn
+        st.qsofa = qsofa_score(st.agg)
+        st.subscores = sofa_subscores(st.agg, self.urineoutput(st))
+        st.sofa = sum([s for s in st.subscores if s is not None])
+        if st.closed:
+            sofa = st.sofa
+        else:
+            renal = renal_score(st.agg['creatinine'], NAN)
+            sofa = sum([s for s in st.subscores[:5] + (renal,) if s is not None])
+        alerts = NO_ALERTS
+        if st.qsofa >= 2 and 'qsofa' not in st.alerted:
+            st.alerted.add('qsofa')
+            alerts = alerts + (Alert(t, st.icustay_id, 'qsofa',
+                                     self.admissions[st.hadm_id].suspected_infection_time,
+                                     st.qsofa, sofa),)
+        if sofa >= 2 and 'sepsis3' not in st.alerted:
+            st.alerted.add('sepsis3')
+            alerts = alerts + (Alert(t, st.icustay_id, 'sepsis3',
+                                     self.admissions[st.hadm_id].suspected_infection_time,
+                                     st.qsofa, sofa),)
+        return alerts
+
+    def state(self):
+        # a dataframe with the current scores of each stay
+        # the GCS of the latest charted time is only included once a later event arrives
+        # subscores are float, with NaN as null, as sofa.sofa_scores
+        rows = list()
+        for st in self.stays.values():
+            adm = self.admissions[st.hadm_id]
+            subscores = st.subscores if st.subscores is not None else [None] * 6
+            rows.append([st.icustay_id, adm.suspected_infection_time, st.qsofa, st.sofa]
+                        + [NAN if s is None else float(s) for s in subscores])
+        return pd.DataFrame(rows, columns=['icustay_id', 'suspected_infection_time', 'qsofa',
+                                           'sofa', 'respiration', 'coagulation', 'liver',
+                                           'cardiovascular', 'cns', 'renal'])
+
+# the order of events at the same time - stays are registered before their events
+KIND_ORDER = {'icustay': 0, 'culture': 1, 'culture_date': 1, 'chart': 2, 'lab': 2, 'output': 2,
+              'bloodgas': 2, 'vasopressor': 2, 'prescription': 3, 'discharge': 4,
+              'hospital_discharge': 5}
+
+def event_frame(kind, df, time, id, itemid=None, value=None, valuenum=None):
+    n = len(df)
+    col = lambda c, default: df[c].values if c is not None else np.full(n, default, dtype=object)
+    return pd.DataFrame({'time': seconds(df[time]), 'kind': kind, 'id': df[id].values,
+                         'itemid': col(itemid, None), 'value': col(value, None),
+                         'valuenum': pd.to_numeric(pd.Series(col(valuenum, NAN)),
+                                                   errors='coerce').values}).loc[df[time].notnull().values]
+
+def event_feed(icustays, chartevents=None, labevents=None, outputevents=None,
+               prescriptions=None, microbiologyevents=None, bloodgas=None, inputevents=None,
+               discharge=True, admissions=None):
+    # build an ordered list of events from dataframes of the MIMIC-III tables, e.g. to
+    # replay an admission through Sepsis3Monitor
+    # icustays - icustay_id, hadm_id, intime, outtime, and optionally weight
+    # bloodgas - icustay_id, charttime, pao2fio2 and ventilated
+    # inputevents - icustay_id, charttime (starttime for metavision), itemid and rate
+    # discharge - if True, a stay is dropped at its outtime
+    # admissions - hadm_id and dischtime, if given the hospitalization is dropped at its
+    #              dischtime (with discharge)
+    ie = icustays.copy()
+    if 'weight' not in ie.columns:
+        ie['weight'] = NAN
+    frames = [event_frame('icustay', ie, 'intime', 'icustay_id', value='hadm_id',
+                          valuenum='weight')]
+    if discharge:
+        frames.append(event_frame('discharge', ie, 'outtime', 'icustay_id'))
+        if admissions is not None:
+            adm = admissions.loc[admissions['dischtime'].notnull()]
+            frames.append(event_frame('hospital_discharge', adm, 'dischtime', 'hadm_id'))
+    if chartevents is not None:
+        ce = chartevents
+        if 'error' in ce.columns:
+            ce = ce.loc[ce['error'].isnull() | (ce['error'] != 1)]
+        ce = ce.loc[ce['itemid'].isin(list(CHART_ITEMS) + list(GCS_ITEMS))]
+        frames.append(event_frame('chart', ce, 'charttime', 'icustay_id', 'itemid', 'value',
+                                  'valuenum'))
+    if labevents is not None:
+        le = labevents.loc[labevents['itemid'].isin(list(LAB_ITEMS)) & labevents['hadm_id'].notnull()]
+        frames.append(event_frame('lab', le, 'charttime', 'hadm_id', 'itemid', None, 'valuenum'))
+    if outputevents is not None:
+        oe = outputevents.loc[outputevents['itemid'].isin(list(URINE_ITEMS))]
+        frames.append(event_frame('output', oe, 'charttime', 'icustay_id', 'itemid', None, 'value'))
+    if prescriptions is not None:
+        frames.append(event_frame('prescription', prescriptions, 'startdate', 'hadm_id',
+                                  value='drug'))
+    if microbiologyevents is not None:
+        me = microbiologyevents.loc[microbiologyevents['hadm_id'].notnull()]
+        me = me.assign(positive=(me['org_name'].notnull() & (me['org_name'] != '')).astype(int))
+        has_time = me['charttime'].notnull()
+        frames.append(event_frame('culture', me.loc[has_time], 'charttime', 'hadm_id', None,
+                                  'spec_type_desc', 'positive'))
+        frames.append(event_frame('culture_date', me.loc[~has_time], 'chartdate', 'hadm_id',
+                                  None, 'spec_type_desc', 'positive'))
+    if bloodgas is not None:
+        frames.append(event_frame('bloodgas', bloodgas, 'charttime', 'icustay_id', None,
+                                  'ventilated', 'pao2fio2'))
+    if inputevents is not None:
+        frames.append(event_frame('vasopressor', inputevents, 'charttime', 'icustay_id',
+                                  'itemid', None, 'rate'))
+
+    feed = pd.concat(frames, ignore_index=True)
+    feed = feed.iloc[np.lexsort((feed['kind'].map(KIND_ORDER).values, feed['time'].values))]
+    return list(zip(feed['time'].tolist(), feed['kind'].tolist(), feed['id'].tolist(),
+                    feed['itemid'].tolist(), feed['value'].tolist(), feed['valuenum'].tolist()))
@@ -0,0 +1,158 @@
+# suspicion of infection from antibiotic prescriptions and microbiology cultures
+# this computes the suspinfect_poe table without the database, following
+#   query/tbls/abx-poe-list.sql
+#   query/tbls/abx-micro-prescription.sql
+#   query/tbls/suspicion-of-infection.sql
+# an antibiotic is matched to cultures taken before it (within 72 hours, or 96 hours of
+# the chart date if there is no chart time) or after it (within 24 hours)
+# the SQL copies every prescription onto every ICU stay of the hospitalization - here
+# the matching is done once per hospitalization, by binary search on the cultures
+# sorted within each hospitalization, which is O((A + C) log C)
+
+import re
+
+import numpy as np
+import pandas as pd
+
+HOUR = 3600
+
+def like_regex(pattern):
+    # a regular expression for "like '%pattern%'", where % and _ are wildcards
+    return '.*'.join(['.'.join([re.escape(c) for c in s.split('_')])
+                      for s in pattern.split('%')])
+
+def antibiotic_drugs(prescriptions, filename='query/tbls/abx-poe-list.sql'):
+    # return the set of drugs in abx_poe_list, using the patterns in abx-poe-list.sql
+    # prescriptions is a dataframe with drug, drug_type and route
+    with open(filename, 'r') as fp:
+        sql = fp.read()
+    patterns = re.findall(r"lower\('([^']*)'\)", sql)
+    regex = '|'.join([like_regex(p.lower()) for p in patterns])
+
+    pr = prescriptions[['drug', 'drug_type', 'route']].drop_duplicates()
+    pr = pr.loc[pr['drug'].notnull() & pr['route'].notnull()]
+    drug = pr['drug'].str.lower()
+    route = pr['route'].str.lower()
+    keep = pr['drug_type'].isin(['MAIN', 'ADDITIVE']) \
+        & ~pr['route'].isin(['OU', 'OS', 'OD', 'AU', 'AS', 'AD', 'TP']) \
+        & ~route.str.contains('ear', regex=False) & ~route.str.contains('eye', regex=False) \
+        & ~drug.str.contains('cream', regex=False) \
+        & ~drug.str.contains('desensitization', regex=False) \
+        & ~drug.str.contains('ophth oint', regex=False) \
+        & ~drug.str.contains('gel', regex=False) \
+        & drug.str.contains(regex, flags=re.DOTALL)
+    return set(pr.loc[keep, 'drug'])
+
+def culture_events(microbiologyevents):
+    # one row per culture, as in the "me" CTE of abx-micro-prescription.sql:
+    # hadm_id, chartdate, charttime, spec_type_desc, positiveculture
+    me = microbiologyevents[['hadm_id', 'chartdate', 'charttime', 'spec_type_desc', 'org_name']]
+    me = me.assign(positiveculture=(me['org_name'].notnull() & (me['org_name'] != '')).astype(int))
+    me = me.sort_values('positiveculture', ascending=False, kind='mergesort')
+    me = me.drop_duplicates(subset=['hadm_id', 'chartdate', 'charttime', 'spec_type_desc'])
+    return me.drop('org_name', axis=1).reset_index(drop=True)
+
+def seconds(t):
+    # datetimes as integer seconds, with NaT as the minimum int64
+    return pd.to_datetime(pd.Series(t)).values.astype('datetime64[s]').astype(np.int64)
+
+def first_in_window(keys, lo, hi, left_closed=True):
+    # index of the first key in [lo, hi) (or (lo, hi) if not left_closed), or -1
+    # keys must be sorted
+    j = np.searchsorted(keys, lo, side='left' if left_closed else 'right')
+    found = j < keys.size
+    found[found] = keys[j[found]] < hi[found]
+    return np.where(found, j, -1)
+
+def take(values, j, missing=-1):
+    # values[j], or missing where j is -1
+    out = np.full(j.shape, missing, dtype=np.asarray(values).dtype)
+    out[j >= 0] = values[j[j >= 0]]
+    return out
+
+def suspicion_of_infection(icustays, prescriptions, microbiologyevents, antibiotics=None):
+    # return a dataframe matching the suspinfect_poe table, with one row per ICU stay:
+    #   icustay_id, antibiotic_name, antibiotic_time, suspected_infection_time,
+    #   specimen, positiveculture (1.0 or 0.0, NaN without a culture)
+    # antibiotics - the drugs in abx_poe_list, by default found with antibiotic_drugs
+    # suspinfect_poe takes the first antibiotic ordered by suspected_infection_time, and
+    # postgres breaks ties arbitrarily - here ties are broken by the antibiotic time and
+    # name, and by the earliest culture (then specimen name) matched to the antibiotic
+    if antibiotics is None:
+        antibiotics = antibiotic_drugs(prescriptions)
+
+    abx = prescriptions.loc[prescriptions['drug'].isin(antibiotics),
+                            ['hadm_id', 'drug', 'startdate']]
+    abx = abx.loc[abx['hadm_id'].isin(icustays['hadm_id'])].reset_index(drop=True)
+    me = culture_events(microbiologyevents)
+
+    # keys combine the hospitalization and the time in seconds, so that a single sorted
+    # array can be searched for cultures in the same hospitalization
+    hadm = pd.Index(pd.unique(np.concatenate([abx['hadm_id'].values, me['hadm_id'].values])))
+    a = seconds(abx['startdate'])
+    a_valid = abx['startdate'].notnull().values
+    ct = seconds(me['charttime'])
+    cd = seconds(me['chartdate'])
+    has_ct = me['charttime'].notnull().values
+    times = np.concatenate([a[a_valid], ct[has_ct], cd[me['chartdate'].notnull().values]])
+    t0 = (times.min() if times.size > 0 else 0) - 96*HOUR
+    span = (times.max() if times.size > 0 else 0) - t0 + 96*HOUR + 1
+
+    a_base = hadm.get_indexer(abx['hadm_id']).astype(np.int64) * span - t0
+    me_base = hadm.get_indexer(me['hadm_id']).astype(np.int64) * span - t0
+
+    # cultures with a chart time, and those with only a chart date, sorted by key then specimen
+    spec = me['spec_type_desc'].fillna('').values
+    ct_idx = np.flatnonzero(has_ct)
+    ct_idx = ct_idx[np.lexsort((spec[ct_idx], ct[ct_idx] + me_base[ct_idx]))]
+    ct_keys = ct[ct_idx] + me_base[ct_idx]
+    cd_idx = np.flatnonzero(~has_ct & me['chartdate'].notnull().values)
+    cd_idx = cd_idx[np.lexsort((spec[cd_idx], cd[cd_idx] + me_base[cd_idx]))]
+    cd_keys = cd[cd_idx] + me_base[cd_idx]
+
+    ak = np.where(a_valid, a, 0) + a_base
+    # culture in the 72 hours before: charttime < antibiotic_time <= charttime + 72 hours
+    j72 = first_in_window(ct_keys, ak - 72*HOUR, ak)
+    # or no charttime: chartdate < antibiotic_time < chartdate + 96 hours
+    j96 = first_in_window(cd_keys, ak - 96*HOUR, ak, left_closed=False)
+    # culture in the 24 hours after: antibiotic_time <= charttime < antibiotic_time + 24 hours
+    j24 = first_in_window(ct_keys, ak, ak + 24*HOUR)
+    j72[~a_valid] = -1
+    j96[~a_valid] = -1
+    j24[~a_valid] = -1
+
+    # the earliest culture before the antibiotic, preferring one with a charttime
+    never = np.iinfo(np.int64).max
+    t72 = take(ct_keys, j72, never) - np.where(j72 >= 0, a_base, 0)
+    t96 = take(cd_keys, j96, never) - np.where(j96 >= 0, a_base, 0)
+    use96 = t96 < t72
+    last72 = np.where(use96, take(cd_idx, j96), take(ct_idx, j72))
+    last72_time = np.where(use96, t96, t72)
+    next24 = take(ct_idx, j24)
+
+    # suspected infection time is the culture time if it is before the antibiotic
+    culture = np.where(last72 >= 0, last72, next24)
+    sit = np.where(last72 >= 0, last72_time, a)
+
+    res = pd.DataFrame({
+        'hadm_id': abx['hadm_id'].values,
+        'antibiotic_name': abx['drug'].values,
+        'antibiotic_time': pd.to_datetime(abx['startdate']).values,
+        'suspected_infection_time': pd.to_datetime(np.where(a_valid, sit, 0), unit='s'),
+        'specimen': take(me['spec_type_desc'].values.astype(object), culture, None),
+        'positiveculture': np.where(culture >= 0,
+                                    take(me['positiveculture'].values, culture), np.nan),
+    })
+    res.loc[~a_valid, 'suspected_infection_time'] = pd.NaT
+    res['suspected_infection_time'] = res['suspected_infection_time'].astype(
+        res['antibiotic_time'].dtype)
+
+    # the first antibiotic of each hospitalization, with missing times last
+    res = res.sort_values(['hadm_id', 'suspected_infection_time', 'antibiotic_time',
+                           'antibiotic_name'], na_position='last', kind='mergesort')
+    res = res.drop_duplicates(subset='hadm_id')
+
+    df = icustays[['icustay_id', 'hadm_id']].merge(res, on='hadm_id', how='left')
+    df = df.sort_values('icustay_id', kind='mergesort').reset_index(drop=True)
+    return df[['icustay_id', 'antibiotic_name', 'antibiotic_time', 'suspected_infection_time',
+               'specimen', 'positiveculture']]
@@ -0,0 +1,366 @@
+# synthetic data shaped like MIMIC-III, for benchmarking the extraction at scale
+# the tables have the columns used by query/tbls and sepsis_extract_data, and the
+# itemids they look for, but the values are only plausible - not realistic
+# this data must never be used to draw clinical conclusions
+#
+#   write_synthetic('data/synthetic', n_patients=460000, fmt='parquet')
+#   backend = duckdb_backend.DuckDBBackend('data/synthetic')
+#
+# patients are generated in chunks, each with a random stream given by the seed and
+# its first patient, so chunks are independent and the output is reproducible
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# number of events per hour of ICU stay, or the probability for per-stay events
+DEFAULT_DENSITY = OrderedDict([
+    ('vitals_per_hour', 1.0),
+    ('gcs_per_hour', 0.25),
+    ('urine_per_hour', 1.0),
+    ('vent_per_hour', 0.25),
+    ('bg_per_hour', 0.15),
+    ('p_vent', 0.4),
+    ('p_infection', 0.5),
+    ('drugs_per_day', 2.0),
+    ('cultures_per_infection', 2.0),
+])
+
+# (carevue itemid, metavision itemid, mean, sd, min, max, unit)
+VITALS = OrderedDict([
+    ('heartrate', (211, 220045, 85, 15, 30, 200, 'bpm')),
+    ('sysbp', (455, 220179, 120, 20, 60, 220, 'mmHg')),
+    ('diasbp', (8441, 220180, 65, 12, 30, 130, 'mmHg')),
+    ('meanbp', (456, 220181, 80, 14, 40, 160, 'mmHg')),
+    ('resprate', (618, 220210, 18, 5, 5, 50, 'insp/min')),
+    ('tempc', (676, 223762, 37, 0.7, 34, 41, 'Deg. C')),
+    ('spo2', (646, 220277, 97, 2, 70, 100, '%')),
+    ('glucose', (807, 220621, 140, 40, 40, 500, 'mg/dL')),
+    ('fio2', (3420, 223835, 50, 20, 21, 100, '%')),
+])
+
+# GCS components: (carevue itemid, metavision itemid, max score)
+GCS = OrderedDict([
+    ('eyes', (184, 220739, 4)),
+    ('motor', (454, 223901, 6)),
+    ('verbal', (723, 223900, 5)),
+])
+
+# ventilator settings: (carevue itemid, metavision itemid, mean, sd, unit)
+VENT_SETTINGS = OrderedDict([
+    ('tidalvolume', (681, 224685, 450, 80, 'mL')),
+    ('peep', (505, 220339, 5, 2, 'cmH2O')),
+    ('minutevolume', (445, 224687, 8, 2, 'L/min')),
+])
+
+# blood gases in labevents: itemid -> (mean, sd, unit) - 50800 is the specimen type
+BLOOD_GAS = OrderedDict([
+    (50801, (150, 80, 'mm Hg')), (50802, (0, 4, 'mEq/L')), (50803, (24, 4, 'mEq/L')),
+    (50804, (25, 4, 'mEq/L')), (50805, (2, 1, '%')), (50806, (104, 5, 'mEq/L')),
+    (50808, (1.1, 0.1, 'mmol/L')), (50809, (140, 40, 'mg/dL')), (50810, (32, 6, '%')),
+    (50811, (10.5, 2, 'g/dL')), (50813, (2.0, 1.5, 'mmol/L')), (50814, (1, 0.5, '%')),
+    (50815, (4, 2, 'L/min')), (50816, (50, 20, '%')), (50817, (95, 4, '%')),
+    (50818, (40, 8, 'mm Hg')), (50819, (5, 2, '')), (50820, (7.38, 0.08, 'units')),
+    (50821, (100, 40, 'mm Hg')), (50822, (4.1, 0.6, 'mEq/L')), (50823, (50, 20, '%')),
+    (50824, (138, 5, 'mEq/L')), (50825, (37, 0.7, '')), (50826, (450, 80, 'ml')),
+    (50827, (16, 5, '')),
+])
+
+# urine output: carevue "Urine Out Foley", metavision "Foley"
+URINE_ITEMIDS = (40055, 226559)
+
+# antibiotics matched by abx_poe_list, and other drugs which are not
+ANTIBIOTICS = ['Vancomycin', 'Ampicillin Sodium', 'Piperacillin-Tazobactam', 'Cefepime',
+               'Levofloxacin', 'MetRONIDAZOLE (FLagyl)', 'Ciprofloxacin IV', 'Azithromycin',
+               'Clindamycin', 'CefazoLIN']
+OTHER_DRUGS = ['Heparin', 'Insulin', 'Furosemide', 'Potassium Chloride', 'Acetaminophen',
+               'Pantoprazole', 'Docusate Sodium', 'Metoprolol Tartrate']
+
+# (spec_itemid, spec_type_desc)
+SPECIMENS = [(70012, 'BLOOD CULTURE'), (70079, 'URINE'), (70062, 'SPUTUM'), (70091, 'MRSA SCREEN')]
+# (org_itemid, org_name)
+ORGANISMS = [(80023, 'STAPH AUREUS COAG +'), (80002, 'ESCHERICHIA COLI'),
+             (80026, 'PSEUDOMONAS AERUGINOSA'), (80053, 'ENTEROCOCCUS SP.')]
+
+HOUR = np.timedelta64(3600, 's')
+
+def event_times(rng, start, end, rate):
+    # poisson events for each interval [start, end) at rate events per hour
+    # returns the index of the interval of each event, and the event times
+    hours = (end - start) / HOUR
+    n = rng.poisson(rate * hours)
+    idx = np.repeat(np.arange(len(start)), n)
+    t = start[idx] + (rng.uniform(0, 1, size=idx.size) * hours[idx] * 3600).astype('timedelta64[s]')
+    return idx, t
+
+def frame(columns):
+    return pd.DataFrame(OrderedDict(columns))
+
+def generate_chunk(n_patients, first_id=1, seed=0, density=None):
+    # generate the tables for patients first_id, ..., first_id + n_patients - 1
+    # there is one hospital admission and ICU stay per patient
+    # returns an OrderedDict mapping table names to dataframes
+    d = OrderedDict(DEFAULT_DENSITY)
+    if density is not None:
+        d.update(density)
+    rng = np.random.default_rng([seed, first_id])
+    N = n_patients
+
+    subject_id = np.arange(first_id, first_id + N)
+    hadm_id = 100000 + subject_id
+    icustay_id = 200000 + subject_id
+    metavision = rng.uniform(size=N) < 0.5
+    # dates are shifted into the future, as in MIMIC
+    year = np.where(metavision, 2160, 2110) + rng.integers(0, 40, size=N)
+    admittime = (year - 1970).astype('datetime64[Y]').astype('datetime64[s]') \
+        + (rng.uniform(0, 365*24*3600, size=N)).astype('timedelta64[s]')
+    intime = admittime + (rng.exponential(12, size=N) * 3600).astype('timedelta64[s]')
+    los_hours = np.maximum(rng.gamma(1.5, 48, size=N), 6)
+    outtime = intime + (los_hours * 3600).astype('timedelta64[s]')
+    dischtime = outtime + (rng.exponential(72, size=N) * 3600).astype('timedelta64[s]')
+    age = np.clip(rng.normal(64, 17, size=N), 16, 89)
+    dob = admittime - (age * 365.242 * 24 * 3600).astype('timedelta64[s]')
+    died = rng.uniform(size=N) < 0.12
+    vented = rng.uniform(size=N) < d['p_vent']
+    infected = rng.uniform(size=N) < d['p_infection']
+
+    tables = OrderedDict()
+    tables['patients'] = frame([
+        ('subject_id', subject_id),
+        ('gender', np.where(rng.uniform(size=N) < 0.56, 'M', 'F')),
+        ('dob', dob.astype('datetime64[D]')),
+        ('dod', np.where(died, dischtime.astype('datetime64[D]'), np.datetime64('NaT'))),
+        ('expire_flag', died.astype(int)),
+    ])
+    tables['admissions'] = frame([
+        ('subject_id', subject_id), ('hadm_id', hadm_id),
+        ('admittime', admittime), ('dischtime', dischtime),
+        ('deathtime', np.where(died, dischtime, np.datetime64('NaT'))),
+        ('admission_type', np.where(rng.uniform(size=N) < 0.8, 'EMERGENCY', 'ELECTIVE')),
+        ('ethnicity', rng.choice(['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC OR LATINO',
+                                  'ASIAN', 'UNKNOWN/NOT SPECIFIED'], size=N)),
+        ('hospital_expire_flag', died.astype(int)),
+        ('has_chartevents_data', np.ones(N, dtype=int)),
+    ])
+    tables['services'] = frame([
+        ('subject_id', subject_id), ('hadm_id', hadm_id), ('transfertime', admittime),
+        ('prev_service', np.full(N, None, dtype=object)),
+        ('curr_service', rng.choice(['MED', 'SURG', 'CSURG', 'NMED', 'TRAUM'], size=N,
+                                    p=[0.6, 0.15, 0.1, 0.1, 0.05])),
+    ])
+    careunit = rng.choice(['MICU', 'SICU', 'CCU', 'CSRU', 'TSICU'], size=N)
+    tables['icustays'] = frame([
+        ('subject_id', subject_id), ('hadm_id', hadm_id), ('icustay_id', icustay_id),
+        ('dbsource', np.where(metavision, 'metavision', 'carevue')),
+        ('first_careunit', careunit), ('last_careunit', careunit),
+        ('intime', intime), ('outtime', outtime), ('los', los_hours / 24.0),
+    ])
+
+    # chartevents - vital signs are charted together
+    charts = list()
+    idx, t = event_times(rng, intime, outtime, d['vitals_per_hour'])
+    for name, (cv, mv, mu, sd, lo, hi, unit) in VITALS.items():
+        if name == 'fio2':
+            # FiO2 is only charted for some patients
+            keep = vented[idx] & (rng.uniform(size=idx.size) < 0.5)
+        else:
+            keep = rng.uniform(size=idx.size) < 0.9
+        i = idx[keep]
+        v = np.round(np.clip(rng.normal(mu, sd, size=i.size), lo, hi), 1)
+        charts.append((i, t[keep], np.where(metavision[i], mv, cv), v.astype(str), v, unit))
+
+    # GCS - intubated patients sometimes have a verbal score of "ET/Trach"
+    idx, t = event_times(rng, intime, outtime, d['gcs_per_hour'])
+    for name, (cv, mv, top) in GCS.items():
+        v = np.clip(top - rng.poisson(0.7, size=idx.size), 1, top).astype(float)
+        value = v.astype(str)
+        if name == 'verbal':
+            ett = vented[idx] & (rng.uniform(size=idx.size) < 0.5)
+            value = np.where(ett, np.where(metavision[idx], 'No Response-ETT', '1.0 ET/Trach'), value)
+            v = np.where(ett, 1.0, v)
+        charts.append((idx, t, np.where(metavision[idx], mv, cv), value, v, 'points'))
+
+    # ventilator settings for the first part of the stay, then an extubation
+    vent_end = intime + ((0.2 + 0.6*rng.uniform(size=N)) * los_hours * 3600).astype('timedelta64[s]')
+    idx, t = event_times(rng, intime[vented], vent_end[vented], d['vent_per_hour'])
+    idx = np.flatnonzero(vented)[idx]
+    for name, (cv, mv, mu, sd, unit) in VENT_SETTINGS.items():
+        v = np.round(np.abs(rng.normal(mu, sd, size=idx.size)), 1)
+        charts.append((idx, t, np.where(metavision[idx], mv, cv), v.astype(str), v, unit))
+    charts.append((idx, t, np.full(idx.size, 720), np.full(idx.size, 'Drager'),
+                   np.full(idx.size, np.nan), ''))
+    i = np.flatnonzero(vented)
+    charts.append((i, vent_end[i], np.full(i.size, 640), np.full(i.size, 'Extubated'),
+                   np.full(i.size, np.nan), ''))
+
+    idx = np.concatenate([c[0] for c in charts])
+    tables['chartevents'] = frame([
+        ('subject_id', subject_id[idx]), ('hadm_id', hadm_id[idx]),
+        ('icustay_id', icustay_id[idx]),
+        ('itemid', np.concatenate([c[2] for c in charts])),
+        ('charttime', np.concatenate([c[1] for c in charts])),
+        ('value', np.concatenate([c[3] for c in charts])),
+        ('valuenum', np.concatenate([c[4] for c in charts])),
+        ('valueuom', np.concatenate([np.full(c[0].size, c[5]) for c in charts])),
+        ('error', np.zeros(idx.size, dtype=int)),
+    ]).sort_values(['icustay_id', 'charttime'], kind='mergesort').reset_index(drop=True)
+
+    # labevents - blood gas panels, mostly arterial for ventilated patients
+    # each row of a panel has the time of the panel
+    idx, t = event_times(rng, intime, outtime, d['bg_per_hour'] * np.where(vented, 2.0, 0.5))
+    p = np.arange(idx.size)
+    specimen = np.where(rng.uniform(size=idx.size) < np.where(vented[idx], 0.8, 0.3), 'ART', 'VEN')
+    labs = [(p, np.full(p.size, 50800), specimen, np.full(p.size, np.nan), '')]
+    for itemid, (mu, sd, unit) in BLOOD_GAS.items():
+        pi = p[rng.uniform(size=p.size) < 0.7]
+        v = rng.normal(mu, sd, size=pi.size)
+        if itemid != 50802:
+            # only base excess can be negative
+            v = np.abs(v)
+        v = np.round(v, 2)
+        labs.append((pi, np.full(pi.size, itemid), v.astype(str), v, unit))
+
+    p = np.concatenate([l[0] for l in labs])
+    tables['labevents'] = frame([
+        ('subject_id', subject_id[idx[p]]), ('hadm_id', hadm_id[idx[p]]),
+        ('itemid', np.concatenate([l[1] for l in labs])),
+        ('charttime', t[p]),
+        ('value', np.concatenate([l[2] for l in labs])),
+        ('valuenum', np.concatenate([l[3] for l in labs])),
+        ('valueuom', np.concatenate([np.full(l[0].size, l[4]) for l in labs])),
+        ('flag', np.full(p.size, None, dtype=object)),
+    ]).sort_values(['subject_id', 'charttime'], kind='mergesort').reset_index(drop=True)
+
+    # outputevents - urine output
+    idx, t = event_times(rng, intime, outtime, d['urine_per_hour'])
+    tables['outputevents'] = frame([
+        ('subject_id', subject_id[idx]), ('hadm_id', hadm_id[idx]),
+        ('icustay_id', icustay_id[idx]), ('charttime', t),
+        ('itemid', np.where(metavision[idx], URINE_ITEMIDS[1], URINE_ITEMIDS[0])),
+        ('value', np.round(np.clip(rng.normal(80, 50, size=idx.size), 0, 1000))),
+        ('valueuom', np.full(idx.size, 'ml')),
+        ('iserror', np.zeros(idx.size, dtype=int)),
+    ])
+
+    # prescriptions - start and end dates are at midnight, as in MIMIC
+    # infected patients get antibiotics, everyone gets other drugs
+    infection_time = intime + (rng.uniform(-24, 48, size=N) * 3600).astype('timedelta64[s]')
+    idx, t = event_times(rng, admittime, dischtime, d['drugs_per_day'] / 24.0)
+    i = np.flatnonzero(infected)
+    n_abx = rng.integers(1, 4, size=i.size)
+    i_abx = np.repeat(i, n_abx)
+    t_abx = infection_time[i_abx] + (rng.exponential(6, size=i_abx.size) * 3600).astype('timedelta64[s]')
+    drug = np.concatenate([rng.choice(OTHER_DRUGS, size=idx.size),
+                           rng.choice(ANTIBIOTICS, size=i_abx.size)])
+    idx = np.concatenate([idx, i_abx])
+    startdate = np.concatenate([t, t_abx]).astype('datetime64[D]').astype('datetime64[s]')
+    tables['prescriptions'] = frame([
+        ('subject_id', subject_id[idx]), ('hadm_id', hadm_id[idx]),
+        ('icustay_id', icustay_id[idx]),
+        ('startdate', startdate),
+        ('enddate', startdate + rng.integers(1, 8, size=idx.size) * 24 * HOUR),
+        ('drug_type', np.full(idx.size, 'MAIN')),
+        ('drug', drug), ('drug_name_poe', drug), ('drug_name_generic', drug),
+        ('route', rng.choice(['IV', 'PO', 'PO/NG', 'IV DRIP'], size=idx.size, p=[0.6, 0.2, 0.1, 0.1])),
+    ]).sort_values(['hadm_id', 'startdate'], kind='mergesort').reset_index(drop=True)
+
+    # microbiologyevents - cultures are taken around the time of infection, and some
+    # are positive - charttime is missing for some, leaving only chartdate
+    n_cx = rng.poisson(d['cultures_per_infection'], size=i.size)
+    idx = np.repeat(i, n_cx)
+    t = infection_time[idx] + (rng.uniform(-24, 24, size=idx.size) * 3600).astype('timedelta64[s]')
+    spec = rng.integers(0, len(SPECIMENS), size=idx.size)
+    org = np.where(rng.uniform(size=idx.size) < 0.3, rng.integers(0, len(ORGANISMS), size=idx.size), -1)
+    positive = org >= 0
+    tables['microbiologyevents'] = frame([
+        ('subject_id', subject_id[idx]), ('hadm_id', hadm_id[idx]),
+        ('chartdate', t.astype('datetime64[D]').astype('datetime64[s]')),
+        ('charttime', np.where(rng.uniform(size=idx.size) < 0.9, t, np.datetime64('NaT'))),
+        ('spec_itemid', np.array([SPECIMENS[s][0] for s in spec], dtype=int)),
+        ('spec_type_desc', np.array([SPECIMENS[s][1] for s in spec], dtype=object)),
+        # org_itemid is float, as a column of integers with nulls is in pandas
+        ('org_itemid', np.where(positive, [ORGANISMS[o][0] for o in org], np.nan)),
+        ('org_name', np.where(positive, np.array([ORGANISMS[o][1] for o in org], dtype=object), None)),
+        ('ab_name', np.where(positive, 'VANCOMYCIN', None)),
+        ('interpretation', np.where(positive, rng.choice(['S', 'R'], size=idx.size), None)),
+    ])
+    return tables
+
+def generate_chunks(n_patients, chunk_size=10000, seed=0, density=None):
+    # generate the tables in chunks of chunk_size patients
+    # yields an OrderedDict of dataframes for each chunk
+    # row_id is added to each table, as it is not null in the MIMIC-III schema
+    row_id = dict()
+    for first_id in range(1, n_patients + 1, chunk_size):
+        n = min(chunk_size, n_patients + 1 - first_id)
+        tables = generate_chunk(n, first_id=first_id, seed=seed, density=density)
+        for name, df in tables.items():
+            N = row_id.get(name, 0)
+            df.insert(0, 'row_id', np.arange(N + 1, N + df.shape[0] + 1))
+            row_id[name] = N + df.shape[0]
+        yield tables
+
+def generate(n_patients=1000, seed=0, density=None):
+    # generate all the tables in memory - see write_synthetic for larger data
+    chunks = list(generate_chunks(n_patients, seed=seed, density=density))
+    return OrderedDict([(t, pd.concat([c[t] for c in chunks], ignore_index=True))
+                        for t in chunks[0]])
+
+PG_TYPES = [('int', 'integer'), ('float', 'double precision'),
+            ('datetime', 'timestamp(0) without time zone'), ('object', 'text')]
+
+def pg_type(dtype):
+    for prefix, t in PG_TYPES:
+        if str(dtype).lower().startswith(prefix):
+            return t
+    return 'text'
+
+def write_synthetic(path, n_patients=1000, fmt='parquet', chunk_size=10000, seed=0,
+                    density=None, schema_name='mimiciii', verbose=True):
+    # write synthetic tables to a folder
+    #   parquet - a folder of parquet files for each table, one file per chunk, as read by
+    #     duckdb_backend.DuckDBBackend
+    #   copy - a CSV file for each table, and load.sql to create and load the tables with
+    #     psql, e.g. psql -d mimic -f data/synthetic/load.sql
+    # returns a dictionary with the number of rows written to each table
+    if fmt not in ('parquet', 'copy'):
+        raise ValueError('Unrecognized format {} - use parquet or copy'.format(fmt))
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    rows = OrderedDict()
+    columns = OrderedDict()
+    for c, tables in enumerate(generate_chunks(n_patients, chunk_size=chunk_size, seed=seed,
+                                               density=density)):
+        for name, df in tables.items():
+            if fmt == 'parquet':
+                if not os.path.exists(os.path.join(path, name)):
+                    os.makedirs(os.path.join(path, name))
+                df.to_parquet(os.path.join(path, name, 'part-{:05d}.parquet'.format(c)),
+                              index=False)
+            else:
+                df.to_csv(os.path.join(path, name + '.csv'), index=False,
+                          mode='w' if c == 0 else 'a', header=(c == 0),
+                          date_format='%Y-%m-%d %H:%M:%S')
+            rows[name] = rows.get(name, 0) + df.shape[0]
+            columns[name] = df.dtypes
+        if verbose:
+            print('Wrote patients {} to {}.'.format(c*chunk_size + 1,
+                                                    min((c+1)*chunk_size, n_patients)))
+
+    if fmt == 'copy':
+        with open(os.path.join(path, 'load.sql'), 'w') as fp:
+            fp.write('-- load the synthetic data written by sepsis_utils.synthetic\n')
+            fp.write('CREATE SCHEMA IF NOT EXISTS {};\n'.format(schema_name))
+            for name in rows:
+                cols = columns[name]
+                fp.write('\nDROP TABLE IF EXISTS {}.{} CASCADE;\n'.format(schema_name, name))
+                fp.write('CREATE TABLE {}.{} (\n  '.format(schema_name, name))
+                fp.write('\n, '.join([c + ' ' + pg_type(cols[c]) for c in cols.index]))
+                fp.write('\n);\n')
+                fp.write("\\copy {}.{} ({}) from '{}' with (format csv, header)\n".format(
+                    schema_name, name, ', '.join(cols.index),
+                    os.path.abspath(os.path.join(path, name + '.csv'))))
+    return rows
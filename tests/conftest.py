@@ -0,0 +1,33 @@
+# fixtures shared by the tests: synthetic MIMIC-III tables (see sepsis_utils.synthetic)
+# written once per session, and a DuckDB backend reading them for each test, so the SQL
+# in query/ can be run as the reference for the in-memory implementations
+# the tests run in the root of the repository, as the scripts in query/ are read by
+# relative path
+
+import os
+
+import pytest
+
+from sepsis_utils import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(autouse=True)
+def in_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+@pytest.fixture(scope='session')
+def synthetic_path(tmp_path_factory):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path_factory.mktemp('synthetic'))
+    synthetic.write_synthetic(path, n_patients=1000, seed=0, verbose=False)
+    return path
+
+@pytest.fixture
+def backend(synthetic_path):
+    pytest.importorskip('duckdb')
+    from sepsis_utils.duckdb_backend import DuckDBBackend
+
+    b = DuckDBBackend(synthetic_path)
+    yield b
+    b.close()
@@ -0,0 +1,41 @@
+# QueryCache: results are computed once, written through their own temporary file, and
+# files removed by another process are ignored
+
+import os
+
+import pandas as pd
+import pytest
+
+from sepsis_utils import cache as ca
+
+def test_fetch_and_invalidate(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    qc = ca.QueryCache(str(tmp_path / 'cache'), fingerprint='x')
+    calls = list()
+    def compute():
+        calls.append(1)
+        return pd.DataFrame({'a': [1, 2, 3]})
+
+    df = qc.fetch(None, 'select a', compute=compute)
+    pd.testing.assert_frame_equal(qc.fetch(None, 'select a', compute=compute), df)
+    assert len(calls) == 1
+    assert os.listdir(qc.path) == [os.path.basename(qc.filename(None, 'select a'))]
+
+    # a file removed by another process after it was listed
+    missing = os.path.join(qc.path, 'missing.parquet')
+    files = qc.files
+    monkeypatch.setattr(qc, 'files', lambda: files() + [missing])
+    qc.max_bytes = 0
+    qc.evict()
+    assert qc.invalidate() == 1
+    assert os.listdir(qc.path) == []
+
+def test_failed_write_removes_temporary_file(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    qc = ca.QueryCache(str(tmp_path), fingerprint='x')
+    def fail(*args, **kwargs):
+        raise IOError('disk full')
+    monkeypatch.setattr(pd.DataFrame, 'to_parquet', fail)
+    with pytest.raises(IOError):
+        qc.fetch(None, 'select a', compute=lambda: pd.DataFrame({'a': [1]}))
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,220 @@
+# durations.py against the SQL it replaces, in DuckDB: the vd CTE formerly in
+# get_scores_at_time (kept here, as it is no longer in the package) and vaso-dur.sql
+
+import numpy as np
+import pandas as pd
+
+from sepsis_utils import durations as du
+
+# the ventsettings, vd1, vd2 and vd CTEs of get_scores_at_time before they were removed
+VD_QUERY = """
+    with ventsettings as
+    (
+      select
+        ce.icustay_id, charttime
+        -- case statement determining whether it is an instance of mech vent
+        , max(
+          case
+            when itemid is null or value is null then 0 -- can't have null values
+            when itemid = 720 and value != 'Other/Remarks' THEN 1  -- VentTypeRecorded
+            when itemid = 467 and value = 'Ventilator' THEN 1 -- O2 delivery device == ventilator
+            when itemid = 648 and value = 'Intubated/trach' THEN 1 -- Speech = intubated
+            when itemid in
+              (
+              445, 448, 449, 450, 1340, 1486, 1600, 224687 -- minute volume
+              , 639, 654, 681, 682, 683, 684,224685,224684,224686 -- tidal volume
+              , 218,436,535,444,459,224697,224695,224696,224746,224747 -- High/Low/Peak/Mean/Neg insp force ("RespPressure")
+              , 221,1,1211,1655,2000,226873,224738,224419,224750,227187 -- Insp pressure
+              , 543 -- PlateauPressure
+              , 5865,5866,224707,224709,224705,224706 -- APRV pressure
+              , 60,437,505,506,686,220339,224700 -- PEEP
+              , 3459 -- high pressure relief
+              , 501,502,503,224702 -- PCV
+              , 223,667,668,669,670,671,672 -- TCPCV
+              , 157,158,1852,3398,3399,3400,3401,3402,3403,3404,8382,227809,227810 -- ETT
+              , 224701 -- PSVlevel
+              )
+              THEN 1
+            else 0
+          end
+          ) as MechVent
+          , max(
+            case when itemid is null or value is null then 0
+              when itemid = 640 and value = 'Extubated' then 1
+              when itemid = 640 and value = 'Self Extubation' then 1
+            else 0
+            end
+            )
+            as Extubated
+          , max(
+            case when itemid is null or value is null then 0
+              when itemid = 640 and value = 'Self Extubation' then 1
+            else 0
+            end
+            )
+            as SelfExtubated
+
+      from mimiciii.chartevents ce
+      where value is not null
+      and itemid in
+      (
+          640 -- extubated
+          , 648 -- speech
+          , 720 -- vent type
+          , 467 -- O2 delivery device
+          , 445, 448, 449, 450, 1340, 1486, 1600, 224687 -- minute volume
+          , 639, 654, 681, 682, 683, 684,224685,224684,224686 -- tidal volume
+          , 218,436,535,444,459,224697,224695,224696,224746,224747 -- High/Low/Peak/Mean/Neg insp force ("RespPressure")
+          , 221,1,1211,1655,2000,226873,224738,224419,224750,227187 -- Insp pressure
+          , 543 -- PlateauPressure
+          , 5865,5866,224707,224709,224705,224706 -- APRV pressure
+          , 60,437,505,506,686,220339,224700 -- PEEP
+          , 3459 -- high pressure relief
+          , 501,502,503,224702 -- PCV
+          , 223,667,668,669,670,671,672 -- TCPCV
+          , 157,158,1852,3398,3399,3400,3401,3402,3403,3404,8382,227809,227810 -- ETT
+          , 224701 -- PSVlevel
+      )
+      group by icustay_id, charttime
+    )
+    -- now we convert CHARTTIME of ventilator settings into durations
+    , vd1 as
+    (
+    select
+        icustay_id
+        -- this carries over the previous charttime which had a mechanical ventilation event
+        , case
+            when MechVent=1 then
+              LAG(CHARTTIME, 1) OVER (partition by icustay_id, MechVent order by charttime)
+            else null
+          end as charttime_lag
+        , charttime
+        , MechVent
+        , Extubated
+        , SelfExtubated
+
+        -- if this is a mechanical ventilation event, we calculate the time since the last event
+        , case
+            -- if the current observation indicates mechanical ventilation is present
+            when MechVent=1 then
+            -- copy over the previous charttime where mechanical ventilation was present
+              CHARTTIME - (LAG(CHARTTIME, 1) OVER (partition by icustay_id, MechVent order by charttime))
+            else null
+          end as ventduration
+
+        -- now we determine if the current mech vent event is a "new", i.e. they've just been intubated
+        , case
+          -- if there is an extubation flag, we mark any subsequent ventilation as a new ventilation event
+            when Extubated = 1 then 0 -- extubation is *not* a new ventilation event, the *subsequent* row is
+            when
+              LAG(Extubated,1)
+              OVER
+              (
+              partition by icustay_id, case when MechVent=1 or Extubated=1 then 1 else 0 end
+              order by charttime
+              )
+              = 1 then 1
+              -- if there is less than 8 hours between vent settings, we do not treat this as a new ventilation event
+            when (CHARTTIME - (LAG(CHARTTIME, 1) OVER (partition by icustay_id, MechVent order by charttime))) <= interval '8' hour
+              then 0
+          else 1
+          end as newvent
+    FROM
+      ventsettings
+    )
+    , vd2 as
+    (
+    select vd1.*
+    -- create a cumulative sum of the instances of new ventilation
+    -- this results in a monotonic integer assigned to each instance of ventilation
+    , case when MechVent=1 or Extubated = 1 then
+        SUM( newvent )
+        OVER ( partition by icustay_id order by charttime )
+      else null end
+      as ventnum
+    from vd1
+    -- now we can isolate to just rows with ventilation settings/extubation settings
+    -- (before we had rows with extubation flags)
+    -- this removes any null values for newvent
+    where
+      MechVent = 1 or Extubated = 1
+    )
+    , vd as
+    (
+    -- finally, create the durations for each mechanical ventilation instance
+    select icustay_id, ventnum
+      , min(charttime) as starttime
+      , max(charttime) as endtime
+    from vd2
+    group by icustay_id, ventnum
+    order by icustay_id, ventnum
+    )
+    select icustay_id, ventnum, starttime, endtime from vd order by icustay_id, ventnum
+    """
+
+def replace_table(backend, name, df):
+    # replace a table of the mimiciii schema with a dataframe
+    backend.con.execute('drop view if exists mimiciii.' + name)
+    backend.con.register('df_' + name, df)
+    backend.con.execute('create or replace table mimiciii.' + name + ' as select * from df_' + name)
+    backend.con.unregister('df_' + name)
+
+def check_ventilation(backend):
+    ref = backend.read_sql(VD_QUERY)
+    res = du.get_ventilation_durations(backend)
+    assert len(ref) > 0
+    ref['ventnum'] = ref['ventnum'].astype(int)
+    pd.testing.assert_frame_equal(res, ref, check_dtype=False)
+
+def test_ventilation_durations_synthetic(backend):
+    check_ventilation(backend)
+
+def test_ventilation_durations_random(backend):
+    # settings charted at random, with extubations and values which are not ventilation
+    rng = np.random.default_rng(0)
+    n = 20000
+    items = np.array([640, 648, 720, 467, 445, 60, 224701, 211])
+    values = {640: ['Extubated', 'Self Extubation', 'Other'], 648: ['Intubated/trach', 'x'],
+              720: ['Other/Remarks', 'CMV'], 467: ['Ventilator', 'Nasal']}
+    ce = pd.DataFrame({'icustay_id': rng.integers(1, 200, n),
+                       'charttime': pd.Timestamp('2100-01-01')
+                       + pd.to_timedelta(rng.integers(0, 20 * 24 * 4, n) * 15, unit='min'),
+                       'itemid': rng.choice(items, n)})
+    ce['value'] = [rng.choice(values.get(i, ['1'])) for i in ce['itemid']]
+    replace_table(backend, 'chartevents', ce)
+    check_ventilation(backend)
+
+def test_vasopressor_durations(backend):
+    rng = np.random.default_rng(0)
+    base = pd.Timestamp('2100-01-01')
+    m = 20000
+    cv = pd.DataFrame({'icustay_id': rng.integers(1, 150, m).astype(float),
+                       'charttime': base + pd.to_timedelta(rng.integers(0, 10 * 24, m), unit='h'),
+                       'itemid': rng.choice([30047, 30120, 30043], m),
+                       'stopped': rng.choice(['Stopped', "D/C'd", 'Restart', None], m,
+                                             p=[.05, .05, .1, .8]),
+                       'rate': np.where(rng.random(m) < .3, np.nan,
+                                        rng.choice([0, 0.05, 0.1, 2.0], m)),
+                       'amount': rng.random(m)})
+    cv.loc[rng.random(m) < .01, 'icustay_id'] = np.nan
+    k = 3000
+    start = base + pd.to_timedelta(rng.integers(0, 10 * 24 * 60, k), unit='min')
+    mv = pd.DataFrame({'icustay_id': rng.integers(1000, 1100, k),
+                       'linkorderid': rng.integers(0, 500, k), 'starttime': start,
+                       'endtime': start + pd.to_timedelta(rng.integers(1, 600, k), unit='min'),
+                       'itemid': rng.choice(du.VASO_MV_ITEMS, k),
+                       'statusdescription': rng.choice(['FinishedRunning', 'Rewritten'], k)})
+    replace_table(backend, 'inputevents_cv', cv)
+    replace_table(backend, 'inputevents_mv', mv)
+
+    with open('query/tbls/vaso-dur.sql', 'r') as fp:
+        backend.execute(fp.read())
+    ref = backend.read_sql('select icustay_id, vasonum, starttime, endtime from vasodur')
+    res = du.get_vasopressor_durations(backend)
+    assert len(ref) > 0
+
+    key = ['icustay_id', 'vasonum', 'starttime']
+    ref = ref.sort_values(key).reset_index(drop=True)
+    res = res.sort_values(key).reset_index(drop=True)
+    ref['vasonum'] = ref['vasonum'].astype(int)
+    pd.testing.assert_frame_equal(res, ref, check_dtype=False)
@@ -0,0 +1,46 @@
+# fit_mfp on a small fixed dataset: a quadratic effect of age, a 4 valued score whose
+# effect is not monotone (which an FP2 would fit exactly), and a 3 valued covariate
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from sepsis_utils import mfp
+
+def fixed_data(n=1000):
+    # low discrepancy sequences rather than a random generator, so the data do not
+    # depend on the version of numpy
+    k = np.arange(n)
+    u = (k * 0.6180339887498949) % 1.0
+    age = 20 + 70 * ((k * 0.7548776662466927) % 1.0)
+    qsofa = np.floor(4 * ((k * 0.5698402909980532) % 1.0))
+    grp = np.floor(3 * ((k * 0.41421356237309515) % 1.0))
+    male = (k % 2).astype(float)
+    logit = -4 + 0.0015 * (age - 20)**2 + np.array([0, 2.0, 0.5, 1.0])[qsofa.astype(int)] \
+        + 0.3 * grp + 0.2 * male
+    y = (u < 1 / (1 + np.exp(-logit))).astype(float)
+    return pd.DataFrame({'y': y, 'age': age, 'qsofa': qsofa, 'grp': grp, 'male': male})
+
+def test_fp_df():
+    assert mfp.fp_df([0, 1, 1, 0]) == 1
+    assert mfp.fp_df([0, 1, 2]) == 1
+    assert mfp.fp_df([0, 1, 2, 3]) == 2
+    assert mfp.fp_df([0, 1, 2, 3, 4]) == 2
+    assert mfp.fp_df(np.arange(6)) == 4
+
+def test_fit_mfp():
+    df = fixed_data()
+    res = mfp.fit_mfp(df, 'y ~ fp(age) + fp(qsofa) + fp(grp) + male')
+    # qsofa is limited to FP1, and grp is linear
+    assert dict(res['powers']) == {'age': (3,), 'qsofa': (-2,), 'grp': (1,)}
+    assert mfp.fp_scale(df['age'].values) == (0.0, 100.0)
+    assert mfp.fp_scale(df['qsofa'].values) == (1.0, 1.0)
+
+    # the final model is a logistic regression on the transformed covariates
+    X = np.column_stack([(df['age'] / 100.0)**3, (df['qsofa'] + 1.0)**-2, df['grp'], df['male']])
+    ref = sm.Logit(df['y'].values, sm.add_constant(X)).fit(disp=0)
+    np.testing.assert_allclose(res['pred'], ref.predict(), rtol=1e-6)
+    np.testing.assert_allclose(res['model'].llf, -403.33152867, rtol=1e-8)
+    np.testing.assert_allclose(res['pred'][[0, 1, 2, 100, 999]],
+                               [0.03568534, 0.85418466, 0.19177503, 0.36151182, 0.09928117],
+                               rtol=1e-6)
@@ -0,0 +1,73 @@
+# rolling_reduce against sofa.reduce_windows, on random values and on the hourly windows
+# of random events, where each window is reduced separately
+
+import numpy as np
+import pandas as pd
+
+from sepsis_utils import rolling as ro
+from sepsis_utils import sofa as so
+from test_sofa import N_STAYS, random_frames
+
+def test_rolling_reduce_matches_reduce_windows():
+    rng = np.random.default_rng(0)
+    n = 500
+    values = rng.normal(size=n)
+    values[rng.random(n) < 0.2] = np.nan
+    # windows of any length, including empty windows and windows at the end of the array
+    lo = rng.integers(0, n + 1, 2000)
+    hi = np.minimum(lo + rng.choice([0, 1, 2, 3, 7, 64, 300], lo.size), n)
+    lo[:3], hi[:3] = [0, n, 5], [n, n, 5]
+    for ufunc in [np.fmin, np.fmax]:
+        res = ro.rolling_reduce(ufunc, values, lo, hi)
+        np.testing.assert_array_equal(res, so.reduce_windows(ufunc, values, lo, hi))
+    # sums are taken over values without nulls (see sofa.sofa_components)
+    values = np.nan_to_num(values)
+    np.testing.assert_allclose(ro.rolling_reduce(np.add, values, lo, hi),
+                               so.reduce_windows(np.add, values, lo, hi))
+
+    empty = np.zeros(0, dtype=int)
+    assert ro.sparse_table_reduce(np.fmin, values, empty, empty).size == 0
+    assert np.isnan(ro.sparse_table_reduce(np.fmax, values, lo[1:2], hi[1:2])).all()
+
+def random_rolling_frames(rng):
+    frames = random_frames(rng)
+    base = pd.Timestamp('2150-01-01')
+    ts = lambda n: base + pd.to_timedelta(np.round(rng.uniform(0, 240, n) * 4) / 4, unit='h')
+    ids = lambda n: rng.integers(1, N_STAYS + 1, n)
+    n = 1500
+    vitals = pd.DataFrame({'icustay_id': ids(n), 'charttime': ts(n)})
+    for c, lo, hi in [('heartrate', 40, 150), ('sysbp', 60, 180), ('resprate', 8, 35),
+                      ('tempc', 34, 40)]:
+        vitals[c] = np.where(rng.random(n) < 0.5, np.nan, rng.uniform(lo, hi, n))
+    frames['vitals'] = vitals
+    k = n // 5
+    frames['wbc'] = pd.DataFrame({
+        'icustay_id': ids(k), 'charttime': ts(k),
+        'wbc': np.where(rng.random(k) < 0.3, np.nan, rng.uniform(1, 20, k)),
+        'bands': np.where(rng.random(k) < 0.7, np.nan, rng.uniform(0, 20, k))})
+    frames['paco2'] = pd.DataFrame({'icustay_id': ids(k), 'charttime': ts(k),
+                                    'paco2': rng.uniform(20, 60, k)})
+    return frames
+
+def test_rolling_scores_match_reduce_windows():
+    rng = np.random.default_rng(1)
+    events = ro.rolling_events(random_rolling_frames(rng))
+    # stays with no events, stays which end before their first events, and a stay
+    # whose end is missing
+    intime = pd.Timestamp('2150-01-01') + pd.to_timedelta(rng.uniform(-48, 200, N_STAYS + 5),
+                                                          unit='h')
+    icustays = pd.DataFrame({'icustay_id': np.arange(1, N_STAYS + 6), 'intime': intime,
+                             'outtime': intime + pd.to_timedelta(rng.uniform(0, 96, N_STAYS + 5),
+                                                                 unit='h')})
+    icustays.loc[0, 'outtime'] = pd.NaT
+
+    for hours, step in [(24, 1), (6, 1), (None, 3)]:
+        windows = ro.hourly_windows(icustays, hours=hours, step=step)
+        assert (windows['icustay_id'] == 1).sum() == 0
+        res = ro.rolling_scores(events, windows)
+        ref = ro.rolling_scores(events, windows, reduce=so.reduce_windows)
+        # some windows have no events of any kind
+        assert ref[['respiration', 'coagulation', 'liver', 'cardiovascular', 'cns',
+                    'renal']].isnull().all(axis=1).any()
+        assert ref['sirs'].max() >= 3 and ref['sofa'].max() >= 6
+        pd.testing.assert_frame_equal(res, ref)
@@ -0,0 +1,268 @@
+# sofa against a row by row reference of sofa-si.sql on random events, and the arterial
+# blood gases of BLOODGAS_ARTERIAL_QUERY against blood-gas-arterial-infect-time.sql
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sepsis_utils import sofa as so
+
+N_STAYS = 60
+N_EVENTS = 1500
+
+def random_frames(rng):
+    base = pd.Timestamp('2150-01-01')
+    ts = lambda n: base + pd.to_timedelta(np.round(rng.uniform(0, 240, n) * 4) / 4, unit='h')
+    ids = lambda n: rng.integers(1, N_STAYS + 1, n)
+    n = N_EVENTS
+    frames = dict()
+    frames['meanbp'] = pd.DataFrame({'icustay_id': ids(n), 'charttime': ts(n),
+                                     'meanbp': rng.uniform(40, 120, n)})
+    labs = pd.DataFrame({'icustay_id': ids(n), 'charttime': ts(n)})
+    k = rng.integers(0, 3, n)
+    for i, (c, lo, hi) in enumerate([('creatinine', 0.3, 7), ('bilirubin', 0.1, 15),
+                                     ('platelet', 5, 400)]):
+        labs[c] = np.where(k == i, rng.uniform(lo, hi, n), np.nan)
+    frames['labs'] = labs
+    urine = pd.DataFrame({'icustay_id': ids(n), 'charttime': ts(n),
+                          'urineoutput': rng.uniform(0, 80, n)})
+    urine.loc[rng.random(n) < 0.05, 'urineoutput'] = np.nan
+    frames['urine'] = urine
+    gcs = pd.DataFrame({'icustay_id': ids(n), 'charttime': ts(n)})
+    gcs = gcs.drop_duplicates(['icustay_id', 'charttime'])
+    m = len(gcs)
+    gcs['gcsmotor'] = np.where(rng.random(m) < 0.3, np.nan, rng.integers(1, 7, m))
+    gcs['gcsverbal'] = np.where(rng.random(m) < 0.3, np.nan, rng.integers(0, 6, m))
+    gcs['gcseyes'] = np.where(rng.random(m) < 0.3, np.nan, rng.integers(1, 5, m))
+    frames['gcs'] = gcs
+    frames['bloodgas'] = pd.DataFrame({'icustay_id': ids(n // 3), 'charttime': ts(n // 3),
+                                       'pao2fio2': rng.uniform(50, 500, n // 3)})
+    start = ts(100)
+    frames['ventdurations'] = pd.DataFrame({
+        'icustay_id': ids(100), 'starttime': start,
+        'endtime': start + pd.to_timedelta(rng.uniform(1, 60, 100), unit='h')})
+    k = n // 6
+    frames['vasopressors'] = pd.DataFrame({
+        'icustay_id': ids(k), 'charttime': ts(k), 'source': rng.choice(['cv', 'mv'], k),
+        'drug': rng.choice(list(so.VASOPRESSORS), k),
+        'rate': rng.uniform(0.01, 0.3, k) * np.where(rng.random(k) < 0.3, 60, 1)})
+    return frames
+
+def nmin(x):
+    x = x.dropna()
+    return x.min() if len(x) > 0 else np.nan
+
+def nmax(x):
+    x = x.dropna()
+    return x.max() if len(x) > 0 else np.nan
+
+def coalesce(a, b):
+    return b if pd.isnull(a) else a
+
+def reference_components(frames, w):
+    # the scorecomp CTE of sofa-si.sql for one window, one row at a time
+    def within(df):
+        return df.loc[(df['icustay_id'] == w.icustay_id) & (df['charttime'] >= w.starttime)
+                      & (df['charttime'] <= w.endtime)]
+    r = dict()
+    r['meanbp_min'] = nmin(within(frames['meanbp'])['meanbp'])
+    labs = within(frames['labs'])
+    r['creatinine_max'] = nmax(labs['creatinine'])
+    r['bilirubin_max'] = nmax(labs['bilirubin'])
+    r['platelet_min'] = nmin(labs['platelet'])
+
+    bg = within(frames['bloodgas'])
+    vd = frames['ventdurations']
+    vent = np.array([((vd['icustay_id'] == b.icustay_id) & (vd['starttime'] <= b.charttime)
+                      & (vd['endtime'] >= b.charttime)).any() for b in bg.itertuples()],
+                    dtype=bool)
+    r['pao2fio2_vent_min'] = nmin(bg['pao2fio2'][vent]) if len(bg) > 0 else np.nan
+    r['pao2fio2_novent_min'] = nmin(bg['pao2fio2'][~vent]) if len(bg) > 0 else np.nan
+
+    uo = within(frames['urine'])
+    if len(uo) == 0 or uo['urineoutput'].notnull().sum() == 0 \
+            or uo['charttime'].max() == uo['charttime'].min():
+        r['urineoutput'] = np.nan
+    else:
+        days = (uo['charttime'].max() - uo['charttime'].min()).total_seconds() / 86400
+        r['urineoutput'] = uo['urineoutput'].sum() / days
+
+    # a GCS uses the previous row of the window if it is within 6 hours
+    best, prev = np.nan, None
+    for g in within(frames['gcs']).sort_values('charttime').itertuples():
+        p = prev if prev is not None \
+            and prev.charttime > g.charttime - pd.Timedelta(hours=6) else None
+        pv = lambda c: np.nan if p is None else getattr(p, c)
+        if g.gcsverbal == 0:
+            v = 15
+        elif pd.isnull(g.gcsverbal) and pv('gcsverbal') == 0:
+            v = 15
+        elif pv('gcsverbal') == 0:
+            v = coalesce(g.gcsmotor, 6) + coalesce(g.gcsverbal, 5) + coalesce(g.gcseyes, 4)
+        else:
+            v = coalesce(g.gcsmotor, coalesce(pv('gcsmotor'), 6)) \
+                + coalesce(g.gcsverbal, coalesce(pv('gcsverbal'), 5)) \
+                + coalesce(g.gcseyes, coalesce(pv('gcseyes'), 4))
+        best = v if pd.isnull(best) else min(best, v)
+        prev = g
+    r['mingcs'] = best
+
+    va = within(frames['vasopressors'])
+    for d in so.VASOPRESSORS:
+        cv = nmax(va['rate'][(va['drug'] == d) & (va['source'] == 'cv')])
+        mv = nmax(va['rate'][(va['drug'] == d) & (va['source'] == 'mv')])
+        r['rate_' + d] = mv if np.isnan(cv) else cv
+    return r
+
+def test_sofa_components_match_reference():
+    rng = np.random.default_rng(1)
+    frames = random_frames(rng)
+    start = pd.Timestamp('2150-01-01') + pd.to_timedelta(rng.uniform(0, 240, 3 * N_STAYS), unit='h')
+    windows = pd.DataFrame({'icustay_id': np.tile(np.arange(1, N_STAYS + 1), 3),
+                            'starttime': start,
+                            'endtime': start + pd.to_timedelta(rng.uniform(0, 72, 3 * N_STAYS),
+                                                               unit='h')})
+
+    comp = so.sofa_components(so.sofa_events(frames), windows)
+    ref = pd.DataFrame([reference_components(frames, w) for w in windows.itertuples()])
+    for c in ref.columns:
+        np.testing.assert_allclose(comp[c].values.astype(float), ref[c].values.astype(float),
+                                   err_msg=c)
+
+def test_bloodgas_arterial_query(backend):
+    # with a window covering the whole stay, the *_si scripts give every arterial gas
+    backend.execute("""
+    create table suspinfect_poe as
+    select icustay_id, timestamp '1900-01-01' as si_starttime,
+      timestamp '2300-01-01' as si_endtime
+    from icustays
+    """)
+    for f in ['query/tbls/blood-gas-infect-time.sql',
+              'query/tbls/blood-gas-arterial-infect-time.sql']:
+        with open(f, 'r') as fp:
+            backend.execute(fp.read())
+    ref = backend.read_sql("""
+    select icustay_id, charttime, specimen_pred, pco2, pao2fio2
+    from bloodgasarterial_si order by 1, 2
+    """)
+    res = backend.read_sql(so.BLOODGAS_ARTERIAL_QUERY + ' order by 1, 2')
+    assert len(ref) > 0
+    pd.testing.assert_frame_equal(res, ref, check_dtype=False)
+
+def create_table(backend, name, df):
+    backend.con.register('df_' + name, df)
+    backend.con.execute('create table ' + name + ' as select * from df_' + name)
+    backend.con.unregister('df_' + name)
+
+def test_sofa_matches_sql(tmp_path):
+    # random events on both sides of each cutoff of sofa-si.sql, scored by the SQL (with
+    # the *_si tables it reads) and by get_sofa_events and sofa
+    duckdb_backend = pytest.importorskip('sepsis_utils.duckdb_backend')
+    backend = duckdb_backend.DuckDBBackend(str(tmp_path))
+    rng = np.random.default_rng(2)
+    base = pd.Timestamp('2150-01-01')
+    # few events of each kind in a window, so that every score of each subscore occurs
+    S, n = 400, 1200
+    ts = lambda n: base + pd.to_timedelta(rng.integers(0, 10 * 24 * 4, n) * 15, unit='min')
+    ids = lambda n: rng.integers(1, S + 1, n)
+
+    icustays = pd.DataFrame({'icustay_id': np.arange(1, S + 1),
+                             'hadm_id': np.arange(1, S + 1) + 1000})
+    sit = pd.Series(ts(S))
+    sit[rng.random(S) < 0.1] = pd.NaT
+    suspinfect = pd.DataFrame({'icustay_id': icustays['icustay_id'],
+                               'suspected_infection_time': sit,
+                               'si_starttime': sit - pd.Timedelta(hours=48),
+                               'si_endtime': sit + pd.Timedelta(hours=24)})
+
+    # mean blood pressure, and GCS components, some charted as intubated
+    meanbp = pd.DataFrame({'icustay_id': ids(n), 'itemid': rng.choice([456, 220052], n),
+                           'charttime': ts(n), 'value': None,
+                           'valuenum': rng.choice([40.0, 69.9, 70.0, 95.0, 350.0], n),
+                           'error': rng.choice([0, 0, 0, 1, None], n)})
+    # GCS panels of motor, verbal and eyes, charted as carevue or metavision, with a
+    # component sometimes missing or charted as intubated
+    m = n // 4
+    panel = pd.DataFrame({'icustay_id': ids(m), 'charttime': ts(m),
+                          'metavision': rng.random(m) < 0.5})
+    gcs = list()
+    for cv, mv, top in [(454, 223901, 6), (723, 223900, 5), (184, 220739, 4)]:
+        g = panel.assign(itemid=np.where(panel['metavision'], mv, cv),
+                         valuenum=rng.integers(1, top + 1, m).astype(float), value='x', error=0)
+        if cv == 723:
+            intubated = rng.random(m) < 0.15
+            g.loc[intubated, 'value'] = np.where(g['metavision'], 'No Response-ETT',
+                                                 '1.0 ET/Trach')[intubated]
+            g.loc[intubated, 'valuenum'] = np.nan
+        gcs.append(g.loc[rng.random(m) < 0.9].drop('metavision', axis=1))
+    gcs = pd.concat(gcs, ignore_index=True)
+    create_table(backend, 'chartevents', pd.concat([meanbp, gcs], ignore_index=True))
+
+    item = rng.choice([50912, 50885, 51265], n)
+    value = np.select([item == 50912, item == 50885],
+                      [rng.choice([1.1, 1.2, 2.0, 3.5, 4.9, 5.0, 200.0], n),
+                       rng.choice([1.1, 1.2, 2.0, 6.0, 12.0], n)],
+                      rng.choice([19.0, 20.0, 50.0, 99.0, 100.0, 150.0, 300.0], n))
+    create_table(backend, 'labevents', pd.DataFrame({
+        'hadm_id': ids(n) + 1000, 'itemid': item, 'charttime': ts(n), 'valuenum': value}))
+    create_table(backend, 'outputevents', pd.DataFrame({
+        'icustay_id': ids(n), 'charttime': ts(n), 'itemid': rng.choice([40055, 226559], n),
+        'value': rng.uniform(0, 60, n)}))
+
+    # vasopressor rates about each cutoff: 0.1 for (nor)epinephrine, 5 and 15 for
+    # dopamine - carevue 30047 and 30044 are per minute, and are divided by the weight
+    k = n // 3
+    cv_item = rng.choice([30047, 30120, 30044, 30119, 30309, 30043, 30307, 30042, 30306], k)
+    per_minute = np.isin(cv_item, [30047, 30044])
+    dopamine = np.isin(cv_item, [30043, 30307])
+    rate = np.where(dopamine, rng.choice([0.0, 2.0, 5.0, 5.5, 15.0, 16.0], k),
+                    rng.choice([0.0, 0.05, 0.1, 0.11, 0.3], k))
+    create_table(backend, 'inputevents_cv', pd.DataFrame({
+        'icustay_id': ids(k), 'charttime': ts(k), 'itemid': cv_item,
+        'rate': np.where(rng.random(k) < 0.1, np.nan, np.where(per_minute, rate * 80, rate))}))
+    mv_item = rng.choice([221906, 221289, 221662, 221653], k)
+    create_table(backend, 'inputevents_mv', pd.DataFrame({
+        'icustay_id': ids(k), 'starttime': ts(k), 'itemid': mv_item,
+        'rate': np.where(mv_item == 221662, rng.choice([2.0, 5.0, 5.5, 15.0, 16.0], k),
+                         rng.choice([0.05, 0.1, 0.11, 0.3], k)),
+        'statusdescription': rng.choice(['FinishedRunning', 'Rewritten'], k, p=[0.9, 0.1])}))
+    weight = pd.DataFrame({'icustay_id': icustays['icustay_id'], 'weight': 80.0})
+    create_table(backend, 'weightfirstday', weight.loc[rng.random(S) < 0.9])
+
+    # PaO2/FiO2 about each cutoff, in and out of ventilation - sofa-si.sql reads the gases
+    # in the window (bloodgasarterial_si), and sofa the gases of the whole stay
+    k = n // 3
+    bloodgas = pd.DataFrame({
+        'icustay_id': ids(k), 'charttime': ts(k), 'specimen_pred': 'ART', 'pco2': 40.0,
+        'pao2fio2': rng.choice([99.0, 100.0, 199.0, 200.0, 299.0, 300.0, 399.0, 400.0,
+                                np.nan], k)})
+    create_table(backend, 'bloodgas', bloodgas)
+    window = bloodgas.merge(suspinfect, on='icustay_id')
+    window = window.loc[(window['charttime'] >= window['si_starttime'])
+                        & (window['charttime'] <= window['si_endtime'])]
+    create_table(backend, 'bloodgasarterial_si', window[bloodgas.columns])
+    start = ts(S)
+    create_table(backend, 'ventdurations', pd.DataFrame({
+        'icustay_id': ids(S), 'starttime': start,
+        'endtime': start + pd.to_timedelta(rng.integers(1, 72, S), unit='h')}))
+    create_table(backend, 'icustays', icustays)
+    create_table(backend, 'suspinfect_poe', suspinfect)
+
+    for f in ['vitals-infect-time', 'labs-infect-time', 'urine-output-infect-time',
+              'gcs-infect-time', 'sofa-si']:
+        with open('query/tbls/' + f + '.sql', 'r') as fp:
+            backend.execute(fp.read())
+    ref = backend.read_sql('select * from sofa_si order by icustay_id')
+
+    frames = so.get_sofa_events(backend, bloodgas_table='bloodgas')
+    res = so.sofa(so.sofa_events(frames), so.si_windows(suspinfect))
+    res = res.sort_values('icustay_id').reset_index(drop=True)
+    backend.close()
+
+    organs = ['respiration', 'coagulation', 'liver', 'cardiovascular', 'cns', 'renal']
+    assert res['icustay_id'].tolist() == ref['icustay_id'].tolist()
+    for c in organs:
+        # every score of each subscore is reached
+        assert set(ref[c].dropna()) == set(range(5)), c
+    pd.testing.assert_frame_equal(res[['sofa'] + organs], ref[['sofa'] + organs],
+                                  check_dtype=False)
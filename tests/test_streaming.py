@@ -0,0 +1,129 @@
+# Sepsis3Monitor: a replay of the synthetic data against the batch scores of
+# suspicion.py, sofa.py and rolling.py, and the state it keeps between events
+
+import numpy as np
+import pandas as pd
+
+from sepsis_utils import durations as du
+from sepsis_utils import rolling as ro
+from sepsis_utils import sofa as so
+from sepsis_utils import suspicion as su
+from sepsis_utils.streaming import HOUR, Sepsis3Monitor, event_feed
+
+# the synthetic data has no vasopressors or weights
+EMPTY_TABLES = """
+create table inputevents_cv as
+select 1 as icustay_id, timestamp '2100-01-01' as charttime, 1 as itemid, 1.0 as rate
+where false;
+create table inputevents_mv as
+select 1 as icustay_id, timestamp '2100-01-01' as starttime, 1 as itemid, 1.0 as rate,
+  'x' as statusdescription
+where false;
+create table weightfirstday as select 1 as icustay_id, 1.0 as weight where false;
+"""
+
+def test_replay_matches_batch(backend):
+    backend.execute(EMPTY_TABLES)
+    vd = du.get_ventilation_durations(backend)
+    backend.con.register('ventdurations', vd)
+
+    icustays = backend.read_sql('select * from icustays')
+    prescriptions = backend.read_sql('select * from prescriptions')
+    micro = backend.read_sql('select * from microbiologyevents')
+    si = su.suspicion_of_infection(icustays, prescriptions, micro)
+    frames = ro.get_rolling_events(backend)
+    events = ro.rolling_events(frames)
+    windows = so.si_windows(si)
+    batch = so.sofa(events, windows)
+    batch['qsofa'] = ro.qsofa_scores(events, windows.reset_index(drop=True))['qsofa'].values
+    batch = batch.merge(si[['icustay_id', 'suspected_infection_time']], on='icustay_id')
+    assert len(batch) > 0
+
+    bg = frames['bloodgas']
+    bg = bg.assign(ventilated=so.ventilated(bg['icustay_id'].values, bg['charttime'], vd))
+    feed = event_feed(icustays, backend.read_sql('select * from chartevents'),
+                      backend.read_sql('select * from labevents'),
+                      backend.read_sql('select * from outputevents'), prescriptions, micro,
+                      bloodgas=bg, discharge=False)
+    monitor = Sepsis3Monitor(su.antibiotic_drugs(prescriptions))
+    alerts = list(monitor.run(feed)) + list(monitor.flush(feed[-1][0] + 1))
+    state = monitor.state()
+    state = state.loc[state['suspected_infection_time'].notnull()]
+    state['suspected_infection_time'] = pd.to_datetime(state['suspected_infection_time'], unit='s')
+
+    res = batch.merge(state, on='icustay_id', how='outer', suffixes=('', '_stream'))
+    assert len(res) == len(batch)
+    for c in ['suspected_infection_time', 'respiration', 'coagulation', 'liver',
+              'cardiovascular', 'cns', 'renal', 'sofa', 'qsofa']:
+        pd.testing.assert_series_equal(res[c + '_stream'], res[c], check_dtype=False,
+                                       check_names=False, obj=c)
+
+    # every alert is raised once, and only for stays which meet it at the end
+    kinds = pd.DataFrame([(a.icustay_id, a.alert) for a in alerts], columns=['icustay_id', 'alert'])
+    assert not kinds.duplicated().any()
+    for alert, met in [('suspected_infection', res['icustay_id']),
+                       ('qsofa', res.loc[res['qsofa'] >= 2, 'icustay_id']),
+                       ('sepsis3', res.loc[res['sofa'] >= 2, 'icustay_id'])]:
+        assert set(kinds.loc[kinds['alert'] == alert, 'icustay_id']) == set(met)
+
+def infection(hadm_id, t):
+    # a culture and an antibiotic an hour later, for a suspected infection time of t
+    return [(t, 'culture', hadm_id, None, 'BLOOD', 0),
+            (t + HOUR, 'prescription', hadm_id, None, 'vancomycin', None)]
+
+def test_urine_output_waits_for_the_window():
+    # two small outputs an hour apart extrapolate to a renal subscore of 3, which the
+    # rest of the window may bring down, so the alert waits for the window to close
+    monitor = Sepsis3Monitor(['vancomycin'])
+    feed = [(0, 'icustay', 1, None, 10, 70.0)] + infection(10, HOUR) \
+        + [(3 * HOUR, 'output', 1, 40055, None, 5.0),
+           (4 * HOUR, 'output', 1, 40055, None, 5.0)]
+    alerts = list(monitor.run(feed))
+    assert [a.alert for a in alerts] == ['suspected_infection']
+    assert monitor.stays[1].subscores[5] == 3
+
+    # more urine in the window, then the window closes: no alert
+    alerts = list(monitor.run([(20 * HOUR, 'output', 1, 40055, None, 2000.0)]))
+    alerts += monitor.flush(HOUR + 25 * HOUR)
+    assert alerts == []
+    assert monitor.stays[1].sofa == 0
+
+    # the same outputs alone alert once the window has closed
+    monitor = Sepsis3Monitor(['vancomycin'])
+    list(monitor.run(feed))
+    alerts = list(monitor.run([(HOUR + 25 * HOUR, 'chart', 1, 220045, None, 80.0)]))
+    assert [(a.alert, a.sofa) for a in alerts] == [('sepsis3', 3)]
+
+def test_creatinine_alerts_in_open_window():
+    monitor = Sepsis3Monitor(['vancomycin'])
+    feed = [(0, 'icustay', 1, None, 10, 70.0)] + infection(10, HOUR) \
+        + [(3 * HOUR, 'lab', 10, 50912, None, 2.5)]
+    assert [a.alert for a in monitor.run(feed)] == ['suspected_infection', 'sepsis3']
+
+def test_second_stay_keeps_suspected_infection():
+    monitor = Sepsis3Monitor(['vancomycin'])
+    feed = [(0, 'icustay', 1, None, 10, 70.0)] + infection(10, HOUR) \
+        + [(10 * HOUR, 'discharge', 1, None, None, None),
+           (300 * HOUR, 'icustay', 2, None, 10, 70.0)]
+    list(monitor.run(feed))
+    assert monitor.stays[2].start == HOUR - 48 * HOUR
+
+    list(monitor.run([(400 * HOUR, 'hospital_discharge', 10, None, None, None)]))
+    assert len(monitor.admissions) == 0 and len(monitor.stays) == 0
+
+def test_admissions_without_stays_expire():
+    # labs of ward admissions are dropped once they have had no events for the lookback
+    monitor = Sepsis3Monitor(['vancomycin'])
+    n = 20000
+    list(monitor.run([(k * 60, 'lab', k, 50912, None, 1.0) for k in range(n)]))
+    assert len(monitor.admissions) <= (monitor.lookback + HOUR) // 60 + 1
+    assert len(monitor.admissions) < n
+
+def test_event_feed_hospital_discharge():
+    icustays = pd.DataFrame({'icustay_id': [1], 'hadm_id': [10],
+                             'intime': pd.to_datetime(['2100-01-01']),
+                             'outtime': pd.to_datetime(['2100-01-02'])})
+    admissions = pd.DataFrame({'hadm_id': [10], 'dischtime': pd.to_datetime(['2100-01-05'])})
+    feed = event_feed(icustays, admissions=admissions)
+    assert [e[1] for e in feed] == ['icustay', 'discharge', 'hospital_discharge']
+    assert np.diff([e[0] for e in feed]).min() > 0
@@ -0,0 +1,50 @@
+# suspicion.suspicion_of_infection against suspinfect_poe built by the SQL in DuckDB
+
+import pandas as pd
+
+from sepsis_utils import suspicion as su
+
+SCRIPTS = ['query/tbls/abx-poe-list.sql', 'query/tbls/abx-micro-prescription.sql',
+           'query/tbls/suspicion-of-infection.sql']
+
+def build(backend):
+    backend.run_build('query/make-tables.sql', only=SCRIPTS, verbose=False)
+    icustays = backend.read_sql('select * from mimiciii.icustays')
+    prescriptions = backend.read_sql('select * from mimiciii.prescriptions')
+    micro = backend.read_sql('select * from mimiciii.microbiologyevents')
+    return icustays, prescriptions, micro
+
+def test_antibiotic_drugs(backend):
+    _, prescriptions, _ = build(backend)
+    sql = set(backend.read_sql('select drug from abx_poe_list')['drug'])
+    assert len(sql) > 0
+    assert su.antibiotic_drugs(prescriptions) == sql
+
+def test_suspected_infection_time(backend):
+    icustays, prescriptions, micro = build(backend)
+    sql = backend.read_sql('select * from suspinfect_poe order by icustay_id')
+    py = su.suspicion_of_infection(icustays, prescriptions, micro)
+
+    assert py['icustay_id'].tolist() == sql['icustay_id'].tolist()
+    assert sql['suspected_infection_time'].notnull().sum() > 0
+    pd.testing.assert_series_equal(py['suspected_infection_time'].reset_index(drop=True),
+                                   sql['suspected_infection_time'].reset_index(drop=True),
+                                   check_dtype=False, check_names=False)
+
+def test_chosen_row_is_tied(backend):
+    # the SQL picks an arbitrary row among ties on suspected_infection_time, so the row
+    # chosen here must be one of the tied rows of abx_micro_poe
+    icustays, prescriptions, micro = build(backend)
+    sql = backend.read_sql('select * from suspinfect_poe')
+    amp = backend.read_sql('select * from abx_micro_poe')
+    amp = amp.merge(sql[['icustay_id', 'suspected_infection_time']], on='icustay_id',
+                    suffixes=('', '_first'))
+    tied = amp.loc[amp['suspected_infection_time'] == amp['suspected_infection_time_first']]
+
+    key = lambda df: set(zip(df['icustay_id'], df['antibiotic_name'], df['antibiotic_time'],
+                             df['specimen'].fillna(''),
+                             df['positiveculture'].fillna(-1).astype(int)))
+    py = su.suspicion_of_infection(icustays, prescriptions, micro)
+    py = py.loc[py['suspected_infection_time'].notnull()]
+    assert len(py) > 0
+    assert key(py) <= key(tied)